@@ -1,32 +1,49 @@
-import scipy.io
 import math
 import numpy as np
 from matplotlib import pyplot as plt
-from agent import Agent, cal_interior_cost, cal_group_cost
-from tools.utility import get_central_vertices, smooth_ployline, get_intersection_point
+from agent import Agent, cal_interior_cost, cal_group_cost, MAX_ACCELERATION, MAX_STEERING_ANGLE
+from tools.utility import get_central_vertices, smooth_ployline, segment_intersections, project_to_polyline
+from tools.nds_dataset import NDSDataset
+from tools.render import render_frames, make_gif, make_mp4
 import pandas as pd
 from datetime import datetime
 import xlsxwriter
+import hashlib
+import os
 
 illustration_needed = False
 print_needed = False
 save_data_needed = True
-# load data
-mat = scipy.io.loadmat('./data/NDS_data_fixed.mat')
-# full interaction information
-inter_info = mat['interaction_info']
-case_number = len(inter_info)
+# warm start the IPV estimation of each frame from the last frame of the same agent (False: every frame from scratch)
+incremental_estimation = True
+# NDS data, loaded on first use. set a memmap directory to convert the .mat once into memory-mappable arrays
+# shared by all processes (e.g. the workers of analyze_nds_parallel)
+nds_memmap_directory = None  # './data/NDS_data_fixed_memmap'
+nds_data = NDSDataset('./data/NDS_data_fixed.mat', nds_memmap_directory)
 '''
-inter_info:
+nds_data.interaction_info: full interaction information
 0-1: [position x] [position y]
 2-3: [velocity x] [velocity y]
 4: [heading]
 5: [velocity overall = sqrt(vx^2+xy^2)]
 6: [curvature] (only for left-turn vehicles)
 dt = 0.12s 
+nds_data.interact_agent_num: the number of go-straight vehicles that interact with the left-turn vehicle
 '''
-# the number of go-straight vehicles that interact with the left-turn vehicle
-inter_num = mat['interact_agent_num']
+
+
+def __getattr__(name):
+    # module attributes of the NDS data before it was loaded lazily
+    if name == 'inter_info':
+        return nds_data.interaction_info
+    if name == 'inter_num':
+        return nds_data.interact_agent_num
+    if name == 'case_number':
+        return nds_data.case_number
+    if name == 'mat':
+        return {'interaction_info': nds_data.interaction_info, 'interact_agent_num': nds_data.interact_agent_num}
+    raise AttributeError("module '" + __name__ + "' has no attribute '" + name + "'")
+
 
 # virtual_agent_IPV_range = np.array([-4, -3, -2, -1, 0, 1, 2, 3, 4]) * math.pi / 9
 
@@ -35,14 +52,135 @@ current_nds_data_version = 5
 data_path = '../data/3_parallel_game_outputs/'
 
 
-def visualize_nds(case_id):
+def file_sha1(file_name):
+    sha1 = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def find_crossing_id(segments):
+    """
+    the first interaction segment in which the left-turn vehicle passes the x position of the interacting
+    go-straight vehicle, -1 if there is none
+    """
+    for i, segment in enumerate(segments):
+        delta_x = segment[:, 2] - segment[:, 9]  # x position of LT is larger than that of interacting FC
+        if len(delta_x) > 0 and np.max(delta_x) > 0:
+            return i
+    return -1
+
+
+def nds_case_file(case_id):
+    """
+    excel of the estimated IPV of a case, written by analyze_nds and read by analyze_ipv_in_nds (with its binary
+    copy, see load_nds_segments)
+    """
+    return data_path + 'NDS_analysis/ipv_estimation/v' + str(current_nds_data_version) + '/' + str(case_id) + '.xlsx'
+
+
+def save_nds_segments(file_name, segments):
+    """
+    binary copy (.npz next to the excel) of the interaction segments of a case, i.e. the sheets of the excel written
+    by analyze_nds, with the crossing index. the copy is only used while the excel and current_nds_data_version
+    are unchanged
+    """
+    arrays = {'segment_' + str(i): np.asarray(segment, dtype=float) for i, segment in enumerate(segments)}
+    np.savez(file_name[:-len('.xlsx')] + '.npz',
+             num_segments=len(segments),
+             crossing_id=find_crossing_id(segments),
+             version=current_nds_data_version,
+             source_sha1=file_sha1(file_name),
+             **arrays)
+
+
+def load_nds_segments(file_name):
+    """
+    interaction segments of a case from its binary copy, or from the excel (the binary copy is then rebuilt)
+    :param file_name: excel of the case
+    :return: list of segments (one array per sheet), crossing index
+    """
+    cache_name = file_name[:-len('.xlsx')] + '.npz'
+    if os.path.exists(cache_name):
+        with np.load(cache_name) as cache:
+            if int(cache['version']) == current_nds_data_version \
+                    and (not os.path.exists(file_name) or str(cache['source_sha1']) == file_sha1(file_name)):
+                segments = [cache['segment_' + str(i)] for i in range(int(cache['num_segments']))]
+                return segments, int(cache['crossing_id'])
+
+    sheets = pd.read_excel(file_name, sheet_name=None)
+    segments = [df_data.values.astype(float) for df_data in sheets.values()]
+    save_nds_segments(file_name, segments)
+    return segments, find_crossing_id(segments)
+
+
+def draw_nds_frame(ax1, case_id, t):
+    """
+    positions and next 10 frames of the left-turn and go-straight vehicles of a case at frame t
+    """
     # abstract interaction info. of a given case
-    case_info = inter_info[case_id]
+    case_info = nds_data.interaction_info[case_id]
     # left-turn vehicle
     lt_info = case_info[0]
     # go-straight vehicles
-    gs_info_multi = case_info[1:inter_num[0, case_id] + 1]
+    gs_info_multi = case_info[1:nds_data.interact_agent_num[0, case_id] + 1]
 
+    t_end = t + 10
+    ax1.cla()
+    ax1.set(xlim=[-22, 53], ylim=[-31, 57])
+    img = plt.imread('background_pic/Jianhexianxia.jpg')
+    ax1.imshow(img, extent=[-22, 53, -31, 57])
+    ax1.text(-10, 60, 'T=' + str(t), fontsize=30)
+
+    # position of go-straight vehicles
+    for gs_id in range(np.size(gs_info_multi, 0)):
+        first_frame, end_frame = nds_data.valid_frames[case_id, gs_id + 1]
+        if first_frame <= t < end_frame:
+            # position
+            ax1.scatter(gs_info_multi[gs_id][t, 0], gs_info_multi[gs_id][t, 1],
+                        s=120,
+                        alpha=0.9,
+                        color='red',
+                        label='go-straight')
+            # future track
+            t_end_gs = min(t + 10, np.size(gs_info_multi[gs_id], 0))
+            ax1.plot(gs_info_multi[gs_id][t:t_end_gs, 0], gs_info_multi[gs_id][t:t_end_gs, 1],
+                     alpha=0.8,
+                     color='red')
+
+    # position of left-turn vehicle
+    ax1.scatter(lt_info[t, 0], lt_info[t, 1],
+                s=120,
+                alpha=0.9,
+                color='blue',
+                label='left-turn')
+    # future track
+    ax1.plot(lt_info[t:t_end, 0], lt_info[t:t_end, 1],
+             alpha=0.8,
+             color='blue')
+
+
+def draw_nds_figure(fig, case_id, t):
+    draw_nds_frame(fig.add_subplot(111), case_id, t)
+
+
+def render_nds(case_id, output_directory, gif=True, mp4=False, max_workers=None):
+    """
+    render the animation of visualize_nds offscreen, frames split across worker processes
+    :return: list of PNG files
+    """
+    pattern = output_directory + '/nds_case_' + str(case_id) + '_{:04d}.png'
+    frames = [(case_id, t) for t in range(np.size(nds_data.interaction_info[case_id, 0], 0))]
+    png_files = render_frames(draw_nds_figure, frames, pattern, figsize=(6.4, 4.8), max_workers=max_workers)
+    if gif:
+        make_gif(png_files, output_directory + '/nds_case_' + str(case_id) + '.gif')
+    if mp4:
+        make_mp4(pattern, output_directory + '/nds_case_' + str(case_id) + '.mp4')
+    return png_files
+
+
+def visualize_nds(case_id):
     fig = plt.figure(1)
     # manager = plt.get_current_fig_manager()
     # manager.full_screen_toggle()
@@ -52,39 +190,8 @@ def visualize_nds(case_id):
     # img = plt.imread('background_pic/Jianhexianxia.jpg')
     # ax2.imshow(img, extent=[-22, 53, -31, 57])
 
-    for t in range(np.size(lt_info, 0)):
-        t_end = t + 10
-        ax1.cla()
-        ax1.set(xlim=[-22, 53], ylim=[-31, 57])
-        img = plt.imread('background_pic/Jianhexianxia.jpg')
-        ax1.imshow(img, extent=[-22, 53, -31, 57])
-        plt.text(-10, 60, 'T=' + str(t), fontsize=30)
-
-        # position of go-straight vehicles
-        for gs_id in range(np.size(gs_info_multi, 0)):
-            if np.size(gs_info_multi[gs_id], 0) > t and not gs_info_multi[gs_id][t, 0] == 0:
-                # position
-                ax1.scatter(gs_info_multi[gs_id][t, 0], gs_info_multi[gs_id][t, 1],
-                            s=120,
-                            alpha=0.9,
-                            color='red',
-                            label='go-straight')
-                # future track
-                t_end_gs = min(t + 10, np.size(gs_info_multi[gs_id], 0))
-                ax1.plot(gs_info_multi[gs_id][t:t_end_gs, 0], gs_info_multi[gs_id][t:t_end_gs, 1],
-                         alpha=0.8,
-                         color='red')
-
-        # position of left-turn vehicle
-        ax1.scatter(lt_info[t, 0], lt_info[t, 1],
-                    s=120,
-                    alpha=0.9,
-                    color='blue',
-                    label='left-turn')
-        # future track
-        ax1.plot(lt_info[t:t_end, 0], lt_info[t:t_end, 1],
-                 alpha=0.8,
-                 color='blue')
+    for t in range(np.size(nds_data.interaction_info[case_id, 0], 0)):
+        draw_nds_frame(ax1, case_id, t)
         # ax1.legend()
         plt.pause(0.1)
 
@@ -106,56 +213,220 @@ def visualize_nds(case_id):
 
 def find_inter_od(case_id):
     """
-    find the starting and end frame of each FC agent that interacts with LT agent
+    find the starting and end frame of each FC agent that interacts with LT agent (precomputed for the dataset)
     :param case_id:
     :return:
     """
-    case_info = inter_info[case_id]
-    lt_info = case_info[0]
+    return nds_data.find_inter_od(case_id)
 
-    # find co-present gs agents (not necessarily interacting)
-    gs_info_multi = case_info[1:inter_num[0, case_id] + 1]
-
-    # find interacting gs agent
-    init_id = 0
-    inter_o = np.zeros(np.size(gs_info_multi, 0))
-    inter_d = np.zeros(np.size(gs_info_multi, 0))
-    for i in range(np.size(gs_info_multi, 0)):
-        gs_agent_temp = gs_info_multi[i]
-        solid_frame = np.nonzero(gs_agent_temp[:, 0])[0]
-        solid_range = range(solid_frame[0], solid_frame[-1])
-        inter_frame = solid_frame[0] + np.array(
-            np.where(gs_agent_temp[solid_range, 1] - lt_info[solid_range, 1] < 0)[0])
-
-        # find start and end frame with each gs agent
-        if inter_frame.size > 1:
-            if i == init_id:
-                inter_o[i] = inter_frame[0]
-            else:
-                inter_o[i] = max(inter_frame[0], inter_d[i - 1])
-            inter_d[i] = max(inter_frame[-1], inter_d[i - 1])
+
+def interaction_frames(case_id, inter_o, inter_d):
+    """
+    interacting gs agent and observation window of every frame of a case
+    :return: generator of (frame, whether an agent interacts, id of the interacting gs agent, start frame of the
+    observation window)
+    """
+    inter_id = 0
+    start_time = 0
+    for t in range(np.size(nds_data.interaction_info[case_id][0], 0)):
+
+        "find current interacting agent"
+        flag = 0
+        for i in range(len(inter_o)):
+            if inter_o[i] <= t < inter_d[i]:  # switch to next interacting agent
+                # update interaction info
+                flag = 1
+                inter_id = i
+                if print_needed:
+                    print('inter_id', inter_id)
+                start_time = max(int(inter_o[inter_id]), t - 10)
+        yield t, flag, inter_id, start_time
+
+
+def estimation_tasks(case_id):
+    """
+    frames of a case in which IPVs are estimated (see analyze_nds)
+    :return: list of (case_id, frame, id of the interacting gs agent, start frame of the observation window)
+    """
+    inter_o, inter_d = find_inter_od(case_id)
+    return [(case_id, t, inter_id, start_time)
+            for t, flag, inter_id, start_time in interaction_frames(case_id, inter_o, inter_d)
+            if flag and (t - start_time > 3)]
+
+
+def estimate_agent_in_frame(case_id, t, inter_id, start_time, role):
+    """
+    simulation-based IPV estimation of one agent over the observation window ending at frame t
+    :param role: 0 for the left-turn agent, 1 for the interacting go-straight agent
+    :return: the agent, with the estimated ipv and ipv_error
+    """
+    lt_info = nds_data.interaction_info[case_id][0]
+    gs_info = nds_data.interaction_info[case_id][inter_id + 1]
+    self_info, other_info = (lt_info, gs_info) if role == 0 else (gs_info, lt_info)
+
+    agent = Agent(self_info[start_time, 0:2], self_info[start_time, 2:4], self_info[start_time, 4],
+                  ['lt_nds', 'gs_nds'][role])
+    agent.estimate_self_ipv_in_NDS(self_info[start_time:t + 1, 0:2], other_info[start_time:t + 1, 0:2])
+    return agent
+
+
+class IncrementalIPVEstimator:
+    """
+    IPV estimation of one agent over the sliding observation windows of one interaction. consecutive windows
+    differ by one observed frame, so the virtual solutions of the last frame, shifted to the new window, seed
+    the solves of the next frame
+
+    only the solutions carry over. the NDS reference path starts at the first observed point of the window, so once
+    the window slides (t - 10 > inter_o) its origin moves every frame, and the reference path and lane distance field
+    are rebuilt for each frame (then shared by the virtual agents and solver iterations of that frame)
+    """
+
+    def __init__(self, case_id, inter_id, role):
+        self.case_id = case_id
+        self.inter_id = inter_id
+        self.role = role
+        self.start_time = None
+        self.actions = None
+
+    def warm_starts(self, t, start_time):
+        """
+        virtual solutions of the last frame, with the controls before start_time dropped and the last control
+        held to fill the window ending at t
+        """
+        if self.actions is None or start_time < self.start_time:
+            return None
+        num_control = t - start_time
+        warm_starts = []
+        for action in self.actions:
+            action = action[start_time - self.start_time:]
+            if len(action) == 0:
+                return None
+            action = np.concatenate([action, np.repeat(action[-1:], max(0, num_control - len(action)), axis=0)])
+            action = action[:num_control]
+            warm_starts.append(np.concatenate([np.clip(action[:, 0], -MAX_ACCELERATION, MAX_ACCELERATION),
+                                               np.clip(action[:, 1], -MAX_STEERING_ANGLE, MAX_STEERING_ANGLE)]))
+        return warm_starts
+
+    def estimate(self, t, start_time):
+        """
+        :return: the agent, with the estimated ipv and ipv_error
+        """
+        lt_info = nds_data.interaction_info[self.case_id][0]
+        gs_info = nds_data.interaction_info[self.case_id][self.inter_id + 1]
+        self_info, other_info = (lt_info, gs_info) if self.role == 0 else (gs_info, lt_info)
+
+        agent = Agent(self_info[start_time, 0:2], self_info[start_time, 2:4], self_info[start_time, 4],
+                      ['lt_nds', 'gs_nds'][self.role])
+        agent.estimate_self_ipv_in_NDS(self_info[start_time:t + 1, 0:2], other_info[start_time:t + 1, 0:2],
+                                       self.warm_starts(t, start_time))
+        self.start_time = start_time
+        self.actions = agent.virtual_action_collection
+        return agent
+
+
+def frame_estimator(case_id, incremental=True, compare_with_scratch=False):
+    """
+    estimation of one agent in one frame of a case, as estimate_agent_in_frame. if incremental, each agent of an
+    interaction is warm started from its last frame (see IncrementalIPVEstimator), so the frames of an interaction
+    must be estimated in order
+    :param compare_with_scratch: validation mode, also estimate every frame from scratch and record the solver work
+    and the largest difference of the estimated IPVs
+    :return: function (t, inter_id, start_time, role) -> agent, dict of the solver iterations (updated by it)
+    """
+    estimators = {}
+    work = {'iterations': 0}
+    if compare_with_scratch:
+        work.update({'scratch_iterations': 0, 'max_ipv_difference': 0.})
+
+    def estimate(t, inter_id, start_time, role):
+        if incremental:
+            if (inter_id, role) not in estimators:
+                estimators[(inter_id, role)] = IncrementalIPVEstimator(case_id, inter_id, role)
+            agent = estimators[(inter_id, role)].estimate(t, start_time)
         else:
-            init_id += 1
-    return inter_o, inter_d
+            agent = estimate_agent_in_frame(case_id, t, inter_id, start_time, role)
+        work['iterations'] += int(np.sum(agent.solver_nit_collection))
+
+        if compare_with_scratch:
+            agent_scratch = estimate_agent_in_frame(case_id, t, inter_id, start_time, role)
+            work['scratch_iterations'] += int(np.sum(agent_scratch.solver_nit_collection))
+            work['max_ipv_difference'] = max(work['max_ipv_difference'], float(abs(agent.ipv - agent_scratch.ipv)))
+        return agent
 
+    return estimate, work
 
-def analyze_nds(case_id):
+
+def report_solver_work(case_id, work):
+    """
+    print the solver iterations of the IPV estimation of a case (and the comparison with the estimation from
+    scratch, if made)
+    """
+    message = 'case ' + str(case_id) + ': ' + str(work['iterations']) + ' solver iterations'
+    if work.get('scratch_iterations'):
+        work['saved'] = 1 - work['iterations'] / work['scratch_iterations']
+        message += (', ' + str(work['scratch_iterations']) + f' from scratch ({work["saved"]:.0%} saved), '
+                    + f'largest IPV difference {work["max_ipv_difference"]:.3f}')
+    print(message)
+
+
+def estimate_ipv_incrementally(case_id, compare_with_scratch=False):
+    """
+    estimate IPV in all frames of a case, warm starting each frame from the last one (see IncrementalIPVEstimator)
+    :param compare_with_scratch: also estimate every frame from scratch and report the solver work saved and the
+    largest difference of the estimated IPVs
+    :return: (ipv_collection, ipv_error_collection) for analyze_nds, dict of solver iterations
+    """
+    lt_info = nds_data.interaction_info[case_id][0]
+    ipv_collection = np.zeros_like(lt_info[:, 0:2])
+    ipv_error_collection = np.ones_like(lt_info[:, 0:2])
+    estimate, work = frame_estimator(case_id, compare_with_scratch=compare_with_scratch)
+    for _, t, inter_id, start_time in estimation_tasks(case_id):
+        for role in [0, 1]:
+            agent = estimate(t, inter_id, start_time, role)
+            ipv_collection[t, role] = agent.ipv
+            ipv_error_collection[t, role] = agent.ipv_error
+    report_solver_work(case_id, work)
+    return (ipv_collection, ipv_error_collection), work
+
+
+def estimate_interaction(case_id, inter_id, role):
+    """
+    incremental IPV estimation of one agent in all frames of one interaction (a task of analyze_nds_parallel)
+    :return: list of (frame, ipv, ipv_error), solver iterations
+    """
+    estimate, work = frame_estimator(case_id, incremental_estimation)
+    results = []
+    for _, t, task_inter_id, start_time in estimation_tasks(case_id):
+        if task_inter_id == inter_id:
+            agent = estimate(t, inter_id, start_time, role)
+            results.append((t, agent.ipv, agent.ipv_error))
+    return results, work['iterations']
+
+
+def analyze_nds(case_id, estimates=None, compare_with_scratch=False):
     """
     estimate IPV in natural driving data and write results into excels
     :param case_id:
-    :return:
+    :param estimates: precomputed (ipv_collection, ipv_error_collection) of the case (see analyze_nds_parallel),
+    the IPVs are estimated frame by frame if None (warm started from the last frame, see incremental_estimation)
+    :param compare_with_scratch: validation mode, also estimate every frame from scratch (see frame_estimator)
+    :return: dict of the solver iterations of the estimation (None if the estimates are given)
     """
     inter_o, inter_d = find_inter_od(case_id)
-    case_info = inter_info[case_id]
+    case_info = nds_data.interaction_info[case_id]
     lt_info = case_info[0]
 
     # find co-present gs agents (not necessarily interacting)
-    gs_info_multi = case_info[1:inter_num[0, case_id] + 1]
+    gs_info_multi = case_info[1:nds_data.interact_agent_num[0, case_id] + 1]
 
     # initialize IPV
-    start_time = 0
-    ipv_collection = np.zeros_like(lt_info[:, 0:2])
-    ipv_error_collection = np.ones_like(lt_info[:, 0:2])
+    work = None
+    if estimates is None:
+        ipv_collection = np.zeros_like(lt_info[:, 0:2])
+        ipv_error_collection = np.ones_like(lt_info[:, 0:2])
+        estimate, work = frame_estimator(case_id, incremental_estimation, compare_with_scratch)
+    else:
+        ipv_collection, ipv_error_collection = estimates
 
     # set figure
     if illustration_needed:
@@ -163,22 +434,11 @@ def analyze_nds(case_id):
         ax1 = fig.add_subplot(121)
         ax2 = fig.add_subplot(122)
 
-    inter_id = 0
-    inter_id_save = inter_id
-    file_name = data_path + 'NDS_analysis/v' + str(current_nds_data_version) + '/' + str(case_id) + '.xlsx'
+    inter_id_save = 0
+    file_name = nds_case_file(case_id)
+    segments = []  # sheets of the excel, also saved in binary
 
-    for t in range(np.size(lt_info, 0)):
-
-        "find current interacting agent"
-        flag = 0
-        for i in range(np.size(gs_info_multi, 0)):
-            if inter_o[i] <= t < inter_d[i]:  # switch to next interacting agent
-                # update interaction info
-                flag = 1
-                inter_id = i
-                if print_needed:
-                    print('inter_id', inter_id)
-                start_time = max(int(inter_o[inter_id]), t - 10)
+    for t, flag, inter_id, start_time in interaction_frames(case_id, inter_o, inter_d):
 
         # save data of last one
         if save_data_needed:
@@ -228,32 +488,21 @@ def analyze_nds(case_id):
                         df_ipv_gs.to_excel(writer, startcol=7, index=False, sheet_name=str(inter_id_save))
                         df_ipv_gs_error.to_excel(writer, startcol=8, index=False, sheet_name=str(inter_id_save))
                         df_motion_gs.to_excel(writer, startcol=9, index=False, sheet_name=str(inter_id_save))
+                segments.append(pd.concat([df_ipv_lt, df_ipv_lt_error, df_motion_lt,
+                                           df_ipv_gs, df_ipv_gs_error, df_motion_gs], axis=1).values)
 
                 inter_id_save = inter_id
 
         "IPV estimation process"
-        if flag and (t - start_time > 3):
+        if flag and (t - start_time > 3) and estimates is None:
 
             "====simulation-based method===="
-            # generate two agents
-            init_position_lt = lt_info[start_time, 0:2]
-            init_velocity_lt = lt_info[start_time, 2:4]
-            init_heading_lt = lt_info[start_time, 4]
-            agent_lt = Agent(init_position_lt, init_velocity_lt, init_heading_lt, 'lt_nds')
-            lt_track = lt_info[start_time:t + 1, 0:2]
-
-            init_position_gs = gs_info_multi[inter_id][start_time, 0:2]
-            init_velocity_gs = gs_info_multi[inter_id][start_time, 2:4]
-            init_heading_gs = gs_info_multi[inter_id][start_time, 4]
-            agent_gs = Agent(init_position_gs, init_velocity_gs, init_heading_gs, 'gs_nds')
-            gs_track = gs_info_multi[inter_id][start_time:t + 1, 0:2]
-
-            # estimate ipv
-            agent_lt.estimate_self_ipv_in_NDS(lt_track, gs_track)
+            # estimate ipv of the two agents
+            agent_lt = estimate(t, inter_id, start_time, 0)
             ipv_collection[t, 0] = agent_lt.ipv
             ipv_error_collection[t, 0] = agent_lt.ipv_error
 
-            agent_gs.estimate_self_ipv_in_NDS(gs_track, lt_track)
+            agent_gs = estimate(t, inter_id, start_time, 1)
             ipv_collection[t, 1] = agent_gs.ipv
             ipv_error_collection[t, 1] = agent_gs.ipv_error
 
@@ -347,31 +596,76 @@ def analyze_nds(case_id):
             if print_needed:
                 print('no results, more observation needed')
 
+    if save_data_needed and segments:
+        save_nds_segments(file_name, segments)
+
+    if work is not None:
+        report_solver_work(case_id, work)
+    return work
+
+
+def analyze_nds_parallel(case_ids, max_workers=None):
+    """
+    estimate IPV in many cases on a process pool and write the results of each case as analyze_nds does.
+    the estimation of each (case, interaction, agent) is one task, whose frames are estimated in order so that each
+    is warm started from the last one (see estimate_interaction). tasks are submitted most frames first and idle
+    workers pull the next waiting task, so the load stays balanced across cases of very different length
+    :param case_ids:
+    :param max_workers: number of worker processes (default: number of CPUs)
+    :return:
+    """
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    estimates = {}
+    work = {}
+    num_task_left = {}
+    tasks = []
+    num_frames = {}
+    for case_id in case_ids:
+        lt_info = nds_data.interaction_info[case_id][0]
+        estimates[case_id] = (np.zeros_like(lt_info[:, 0:2]), np.ones_like(lt_info[:, 0:2]))
+        work[case_id] = {'iterations': 0}
+        case_tasks = estimation_tasks(case_id)
+        inter_ids = sorted(set(task[2] for task in case_tasks))
+        num_task_left[case_id] = 2 * len(inter_ids)
+        for inter_id in inter_ids:
+            for role in [0, 1]:
+                tasks.append((case_id, inter_id, role))
+                num_frames[tasks[-1]] = sum(task[1] - task[3] for task in case_tasks if task[2] == inter_id)
+        if not case_tasks:
+            analyze_nds(case_id, estimates[case_id])
+
+    # the cost of a task grows with the number and length of its observation windows
+    tasks.sort(key=lambda task: num_frames[task], reverse=True)
+    print('==== ' + str(len(tasks)) + ' estimation tasks in ' + str(len(case_ids)) + ' cases ====')
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(estimate_interaction, *task): task for task in tasks}
+        for future in as_completed(futures):
+            case_id, _, role = futures[future]
+            ipv_collection, ipv_error_collection = estimates[case_id]
+            results, iterations = future.result()
+            for t, ipv, ipv_error in results:
+                ipv_collection[t, role], ipv_error_collection[t, role] = ipv, ipv_error
+            work[case_id]['iterations'] += iterations
+
+            # write the results of a case as soon as all of its interactions are estimated
+            num_task_left[case_id] -= 1
+            if num_task_left[case_id] == 0:
+                analyze_nds(case_id, estimates[case_id])
+                report_solver_work(case_id, work[case_id])
+                print('case ' + str(case_id) + ' saved')
+
 
 def analyze_ipv_in_nds(case_id, fig=False):
-    file_name = data_path + 'NDS_analysis/ipv_estimation/v' + str(current_nds_data_version) \
-                + '/' + str(case_id) + '.xlsx'
-    file = pd.ExcelFile(file_name)
-    num_sheet = len(file.sheet_names)
-    # print(num_sheet)
+    segments, crossing_id = load_nds_segments(nds_case_file(case_id))
     start_x = 0
-    crossing_id = -1
 
-    for i in range(num_sheet):
-        "get ipv data from excel"
-        df_ipv_data = pd.read_excel(file_name, sheet_name=i)
-        ipv_data_temp = df_ipv_data.values
+    for ipv_data_temp in segments:
+        "get ipv data"
         ipv_value_lt, ipv_value_gs = ipv_data_temp[:, 0], ipv_data_temp[:, 7]
         ipv_error_lt, ipv_error_gs = ipv_data_temp[:, 1], ipv_data_temp[:, 8]
 
-        # find cross event
-        x_lt = ipv_data_temp[:, 2]
-        x_gs = ipv_data_temp[:, 9]
-        delta_x = x_lt - x_gs  # x position of LT is larger than that of interacting FC
-        if len(delta_x) > 0:
-            if np.max(delta_x) > 0 and crossing_id == -1:
-                crossing_id = i
-
         "draw ipv value and error bar"
 
         if fig:
@@ -425,13 +719,11 @@ def analyze_ipv_in_nds(case_id, fig=False):
     case_data_crossing = []
     case_data_non_crossing = []
     if not crossing_id == -1:
-        df_data = pd.read_excel(file_name, sheet_name=crossing_id)
-        case_data_crossing = df_data.values[:, :]
+        case_data_crossing = segments[crossing_id]
 
-    for sheet_id in range(num_sheet):
+    for sheet_id in range(len(segments)):
         if not sheet_id == crossing_id:
-            df_data = pd.read_excel(file_name, sheet_name=sheet_id)
-            case_data_non_crossing.append(df_data.values[:, :])
+            case_data_non_crossing.append(segments[sheet_id])
 
     return crossing_id, case_data_crossing, case_data_non_crossing
 
@@ -441,7 +733,7 @@ def show_ipv_distribution():
     ipv_cross_gs = []
     ipv_non_cross_lt = []
     ipv_non_cross_gs = []
-    for i in range(np.size(inter_info, 0)):
+    for i in range(np.size(nds_data.interaction_info, 0)):
 
         _, ipv_cross_temp, ipv_non_cross_temp = analyze_ipv_in_nds(i, False)
         if len(ipv_cross_temp) > 0:
@@ -516,59 +808,41 @@ def show_ipv_distribution():
     plt.show()
 
 
-def cal_pet(trj_a, trj_b, type_cal):
+def cal_conflict(trj_a, trj_b):
     """
-    calculate the PET of two given trajectory
-    :param trj_a:
-    :param trj_b:
-    :param type_cal: PET or APET
-    :return:
+    conflict point, PET and anticipated PET of two given trajectories, in one pass
+    :param trj_a: N by 2 positions
+    :param trj_b: M by 2 positions
+    :return: PET, APET, time to the conflict point of a and of b at each frame, conflict point
     """
 
     "find the conflict point"
-    conflict_point_str = get_intersection_point(trj_a, trj_b)
-    conflict_point = np.array(conflict_point_str)
-    if conflict_point_str.is_empty:  # there is no intersection between given polylines
-        min_dis = 99
-        min_dis2cv_index_a = None
-        min_dis2cv_index_b = 0
-        for i in range(np.size(trj_b, 0)):
-            point_b = trj_b[i, :]
-            dis2cv_lt_temp = np.linalg.norm(trj_a - point_b, axis=1)
-            min_dis2cv_temp = np.amin(dis2cv_lt_temp)
-            min_dis2cv_index_temp = np.where(min_dis2cv_temp == dis2cv_lt_temp)
-            if min_dis2cv_temp < min_dis:
-                min_dis = min_dis2cv_temp
-                min_dis2cv_index_a = min_dis2cv_index_temp[0]
-                min_dis2cv_index_b = i
-        conflict_point = (trj_a[min_dis2cv_index_a[0], :] + trj_b[min_dis2cv_index_b, :]) / 2
-
-    "find the point that most closed to cp in each trajectory"
-    smoothed_trj_a, smoothed_progress_a = smooth_ployline(trj_a, point_num=100)
-    cp2trj_a = np.linalg.norm(smoothed_trj_a - conflict_point, axis=1)
-    min_dcp2trj_a = np.amin(cp2trj_a)
-    cp_index_a = np.where(min_dcp2trj_a == cp2trj_a)
-
-    smoothed_trj_b, smoothed_progress_b = smooth_ployline(trj_b, point_num=100)
-    cp2trj_b = np.linalg.norm(smoothed_trj_b - conflict_point, axis=1)
-    min_dcp2trj_b = np.amin(cp2trj_b)
-    cp_index_b = np.where(min_dcp2trj_b == cp2trj_b)
+    crossing_points, _, _ = segment_intersections(trj_a, trj_b)
+    if len(crossing_points):
+        conflict_point = crossing_points[0, :]
+    else:  # there is no intersection between given polylines: the midpoint of their nearest positions
+        dis = np.linalg.norm(trj_b[:, np.newaxis, :] - trj_a[np.newaxis, :, :], axis=2)
+        index_b, index_a = np.unravel_index(np.argmin(dis), np.shape(dis))
+        conflict_point = (trj_a[index_a, :] + trj_b[index_b, :]) / 2
+
+    "progress of the conflict point along each trajectory"
+    cp_progress_a, _ = project_to_polyline(trj_a, conflict_point)
+    cp_progress_b, _ = project_to_polyline(trj_b, conflict_point)
 
     "calculate time to cp"
     seg_len_a = np.linalg.norm(trj_a[1:, :] - trj_a[:-1, :], axis=1)
     seg_len_b = np.linalg.norm(trj_b[1:, :] - trj_b[:-1, :], axis=1)
     vel_a = seg_len_a / 0.12
     vel_b = seg_len_b / 0.12
-    seg_len_a = np.concatenate([np.array([0]), seg_len_a])
-    seg_len_b = np.concatenate([np.array([0]), seg_len_b])
-    longi_progress_a = np.cumsum(seg_len_a)
-    longi_progress_b = np.cumsum(seg_len_b)
+    longi_progress_a = np.concatenate([np.array([0]), np.cumsum(seg_len_a)])
+    longi_progress_b = np.concatenate([np.array([0]), np.cumsum(seg_len_b)])
 
-    dis2conf_a = -(longi_progress_a - smoothed_progress_a[cp_index_a])
-    dis2conf_b = -(longi_progress_b - smoothed_progress_b[cp_index_b])
+    dis2conf_a = -(longi_progress_a - cp_progress_a)
+    dis2conf_b = -(longi_progress_b - cp_progress_b)
 
-    ttcp_a = dis2conf_a[:-1] / vel_a
-    ttcp_b = dis2conf_b[:-1] / vel_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ttcp_a = dis2conf_a[:-1] / vel_a
+        ttcp_b = dis2conf_b[:-1] / vel_b
 
     solid_len = min(np.size(ttcp_a[ttcp_a > 0], 0), np.size(ttcp_b[ttcp_b > 0], 0))
 
@@ -577,6 +851,18 @@ def cal_pet(trj_a, trj_b, type_cal):
 
     pet = max(ttcp_a[solid_len - 1], ttcp_b[solid_len - 1]) - min(ttcp_a[solid_len - 1], ttcp_b[solid_len - 1])
 
+    return pet, apet, ttcp_a, ttcp_b, conflict_point
+
+
+def cal_pet(trj_a, trj_b, type_cal):
+    """
+    calculate the PET of two given trajectory
+    :param trj_a:
+    :param trj_b:
+    :param type_cal: PET or APET
+    :return:
+    """
+    pet, apet, ttcp_a, ttcp_b, conflict_point = cal_conflict(trj_a, trj_b)
     if type_cal == 'pet':
 
         return pet, conflict_point
@@ -586,6 +872,31 @@ def cal_pet(trj_a, trj_b, type_cal):
         return apet, ttcp_a, ttcp_b
 
 
+def cal_conflict_in_nds(case_ids=None):
+    """
+    cal_conflict of the left-turn vehicle and every interacting go-straight vehicle in the dataset, both from the
+    start of their interaction. cal_conflict is vectorized over the segments of one pair, and the pairs are looped
+    over here: the tracks of the pairs of a case start at different frames, so padding them into one array makes
+    every pair as long as the longest one (slower and larger than the loop, which takes well under a second for the
+    whole dataset)
+    :param case_ids: cases to evaluate (default: all)
+    :return: dict from (case id, id of the go-straight vehicle) to the results of cal_conflict
+    """
+    if case_ids is None:
+        case_ids = range(nds_data.case_number)
+    conflicts = {}
+    for case_id in case_ids:
+        inter_o, inter_d = find_inter_od(case_id)
+        for gs_id in range(len(inter_o)):
+            if inter_d[gs_id] <= inter_o[gs_id]:  # not interacting
+                continue
+            start_frame = int(inter_o[gs_id])
+            lt_trj = nds_data.interaction_info[case_id, 0][start_frame:, 0:2]
+            gs_trj = nds_data.interaction_info[case_id, gs_id + 1][start_frame:, 0:2]
+            conflicts[(case_id, gs_id)] = cal_conflict(lt_trj, gs_trj)
+    return conflicts
+
+
 def divide_pet_in_nds(save_collection_analysis=False,
                       save_divided_trj=False,
                       show_fig=False):
@@ -622,7 +933,7 @@ def divide_pet_in_nds(save_collection_analysis=False,
         #  关闭工作簿。在文件夹中打开文件，查看写入的结果。
         workbook.close()  # 一定要关闭workbook后才会产生文件！
 
-    for case_index in range(case_number):
+    for case_index in range(nds_data.case_number):
 
         cross_id, data_cross, data_non_cross = analyze_ipv_in_nds(case_index)
         # save data into an excel with the format of:
@@ -635,13 +946,12 @@ def divide_pet_in_nds(save_collection_analysis=False,
         if not cross_id == -1:  # and case_index not in {114, 129}:
 
             # go-straight vehicles
-            gs_info_multi = inter_info[case_index][1:inter_num[0, case_index] + 1]
+            gs_info_multi = nds_data.interaction_info[case_index][1:nds_data.interact_agent_num[0, case_index] + 1]
             gs_trj = gs_info_multi[cross_id][start_frame:, 0:2]
             # left-turn vehicle
-            lt_trj = inter_info[case_index][0][start_frame:, 0:2]
+            lt_trj = nds_data.interaction_info[case_index][0][start_frame:, 0:2]
 
-            pet_temp, _ = cal_pet(lt_trj, gs_trj, 'pet')
-            apet, ttcp_lt, ttcp_gs = cal_pet(lt_trj, gs_trj, 'apet')
+            pet_temp, apet, ttcp_lt, ttcp_gs, _ = cal_conflict(lt_trj, gs_trj)
 
             data_cross = data_cross[4:, :]
             lt_ipv = np.mean(data_cross[:, 0])
@@ -664,11 +974,12 @@ def divide_pet_in_nds(save_collection_analysis=False,
             if lt_ipv < 0:
                 comp_lt_collection.append([case_index, lt_ipv, gs_ipv, pet_temp, vel_ave,
                                            acc_mean_gs, acc_min_gs, ttcp_lt[0], ttcp_gs[0]])
-                ax1.plot(inter_info[case_index][0][:, 0], inter_info[case_index][0][:, 1], color="red", alpha=0.5)
+                ax1.plot(nds_data.interaction_info[case_index][0][:, 0], nds_data.interaction_info[case_index][0][:, 1],
+                         color="red", alpha=0.5)
                 # alpha=-np.mean(ipv_data_cross[:, 0] * (1 - ipv_data_cross[:, 1])) / 1.57
 
                 if save_divided_trj:
-                    lt_trj_comp = pd.DataFrame(inter_info[case_index][0][:, 0:2],
+                    lt_trj_comp = pd.DataFrame(nds_data.interaction_info[case_index][0][:, 0:2],
                                                columns=['case-' + str(case_index) + '-x', 'y'])
                     with pd.ExcelWriter(filename_divided_trj,
                                         mode='a',
@@ -680,10 +991,11 @@ def divide_pet_in_nds(save_collection_analysis=False,
             else:
                 coop_lt_collection.append([case_index, lt_ipv, gs_ipv, pet_temp, vel_ave,
                                            acc_mean_gs, acc_min_gs, ttcp_lt[0], ttcp_gs[0]])
-                ax1.plot(inter_info[case_index][0][:, 0], inter_info[case_index][0][:, 1], color="green", alpha=0.5)
+                ax1.plot(nds_data.interaction_info[case_index][0][:, 0], nds_data.interaction_info[case_index][0][:, 1],
+                         color="green", alpha=0.5)
 
                 if save_divided_trj:
-                    lt_trj_coop = pd.DataFrame(inter_info[case_index][0][:, 0:2],
+                    lt_trj_coop = pd.DataFrame(nds_data.interaction_info[case_index][0][:, 0:2],
                                                columns=['case-' + str(case_index) + '-x', 'y'])
                     with pd.ExcelWriter(filename_divided_trj,
                                         mode='a',
@@ -694,8 +1006,7 @@ def divide_pet_in_nds(save_collection_analysis=False,
                 num_coop_lt_trj += 1
 
             # delete invalid (0,0) positions
-            gs_trj_temp = gs_info_multi[cross_id][:, 0:2]
-            invalid_len = len((np.where(gs_trj_temp[:, 0] == 0))[0])
+            invalid_len = nds_data.valid_frames[case_index, cross_id + 1, 0]
 
             if gs_ipv < 0:
                 comp_gs_collection.append([case_index, lt_ipv, gs_ipv, pet_temp, vel_ave, vel_mean_gs, vel_gs_max])
@@ -712,11 +1023,11 @@ def divide_pet_in_nds(save_collection_analysis=False,
             if not non_cross_id == cross_id:
                 start_frame = int(o[non_cross_id])
                 # go-straight vehicles
-                gs_info_multi = inter_info[case_index][1:inter_num[0, case_index] + 1]
+                gs_info_multi = nds_data.interaction_info[case_index][1:nds_data.interact_agent_num[0, case_index] + 1]
                 gs_trj = gs_info_multi[non_cross_id][start_frame:, 0:2]
 
                 # left-turn vehicle
-                lt_trj = inter_info[case_index][0][start_frame:, 0:2]
+                lt_trj = nds_data.interaction_info[case_index][0][start_frame:, 0:2]
 
                 # pet_temp, _ = cal_pet(lt_trj, gs_trj, 'pet')
                 if np.size(gs_trj, 0)>8:
@@ -847,13 +1158,13 @@ def show_crossing_event(case_index, isfig=True, issavedata=False):
     if not cross_id == -1:
 
         # go-straight vehicles
-        gs_info_multi = inter_info[case_index][1:inter_num[0, case_index] + 1]
+        gs_info_multi = nds_data.interaction_info[case_index][1:nds_data.interact_agent_num[0, case_index] + 1]
         gs_trj = gs_info_multi[cross_id][start_frame:, 0:2]
         # left-turn vehicle
-        lt_trj = inter_info[case_index][0][start_frame:, 0:2]
+        lt_trj = nds_data.interaction_info[case_index][0][start_frame:, 0:2]
 
         # calculate PET of the whole event
-        pet, conflict_point = cal_pet(lt_trj, gs_trj, "pet")
+        pet, apet, ttc_lt, ttc_gs, conflict_point = cal_conflict(lt_trj, gs_trj)
         if isfig:
             fig = plt.figure(1)
             ax1 = fig.add_subplot(111)
@@ -885,8 +1196,7 @@ def show_crossing_event(case_index, isfig=True, issavedata=False):
             # plt.savefig('./outputs/NDS_analysis/crossing_event_v' + str(current_nds_data_version)
             #             + '/' + str(case_index) + '.png')
 
-        # calculate anticipated PET of the process
-        apet, ttc_lt, ttc_gs = cal_pet(lt_trj, gs_trj, "apet")
+        # anticipated PET of the process
         x_range = range(start_frame, start_frame + len(apet))
 
         if issavedata:
@@ -918,9 +1228,12 @@ if __name__ == '__main__':
     # for case_index in range(99, 100):
     #     analyze_nds(case_index)
     # analyze_nds(30)
+    # analyze_nds_parallel(range(nds_data.case_number))
+    # analyze_nds(30, compare_with_scratch=True)  # validate the incremental estimation against the scratch one
 
     "show trajectories in NDS"
     # visualize_nds(129)
+    # render_nds(129, './outputs/NDS_frames')
 
     "find crossing event and the ipv of yield front-coming vehicle (if there is)"
     # cross_id, ipv_data_cross, ipv_data_non_cross = analyze_ipv_in_nds(30, True)
@@ -1,10 +1,15 @@
 """create agents for simulation"""
 import numpy as np
 import math
-from scipy.optimize import minimize
 from matplotlib import pyplot as plt
-from tools.utility import get_central_vertices, kinematic_model
+from tools.utility import get_central_vertices, kinematic_model, kinematic_model_vjp, kinematic_model_batch
+from tools.utility import get_lane_distance_field, distance_to_central_vertices, reference_path_cache
+from tools.utility import GrowingArray
+from tools.instrumentation import Instrumentation, NULL_INSTRUMENTATION
+from tools import jit_kernels
+from solvers import TrajectoryProblem, solve_trajectory
 import copy
+from concurrent.futures import ProcessPoolExecutor
 from tools.utility import get_intersection_point
 
 '''##========Check Target=======##'''
@@ -51,12 +56,148 @@ elif TARGET == 'simulation':
 elif TARGET == 'nds simulation':
     WEIGHT_GRP = 0.4
 
+# look up lane deviation in a precomputed distance field (False: brute-force search over central vertices)
+USE_LANE_DISTANCE_FIELD = True
+
+# pass the analytic gradient of the objective to the solver (False: finite differences by SciPy)
+USE_ANALYTIC_GRADIENT = True
+
+# default solver of solve_game_IBR, see solvers.SOLVER_BACKENDS (agents with a solver_backend override it)
+SOLVER_BACKEND = 'SLSQP'
+
+# process pool playing the parallel virtual-agent games (None: serial), see set_virtual_game_workers
+_virtual_game_executor = None
+_virtual_game_workers = 0
+# module settings the pool workers were started with
+_virtual_game_settings = None
+
+# module settings read while playing a game, copied into the pool workers (see virtual_game_settings)
+VIRTUAL_GAME_SETTINGS = ['TARGET', 'dt', 'weight_metric', 'MAX_STEERING_ANGLE', 'MAX_ACCELERATION', 'MAX_SPEED',
+                         'WEIGHT_INT', 'WEIGHT_GRP', 'USE_LANE_DISTANCE_FIELD', 'USE_ANALYTIC_GRADIENT',
+                         'SOLVER_BACKEND']
+
 # likelihood function
 sigma = 0.02
 sigma2 = 0.4
 
 
-class Agent:
+class Planner:
+    """
+    best-response planning shared by Agent and its compact PlanningState
+    """
+    __slots__ = ()
+
+    def solve_game_IBR(self, inter_track, u0=None):
+        track_len = np.size(inter_track, 0)
+        self_info = [self.position,
+                     self.velocity,
+                     self.heading,
+                     self.ipv,
+                     self.target]
+
+        p, v, h = self_info[0:3]
+        init_state_4_kine = [p[0], p[1], v[0], v[1], h]  # initial state
+        if u0 is None:
+            u0 = self.initial_guess(track_len)  # initialize solution
+        upper = np.concatenate([np.full(track_len - 1, MAX_ACCELERATION),
+                                np.full(track_len - 1, MAX_STEERING_ANGLE)])  # boundaries
+        problem = TrajectoryProblem(init_state_4_kine, inter_track, self.ipv, self.target, -upper, upper,
+                                    utility_IBR(self_info, inter_track),  # objective function
+                                    utility_grad_IBR(self_info, inter_track) if USE_ANALYTIC_GRADIENT else None,
+                                    position_grad=utility_position_grad_IBR(self_info, inter_track),
+                                    fun_batch=utility_batch_IBR(self_info, inter_track), dt=dt)
+
+        backend = self.solver_backend or SOLVER_BACKEND
+        with self.instrumentation.timer('solver/' + backend):
+            res = solve_trajectory(problem, u0.flatten(), backend)
+        self.solver_nit_collection.append(res.nit)
+        if self.instrumentation.enabled:
+            self.instrumentation.count('solver/' + backend + '/solves')
+            self.instrumentation.count('solver/' + backend + '/iterations', res.nit)
+            self.instrumentation.count('solver/' + backend + '/function_evaluations', res.nfev)
+            self.instrumentation.count('solver/' + backend + '/not_converged', int(not res.success))
+        x = np.reshape(res.x, [2, track_len - 1]).T
+        self.action = x
+        self.trj_solution = kinematic_model(x, init_state_4_kine, track_len, dt)
+        return self.trj_solution
+
+    def initial_guess(self, track_len):
+        """
+        initial solution of solve_game_IBR, flattened as [accelerations, steering angles]
+        :param track_len:
+        :return:
+        """
+        if not self.warm_start or not np.size(self.action, 0) == track_len - 1:
+            return np.zeros(2 * (track_len - 1))
+
+        action = self.action
+        if not np.allclose(self.position, self.trj_solution[0, 0:2]):
+            # the agent has moved on since the last plan: drop the conducted step and hold the last control
+            action = np.concatenate([action[1:], action[-1:]])
+        u0 = np.concatenate([np.clip(action[:, 0], -MAX_ACCELERATION, MAX_ACCELERATION),
+                             np.clip(action[:, 1], -MAX_STEERING_ANGLE, MAX_STEERING_ANGLE)])
+        return u0
+
+    def planning_state(self, ipv=None):
+        """
+        :param ipv: IPV of the planning state, defaults to the IPV of this planner
+        :return: PlanningState carrying only what solve_game_IBR needs
+        """
+        return PlanningState(self, ipv)
+
+
+class PlanningState(Planner):
+    """
+    state, IPV, target and current plan of an agent, used by the game loops instead of deep copies of
+    the whole agent (and its ever-growing history). arrays are shared, as solving replaces them instead
+    of modifying them in place
+    """
+    __slots__ = ('position', 'velocity', 'heading', 'ipv', 'target',
+                 'trj_solution', 'action', 'warm_start', 'solver_nit_collection',
+                 'instrumentation', 'solver_backend')
+
+    def __init__(self, planner, ipv=None):
+        self.position = planner.position
+        self.velocity = planner.velocity
+        self.heading = planner.heading
+        self.ipv = planner.ipv if ipv is None else ipv
+        self.target = planner.target
+        self.trj_solution = planner.trj_solution
+        self.action = planner.action
+        self.warm_start = planner.warm_start
+        self.solver_nit_collection = []
+        self.instrumentation = planner.instrumentation
+        # resolved here, so that a state played in a pool worker uses the solver of the process that created it
+        self.solver_backend = planner.solver_backend or SOLVER_BACKEND
+
+
+class HistoryBuffer:
+    """
+    agent history backed by a GrowingArray stored under the underscored name. reading the attribute
+    gives an array view of the history, assigning (a sequence of items) replaces it
+    """
+
+    def __set_name__(self, owner, name):
+        self.storage_name = '_' + name
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return getattr(instance, self.storage_name).view
+
+    def __set__(self, instance, items):
+        setattr(instance, self.storage_name, GrowingArray.from_items(items))
+
+
+class Agent(Planner):
+    # histories: observed [x, y, vx, vy, heading] per step, plans, actions, IPV estimates and virtual tracks
+    observed_trajectory = HistoryBuffer()
+    trj_solution_collection = HistoryBuffer()
+    action_collection = HistoryBuffer()
+    ipv_collection = HistoryBuffer()
+    ipv_error_collection = HistoryBuffer()
+    virtual_track_collection = HistoryBuffer()
+
     def __init__(self, position, velocity, heading, target):
         self.position = position
         self.velocity = velocity
@@ -78,54 +219,46 @@ class Agent:
         self.ipv_collection = []
         self.ipv_error_collection = []
         self.virtual_track_collection = []
-
-    def solve_game_IBR(self, inter_track):
-        track_len = np.size(inter_track, 0)
-        self_info = [self.position,
-                     self.velocity,
-                     self.heading,
-                     self.ipv,
-                     self.target]
-
-        p, v, h = self_info[0:3]
-        init_state_4_kine = [p[0], p[1], v[0], v[1], h]  # initial state
-        fun = utility_IBR(self_info, inter_track)  # objective function
-        u0 = np.concatenate([1 * np.zeros([(track_len - 1), 1]),
-                             np.zeros([(track_len - 1), 1])])  # initialize solution
-        bds = [(-MAX_ACCELERATION, MAX_ACCELERATION) for i in range(track_len - 1)] + \
-              [(-MAX_STEERING_ANGLE, MAX_STEERING_ANGLE) for i in range(track_len - 1)]  # boundaries
-
-        res = minimize(fun, u0, bounds=bds, method='SLSQP')
-        x = np.reshape(res.x, [2, track_len - 1]).T
-        self.action = x
-        self.trj_solution = kinematic_model(x, init_state_4_kine, track_len, dt)
-        return self.trj_solution
+        # solutions of the virtual agents in the last IPV estimation in NDS
+        self.virtual_action_collection = []
+        # seed the solver with the previous plan instead of zeros
+        self.warm_start = False
+        # number of solver iterations of each solve made by (or on behalf of) this agent
+        self.solver_nit_collection = []
+        # timers and counters, see tools/instrumentation.py
+        self.instrumentation = NULL_INSTRUMENTATION
+        # name of the solver backend of solve_game_IBR, None: SOLVER_BACKEND
+        self.solver_backend = None
 
     def interact_with_parallel_virtual_agents(self, agent_inter, iter_limit=10):
         """
-        generate copy of the interacting agent and interact with them
+        generate copy of the interacting agent and interact with them.
+        the games are played on the virtual game pool if one is started (see set_virtual_game_workers)
         :param iter_limit:
         :param agent_inter: Agent:interacting agent
         :return:
         """
-        virtual_agent_track_collection = []
-
-        for ipv_temp in virtual_agent_IPV_range:
-            virtual_inter_agent = copy.deepcopy(agent_inter)
-            virtual_inter_agent.ipv = ipv_temp
-            agent_self_temp = copy.deepcopy(self)
+        self_state = self.planning_state()
+        inter_state = agent_inter.planning_state()
+        # each game collects its statistics on its own (possibly in a worker process), merged below
+        self_state.instrumentation = inter_state.instrumentation = NULL_INSTRUMENTATION
+        # the virtual agents are planned by this agent, with its solver
+        inter_state.solver_backend = self_state.solver_backend
+        instrumented = self.instrumentation.enabled
+        games = [(self_state, inter_state, ipv_temp, iter_limit, instrumented)
+                 for ipv_temp in virtual_agent_IPV_range]
+        if _virtual_game_executor is None:
+            results = [play_virtual_game(*game) for game in games]
+        else:
+            update_virtual_game_workers()
+            results = list(_virtual_game_executor.map(play_virtual_game, *zip(*games)))
 
-            count_iter = 0  # count number of iteration
-            last_self_track = np.zeros_like(self.trj_solution)  # initialize a track reservation
-            while np.linalg.norm(agent_self_temp.trj_solution[:, 0:2] - last_self_track[:, 0:2]) > 1e-3:
-                count_iter += 1
-                last_self_track = agent_self_temp.trj_solution
-                agent_self_temp.solve_game_IBR(virtual_inter_agent.trj_solution)
-                virtual_inter_agent.solve_game_IBR(agent_self_temp.trj_solution)
-                if count_iter > iter_limit:
-                    break
-            virtual_agent_track_collection.append(virtual_inter_agent.trj_solution)
-        self.estimated_inter_agent.virtual_track_collection.append(virtual_agent_track_collection)
+        virtual_agent_track_collection = []
+        for virtual_track, solver_nit, stats in results:
+            virtual_agent_track_collection.append(virtual_track)
+            self.solver_nit_collection.extend(solver_nit)
+            self.instrumentation.merge(stats)
+        self.estimated_inter_agent._virtual_track_collection.append(virtual_agent_track_collection)
 
     def interact_with_estimated_agents(self, iter_limit=10, controller_type='VGIM'):
         """
@@ -146,6 +279,20 @@ class Agent:
             self.estimated_inter_agent.solve_game_IBR(self.trj_solution)
             self.solve_game_IBR(self.estimated_inter_agent.trj_solution)
 
+    def __setstate__(self, state):
+        # agents pickled before the histories were buffered store them as plain arrays and lists
+        for name in ['observed_trajectory', 'trj_solution_collection', 'action_collection',
+                     'ipv_collection', 'ipv_error_collection', 'virtual_track_collection']:
+            if name in state:
+                state['_' + name] = GrowingArray.from_items(state.pop(name))
+            elif '_' + name not in state:
+                state['_' + name] = GrowingArray.from_items([])
+        # attributes added after older runs were pickled get their initial values
+        for name, value in [('virtual_action_collection', []), ('warm_start', False), ('solver_nit_collection', []),
+                            ('instrumentation', NULL_INSTRUMENTATION), ('solver_backend', None)]:
+            state.setdefault(name, value)
+        self.__dict__.update(state)
+
     def update_state(self, inter_agent, controller_type='VGIM'):
         self.position = self.trj_solution[1, 0:2]
         self.velocity = self.trj_solution[1, 2:4]
@@ -159,10 +306,10 @@ class Agent:
                                      self.velocity[0],
                                      self.velocity[1],
                                      self.heading], ])
-        self.observed_trajectory = np.concatenate((self.observed_trajectory, new_track_point), axis=0)
+        self._observed_trajectory.append(new_track_point[0])
 
-        self.trj_solution_collection.append(self.trj_solution)
-        self.action_collection.append(self.action)
+        self._trj_solution_collection.append(self.trj_solution)
+        self._action_collection.append(self.action)
 
         if controller_type in {'VGIM-coop', 'VGIM-dyna', 'VGIM'}:
             # update IPV
@@ -173,44 +320,51 @@ class Agent:
 
                 # if method == 1:
                 "====parallel game method===="
-                candidates = self.estimated_inter_agent.virtual_track_collection[start_time]
-                virtual_track_collection = []
-                for i in range(len(candidates)):
-                    virtual_track_collection.append(candidates[i][0:time_duration, 0:2])
+                candidates = np.asarray(self.estimated_inter_agent.virtual_track_collection[start_time])
+                virtual_track_collection = candidates[:, 0:time_duration, 0:2]
                 actual_track = inter_agent.observed_trajectory[start_time:current_time, 0:2]
 
-                ipv_weight = cal_reliability([], actual_track, virtual_track_collection, [])
+                with self.instrumentation.timer('ipv_likelihood'):
+                    ipv_weight = cal_reliability([], actual_track, virtual_track_collection, [])
 
                 # weighted sum of all candidates' IPVs
                 self.estimated_inter_agent.ipv = sum(virtual_agent_IPV_range * ipv_weight)
 
                 # save updated ipv and estimation error
-                self.estimated_inter_agent.ipv_collection.append(self.estimated_inter_agent.ipv)
+                self.estimated_inter_agent._ipv_collection.append(self.estimated_inter_agent.ipv)
                 error = 1 - np.sqrt(sum(ipv_weight ** 2))
-                self.estimated_inter_agent.ipv_error_collection.append(error)
+                self.estimated_inter_agent._ipv_error_collection.append(error)
                 "====end of parallel game method===="
 
             # # modify ipv for 'dyna' models
             # if controller_type in {'VGIM-dyna'} and self.estimated_inter_agent.ipv > math.pi * 3/16:
             #     self.ipv = 0
 
-    def estimate_self_ipv_in_NDS(self, self_actual_track, inter_track):
+    def estimate_self_ipv_in_NDS(self, self_actual_track, inter_track, warm_starts=None):
+        """
+        :param warm_starts: initial solution of each virtual agent (e.g. its solution in the previous frame),
+        zeros if None
+        """
         self_virtual_track_collection = []
+        self.virtual_action_collection = []
         # ipv_range = np.random.normal(self.ipv, math.pi/6, 6)
         ipv_range = virtual_agent_IPV_range
-        for ipv_temp in ipv_range:
-            agent_self_temp = copy.deepcopy(self)
-            agent_self_temp.ipv = ipv_temp
+        for i, ipv_temp in enumerate(ipv_range):
+            agent_self_temp = self.planning_state(ipv_temp)
             # generate track with varied ipv
-            virtual_track_temp = agent_self_temp.solve_game_IBR(inter_track)
+            virtual_track_temp = agent_self_temp.solve_game_IBR(inter_track,
+                                                                None if warm_starts is None else warm_starts[i])
             # save track into a collection
-            self.virtual_track_collection.append(virtual_track_temp[:, 0:2])
+            self._virtual_track_collection.append(virtual_track_temp[:, 0:2])
+            self.virtual_action_collection.append(agent_self_temp.action)
+            self.solver_nit_collection.extend(agent_self_temp.solver_nit_collection)
 
         # calculate reliability of each track
-        ipv_weight = cal_reliability(inter_track,
-                                     self_actual_track,
-                                     self.virtual_track_collection,
-                                     self.target)
+        with self.instrumentation.timer('ipv_likelihood'):
+            ipv_weight = cal_reliability(inter_track,
+                                         self_actual_track,
+                                         self.virtual_track_collection,
+                                         self.target)
 
         # weighted sum of all candidates' IPVs
         self.ipv = sum(ipv_range * ipv_weight)
@@ -237,6 +391,80 @@ class Agent:
         plt.show()
 
 
+def play_virtual_game(agent_self, agent_inter, ipv_temp, iter_limit, instrumented=False):
+    """
+    IBR game between the self agent and the interacting agent with a virtual IPV
+    :param agent_self: Agent or PlanningState
+    :param agent_inter: Agent or PlanningState
+    :param instrumented: collect the timers and counters of the game
+    :return: track of the virtual interacting agent, the solver iterations and the statistics record of the game
+    (None if not instrumented)
+    """
+    virtual_inter_agent = agent_inter.planning_state(ipv_temp)
+    agent_self_temp = agent_self.planning_state()
+    stats = Instrumentation() if instrumented else NULL_INSTRUMENTATION
+    virtual_inter_agent.instrumentation = agent_self_temp.instrumentation = stats
+
+    count_iter = 0  # count number of iteration
+    last_self_track = np.zeros_like(agent_self.trj_solution)  # initialize a track reservation
+    while np.linalg.norm(agent_self_temp.trj_solution[:, 0:2] - last_self_track[:, 0:2]) > 1e-3:
+        count_iter += 1
+        last_self_track = agent_self_temp.trj_solution
+        agent_self_temp.solve_game_IBR(virtual_inter_agent.trj_solution)
+        virtual_inter_agent.solve_game_IBR(agent_self_temp.trj_solution)
+        if count_iter > iter_limit:
+            break
+    solver_nit = agent_self_temp.solver_nit_collection + virtual_inter_agent.solver_nit_collection
+    return virtual_inter_agent.trj_solution, solver_nit, stats.record()
+
+
+def set_virtual_game_workers(max_workers):
+    """
+    start a persistent process pool for the parallel virtual-agent games, reused by all agents
+    and time steps until it is changed again
+    :param max_workers: number of worker processes, 0 or None to play the games in this process
+    :return:
+    """
+    global _virtual_game_executor, _virtual_game_workers, _virtual_game_settings
+    if _virtual_game_executor is not None:
+        _virtual_game_executor.shutdown(wait=True)
+        _virtual_game_executor = None
+    _virtual_game_workers = max_workers or 0
+    if max_workers:
+        _virtual_game_settings = virtual_game_settings()
+        _virtual_game_executor = ProcessPoolExecutor(max_workers=max_workers, initializer=apply_virtual_game_settings,
+                                                     initargs=(_virtual_game_settings,))
+
+
+def virtual_game_settings():
+    """
+    :return: dict of the module settings read while playing a game, and the switch of the JIT kernels
+    """
+    settings = {name: globals()[name] for name in VIRTUAL_GAME_SETTINGS}
+    settings['USE_JIT_KERNELS'] = jit_kernels.USE_JIT_KERNELS
+    return settings
+
+
+def apply_virtual_game_settings(settings):
+    """
+    initializer of the pool workers: the settings of the parent process when the pool was started, whether the
+    workers are forked (which copies the module as it is) or spawned (which imports it again)
+    """
+    settings = dict(settings)
+    jit_kernels.USE_JIT_KERNELS = settings.pop('USE_JIT_KERNELS')
+    globals().update(settings)
+
+
+def update_virtual_game_workers():
+    """
+    restart the virtual game pool if the module settings changed since it was started, so that the games played
+    in the workers and in this process give the same tracks
+    """
+    settings = virtual_game_settings()
+    if any(not np.array_equal(settings[name], _virtual_game_settings[name]) for name in settings):
+        set_virtual_game_workers(_virtual_game_workers)
+
+
 def utility_IBR(self_info, track_inter):
     def fun(u):
         """
@@ -262,31 +490,151 @@ def utility_IBR(self_info, track_inter):
     return fun
 
 
+def utility_grad_IBR(self_info, track_inter):
+    """
+    same objective as utility_IBR, additionally returning its exact gradient w.r.t. the controls
+    (back-propagated through the kinematic model), for minimize(..., jac=True)
+    """
+    def fun(u):
+        p, v, h = self_info[0:3]
+        init_state_4_kine = [p[0], p[1], v[0], v[1], h]
+        track_len = np.size(track_inter, 0)
+        u_steps = np.reshape(u, [2, track_len - 1]).T
+        track_self = kinematic_model(u_steps, init_state_4_kine, track_len, dt)[:, 0:2]
+        track_all = [track_self, track_inter[:, 0:2]]
+        interior_cost = cal_interior_cost(track_self, self_info[4])
+        group_cost = cal_group_cost(track_all, self_info[4])
+        util = np.cos(self_info[3]) * interior_cost + np.sin(self_info[3]) * group_cost
+
+        grad_track = position_grad(track_self)
+        grad_u = kinematic_model_vjp(u_steps, init_state_4_kine, grad_track, dt)
+        return util, grad_u.T.flatten()
+
+    position_grad = utility_position_grad_IBR(self_info, track_inter)
+    return fun
+
+
+def utility_batch_IBR(self_info, track_inter):
+    """
+    objective of utility_IBR for a batch of control sequences at once
+    """
+    def fun(u_steps):
+        """
+        :param u_steps: N by (TRACK_LEN - 1) by 2 array of controls [acceleration, steering angle]
+        :return: N array of utilities
+        """
+        p, v, h = self_info[0:3]
+        init_state_4_kine = [p[0], p[1], v[0], v[1], h]
+        tracks_self = kinematic_model_batch(u_steps, init_state_4_kine, dt)[:, :, 0:2]
+        interior_cost = cal_interior_cost_batch(tracks_self, self_info[4])
+        group_cost = cal_group_cost_batch(tracks_self, track_inter[:, 0:2], self_info[4])
+        return np.cos(self_info[3]) * interior_cost + np.sin(self_info[3]) * group_cost
+
+    return fun
+
+
+def utility_position_grad_IBR(self_info, track_inter):
+    """
+    gradient of the objective of utility_IBR w.r.t. the positions of the self track
+    """
+    def fun(track_self):
+        track_all = [track_self, track_inter[:, 0:2]]
+        return np.cos(self_info[3]) * cal_interior_cost_grad(track_self, self_info[4]) \
+            + np.sin(self_info[3]) * cal_group_cost_grad(track_all, self_info[4])
+
+    return fun
+
+
+def check_utility_grad(self_info, track_inter, u=None, eps=1e-6):
+    """
+    compare the analytic gradient of utility_grad_IBR with central finite differences of utility_IBR
+    :return: maximal absolute difference and maximal absolute value of the analytic gradient
+    """
+    track_len = np.size(track_inter, 0)
+    if u is None:
+        u = np.concatenate([np.random.uniform(-1, 1, track_len - 1) * MAX_ACCELERATION,
+                            np.random.uniform(-1, 1, track_len - 1) * MAX_STEERING_ANGLE]) * 0.5
+    fun = utility_IBR(self_info, track_inter)
+    _, grad = utility_grad_IBR(self_info, track_inter)(u)
+    grad_fd = np.zeros_like(u)
+    for i in range(np.size(u)):
+        step = np.zeros_like(u)
+        step[i] = eps
+        grad_fd[i] = (fun(u + step) - fun(u - step)) / (2 * eps)
+    return np.amax(np.abs(grad - grad_fd)), np.amax(np.abs(grad))
+
+
+def check_jit_kernels(num_track=200, seed=0):
+    """
+    compare the JIT kernels (plain Python if numba is not installed) with the NumPy implementations on
+    random controls of both simulation agents
+    :return: dict from kernel to the maximal absolute difference
+    """
+    use_jit_kernels = jit_kernels.USE_JIT_KERNELS
+    init_states = {'lt': [11, -5.8, 1.5, 1, math.pi / 4], 'gs': [25, -2, -5, 0, math.pi]}
+    results = {}
+    for use_jit in [False, True]:
+        jit_kernels.USE_JIT_KERNELS = use_jit
+        values = {'kinematic_model': [], 'cal_interior_cost': [], 'cal_group_cost': []}
+        rng = np.random.default_rng(seed)
+        for _ in range(num_track):
+            tracks = {}
+            for target, init_state in init_states.items():
+                u = np.concatenate([rng.uniform(-MAX_ACCELERATION, MAX_ACCELERATION, TRACK_LEN - 1),
+                                    rng.uniform(-MAX_STEERING_ANGLE, MAX_STEERING_ANGLE, TRACK_LEN - 1)])
+                tracks[target] = kinematic_model(u, init_state, TRACK_LEN, dt)
+                values['kinematic_model'].append(tracks[target])
+                values['cal_interior_cost'].append(cal_interior_cost(tracks[target][:, 0:2], target))
+            values['cal_group_cost'].append(cal_group_cost([tracks['lt'][:, 0:2], tracks['gs'][:, 0:2]], 'lt'))
+        results[use_jit] = values
+    jit_kernels.USE_JIT_KERNELS = use_jit_kernels
+    return {name: float(np.amax(np.abs(np.array(results[True][name]) - np.array(results[False][name]))))
+            for name in results[False]}
+
+
 def cal_interior_cost(track, target):
+    if jit_kernels.USE_JIT_KERNELS:
+        track = np.ascontiguousarray(track[:, 0:2], dtype=float)
+        origin_point = track[0, :] if target in {'gs_nds', 'lt_nds'} else None
+        dis2cv = distance_to_reference(track[None, :, :], target, origin_point)[0]
+        return jit_kernels.interior_cost(track, dis2cv, dt, MAX_SPEED, weight_metric) * WEIGHT_INT
+    return cal_interior_cost_batch(track[None, :, :], target)[0]
+
+
+def cal_interior_cost_batch(tracks, target):
+    """
+    interior cost of a stack of tracks
+    :param tracks: N by TRACK_LEN by 2 array
+    :param target:
+    :return: N array of interior costs
+    """
+    num_point = np.size(tracks, 1)
+
+    # distance from each point in the tracks to cv
     if target in {'gs_nds', 'lt_nds'}:
-        cv, s = get_central_vertices(target, track[0, :])
+        # the reference path starts at the first point of each track
+        dis2cv = np.zeros(tracks.shape[0:2])
+        origin_keys = [reference_path_cache.make_key(target, track[0, :]) for track in tracks]
+        for key in set(origin_keys):
+            index = [i for i in range(len(origin_keys)) if origin_keys[i] == key]
+            dis2cv[index] = distance_to_reference(tracks[index, :, 0:2], target, tracks[index[0], 0, :])
     else:
-        cv, s = get_central_vertices(target, None)
-
-    # initialize an array to store distance from each point in the track to cv
-    dis2cv = np.zeros([np.size(track, 0), 1])
-    for i in range(np.size(track, 0)):
-        dis2cv[i] = np.amin(np.linalg.norm(cv - track[i, 0:2], axis=1))
+        dis2cv = distance_to_reference(tracks[:, :, 0:2], target, None)
 
     "1. cost of travel delay"
     # calculate the on-reference distance of the given track (the longer the better)
-    travel_distance = np.linalg.norm(track[-1, 0:2] - track[0, 0:2]) / np.size(track, 0)
+    travel_distance = np.linalg.norm(tracks[:, -1, 0:2] - tracks[:, 0, 0:2], axis=1) / num_point
     cost_travel_distance = - travel_distance
     # print('cost of travel delay:', cost_travel_distance)
 
     "2. cost of lane deviation"
-    cost_mean_deviation = max(0.2, dis2cv.mean())
+    cost_mean_deviation = np.maximum(0.2, dis2cv.mean(axis=1))
     # print('cost of lane deviation:', cost_mean_deviation)
 
     "3. cost of overspeed"
-    dis = np.linalg.norm(track[1:, :] - track[0:-1, :], axis=1)
-    vel = (dis[1:] - dis[0:-1]) / dt
-    cost_overspeed = max(max(vel) - MAX_SPEED, 0)
+    dis = np.linalg.norm(tracks[:, 1:, :] - tracks[:, 0:-1, :], axis=2)
+    vel = (dis[:, 1:] - dis[:, 0:-1]) / dt
+    cost_overspeed = np.maximum(np.amax(vel, axis=1) - MAX_SPEED, 0)
 
     "4. cost of jerk"
     # dis = np.linalg.norm(track[1:, :] - track[0:-1, :], axis=1)
@@ -299,21 +647,53 @@ def cal_interior_cost(track, target):
     cost_metric = np.array([cost_travel_distance, cost_mean_deviation, cost_overspeed])
 
     "overall cost"
-    cost_interior = weight_metric.dot(cost_metric.T)
+    cost_interior = weight_metric.dot(cost_metric)
 
     return cost_interior * WEIGHT_INT
 
 
+def distance_to_reference(tracks, target, origin_point):
+    """
+    :param tracks: N by TRACK_LEN by 2 array of positions sharing one reference path
+    :return: N by TRACK_LEN array of distances to the reference path
+    """
+    points = tracks.reshape(-1, 2)
+    if USE_LANE_DISTANCE_FIELD:
+        dis2cv = get_lane_distance_field(target, origin_point).distance(points)
+    else:
+        cv, s = get_central_vertices(target, origin_point)
+        dis2cv = distance_to_central_vertices(cv, points)
+    return dis2cv.reshape(tracks.shape[0:2])
+
+
 def cal_group_cost(track_packed, self_target):
     track_self, track_inter = track_packed
-    pos_rel = track_inter - track_self
-    dis_rel = np.linalg.norm(pos_rel, axis=1)
+    if jit_kernels.USE_JIT_KERNELS:
+        track_self = np.ascontiguousarray(track_self[:, 0:2], dtype=float)
+        track_inter = np.ascontiguousarray(track_inter[:, 0:2], dtype=float)
+        if TARGET == 'simulation':
+            return jit_kernels.group_cost_simulation(track_self, track_inter, dt, TRACK_LEN) * WEIGHT_GRP
+        elif TARGET in {'nds analysis', 'nds simulation'}:
+            return jit_kernels.group_cost_nds(track_self, track_inter, dt, TRACK_LEN, MAX_ACCELERATION) * WEIGHT_GRP
+    return cal_group_cost_batch(track_self[None, :, :], track_inter, self_target)[0]
+
+
+def cal_group_cost_batch(tracks_self, track_inter, self_target):
+    """
+    group cost of a stack of self tracks against one interacting track (or a stack of them)
+    :param tracks_self: N by TRACK_LEN by 2 array
+    :param track_inter: TRACK_LEN by 2 array, or N by TRACK_LEN by 2
+    :param self_target:
+    :return: N array of group costs
+    """
+    pos_rel = track_inter - tracks_self
+    dis_rel = np.linalg.norm(pos_rel, axis=2)
 
-    vel_self = (track_self[1:, :] - track_self[0:-1, :]) / dt
-    vel_inter = (track_inter[1:, :] - track_inter[0:-1, :]) / dt
+    vel_self = (tracks_self[:, 1:, :] - tracks_self[:, 0:-1, :]) / dt
+    vel_inter = (track_inter[..., 1:, :] - track_inter[..., 0:-1, :]) / dt
     vel_rel = vel_self - vel_inter
 
-    acc_self = (vel_self[1:, :] - vel_self[0:-1, :]) / dt
+    acc_self = (vel_self[:, 1:, :] - vel_self[:, 0:-1, :]) / dt
     # acc_inter = (vel_inter[1:, :] - vel_inter[0:-1, :]) / dt
     # acc_rel = acc_self - acc_inter
 
@@ -322,62 +702,142 @@ def cal_group_cost(track_packed, self_target):
     # min_index = np.where(min_rel_distance == rel_distance)[0]  # the time step when reach the minimal distance
     # cost_group1 = -min_rel_distance * min_index[0] / (np.size(track_self, 0)) / rel_distance[0]
 
-    cost_group = 0
+    cost_group = np.zeros(np.size(tracks_self, 0))
     if TARGET == 'simulation':
         "version 2: stable for simulation"
-        vel_rel_along_sum = 0
-        for i in range(np.size(vel_rel, 0)):
-            if dis_rel[i + 1] > 3:
-                collision_factor = 0.5
-            else:
-                collision_factor = 1.5
-            nearness_temp = collision_factor * pos_rel[i + 1, :].dot(vel_rel[i, :]) / dis_rel[i + 1]
-            # do not give reward to negative nearness (flee action)
-            vel_rel_along_sum = vel_rel_along_sum + (nearness_temp + np.abs(nearness_temp)) * 0.5
+        collision_factor = np.where(dis_rel[:, 1:] > 3, 0.5, 1.5)
+        nearness = collision_factor * np.sum(pos_rel[:, 1:, :] * vel_rel, axis=2) / dis_rel[:, 1:]
+        # do not give reward to negative nearness (flee action)
+        vel_rel_along_sum = np.sum((nearness + np.abs(nearness)) * 0.5, axis=1)
         cost_group = vel_rel_along_sum / TRACK_LEN
 
     elif TARGET in {'nds analysis', 'nds simulation'}:
         "version 3: stable for nds analysis"
-        acc_self_along_sum = 0
-        for i in range(np.size(acc_self, 0)):
-            nearness_temp = pos_rel[i + 2, :].dot(acc_self[i, :]) / dis_rel[i + 2]
-            acc_self_along_sum = acc_self_along_sum + nearness_temp
-            # acc_self_along_sum = acc_self_along_sum + (nearness_temp + np.abs(nearness_temp)) * 0.5
+        nearness = np.sum(pos_rel[:, 2:, :] * acc_self, axis=2) / dis_rel[:, 2:]
+        acc_self_along_sum = np.sum(nearness, axis=1)
+        # acc_self_along_sum = np.sum((nearness + np.abs(nearness)) * 0.5, axis=1)
         cost_group = acc_self_along_sum / TRACK_LEN / MAX_ACCELERATION  # [-1,1]
 
     # print('group cost:', cost_group)
     return cost_group * WEIGHT_GRP
 
 
+def cal_interior_cost_grad(track, target):
+    """
+    gradient of cal_interior_cost w.r.t. the positions of the track
+    :param track: TRACK_LEN by 2 array of positions
+    :param target:
+    :return: TRACK_LEN by 2 array
+    """
+    track = track[:, 0:2]
+    num_point = np.size(track, 0)
+    grad = np.zeros_like(track, dtype=float)
+
+    if target in {'gs_nds', 'lt_nds'}:
+        origin_point = track[0, :]
+    else:
+        origin_point = None
+
+    "1. cost of travel delay"
+    travel = track[-1, :] - track[0, :]
+    travel_norm = np.linalg.norm(travel)
+    if travel_norm > 0:
+        grad[-1, :] -= weight_metric[0] * travel / travel_norm / num_point
+        grad[0, :] += weight_metric[0] * travel / travel_norm / num_point
+
+    "2. cost of lane deviation"
+    if USE_LANE_DISTANCE_FIELD:
+        dis2cv, grad_dis2cv = get_lane_distance_field(target, origin_point).distance_and_gradient(track)
+    else:
+        cv, _ = get_central_vertices(target, origin_point)
+        rel = track[:, None, :] - cv[None, :, :]
+        dis_all = np.linalg.norm(rel, axis=2)
+        nearest = np.argmin(dis_all, axis=1)
+        dis2cv = dis_all[np.arange(num_point), nearest]
+        grad_dis2cv = rel[np.arange(num_point), nearest] / np.maximum(dis2cv, 1e-9)[:, None]
+    if dis2cv.mean() > 0.2:
+        grad += weight_metric[1] * grad_dis2cv / num_point
+
+    "3. cost of overspeed"
+    seg = track[1:, :] - track[0:-1, :]
+    dis = np.linalg.norm(seg, axis=1)
+    vel = (dis[1:] - dis[0:-1]) / dt
+    if max(vel) - MAX_SPEED > 0:
+        k = np.argmax(vel)
+        # vel[k] grows with the length of segment k + 1 and shrinks with that of segment k
+        for seg_id, sign in [(k + 1, 1), (k, -1)]:
+            if dis[seg_id] > 0:
+                direction = seg[seg_id, :] / dis[seg_id]
+                grad[seg_id + 1, :] += weight_metric[2] * sign * direction / dt
+                grad[seg_id, :] -= weight_metric[2] * sign * direction / dt
+
+    return grad * WEIGHT_INT
+
+
+def cal_group_cost_grad(track_packed, self_target):
+    """
+    gradient of cal_group_cost w.r.t. the positions of the self track (the interacting track is fixed)
+    :return: TRACK_LEN by 2 array
+    """
+    track_self, track_inter = track_packed
+    pos_rel = track_inter - track_self
+    dis_rel = np.linalg.norm(pos_rel, axis=1)
+    grad = np.zeros_like(track_self, dtype=float)
+
+    if TARGET == 'simulation':
+        vel_self = (track_self[1:, :] - track_self[0:-1, :]) / dt
+        vel_inter = (track_inter[1:, :] - track_inter[0:-1, :]) / dt
+        vel_rel = vel_self - vel_inter
+        pos = pos_rel[1:, :]
+        dis = dis_rel[1:]
+        collision_factor = np.where(dis > 3, 0.5, 1.5)
+        along = np.sum(pos * vel_rel, axis=1)
+        nearness = collision_factor * along / dis
+        # negative nearness (flee action) is not rewarded, so it has no gradient either
+        active = (nearness > 0)[:, None] * collision_factor[:, None]
+        grad_pos = vel_rel / dis[:, None] - along[:, None] * pos / dis[:, None] ** 3
+        grad_vel = pos / dis[:, None]
+        grad[1:, :] += active * (-grad_pos + grad_vel / dt)
+        grad[0:-1, :] -= active * grad_vel / dt
+        grad = grad / TRACK_LEN
+
+    elif TARGET in {'nds analysis', 'nds simulation'}:
+        acc_self = (track_self[2:, :] - 2 * track_self[1:-1, :] + track_self[0:-2, :]) / dt ** 2
+        pos = pos_rel[2:, :]
+        dis = dis_rel[2:]
+        along = np.sum(pos * acc_self, axis=1)
+        grad_pos = acc_self / dis[:, None] - along[:, None] * pos / dis[:, None] ** 3
+        grad_acc = pos / dis[:, None] / dt ** 2
+        grad[2:, :] += -grad_pos + grad_acc
+        grad[1:-1, :] -= 2 * grad_acc
+        grad[0:-2, :] += grad_acc
+        grad = grad / TRACK_LEN / MAX_ACCELERATION
+
+    return grad * WEIGHT_GRP
+
+
 def cal_reliability(inter_track, act_trck, vir_trck_coll, target):
     """
+    likelihood weight of each virtual candidate, evaluated for all candidates at once
 
     :param target:
     :param inter_track:
     :param act_trck: actual_track
-    :param vir_trck_coll: virtual_track_collection
+    :param vir_trck_coll: virtual_track_collection, N by track length by 2 array (or a list of tracks)
     :return:
     """
-    candidates_num = len(vir_trck_coll)
-    var = np.zeros(candidates_num)
-    interior_cost_vir = np.zeros(candidates_num)
-    group_cost_vir = np.zeros(candidates_num)
-    delta_pref = np.zeros(candidates_num)
-    cost_preference_vir = np.zeros(candidates_num)
+    vir_trck_coll = np.asarray(vir_trck_coll, dtype=float)
+    candidates_num = np.size(vir_trck_coll, 0)
     if np.size(inter_track) == 0:
         # calculate with trj similarity
-        for i in range(candidates_num):
-            virtual_track = vir_trck_coll[i]
-            rel_dis = np.linalg.norm(virtual_track - act_trck, axis=1)  # distance vector
-            var[i] = np.power(
-                np.prod(
-                    (1 / sigma / np.sqrt(2 * math.pi))
-                    * np.exp(- rel_dis ** 2 / (2 * sigma ** 2))
-                )
-                , 1 / np.size(act_trck, 0))
-
-            if var[i] < 0:
-                var[i] = 0
+        rel_dis = np.linalg.norm(vir_trck_coll - act_trck, axis=2)  # distance vectors
+        var = np.power(
+            np.prod(
+                (1 / sigma / np.sqrt(2 * math.pi))
+                * np.exp(- rel_dis ** 2 / (2 * sigma ** 2)),
+                axis=1)
+            , 1 / np.size(act_trck, 0))
+        var = np.maximum(var, 0)
 
     else:
         # calculate with cost preference similarity
@@ -385,15 +845,11 @@ def cal_reliability(inter_track, act_trck, vir_trck_coll, target):
         group_cost_observed = cal_group_cost([act_trck, inter_track], target)
         cost_preference_observed = math.atan(group_cost_observed / interior_cost_observed)
 
-        for i in range(candidates_num):
-            virtual_track = vir_trck_coll[i]
-            interior_cost_vir[i] = cal_interior_cost(virtual_track, target)
-            group_cost_vir[i] = cal_group_cost([virtual_track, inter_track], target)
-            cost_preference_vir[i] = math.atan(group_cost_vir[i] / interior_cost_vir[i])
-            delta_pref[i] = cost_preference_vir[i] - cost_preference_observed
-            p1 = (1 / sigma2 / np.sqrt(2 * math.pi))
-            p2 = np.exp(- delta_pref[i] ** 2 / (2 * sigma2 ** 2))
-            var[i] = (1 / sigma2 / np.sqrt(2 * math.pi)) * np.exp(- delta_pref[i] ** 2 / (2 * sigma2 ** 2))
+        interior_cost_vir = cal_interior_cost_batch(vir_trck_coll, target)
+        group_cost_vir = cal_group_cost_batch(vir_trck_coll, inter_track, target)
+        cost_preference_vir = np.arctan(group_cost_vir / interior_cost_vir)
+        delta_pref = cost_preference_vir - cost_preference_observed
+        var = (1 / sigma2 / np.sqrt(2 * math.pi)) * np.exp(- delta_pref ** 2 / (2 * sigma2 ** 2))
 
     if sum(var):
         weight = var / (sum(var))
@@ -428,6 +884,17 @@ if __name__ == '__main__':
     # plt.axis('equal')
     # plt.show()
 
+    "test lane distance field (asserted for every path type in tests/test_utility.py)"
+    # from tools.utility import check_lane_distance_field
+    # for target in ['lt', 'gs']:
+    #     max_error, resolution = check_lane_distance_field(target)
+    #     print(target, 'max error:', max_error, 'resolution:', resolution)
+
+    "test gradient of the objective (asserted in tests/test_agent.py)"
+    # self_info_test = [np.array([11, -5.8]), np.array([1.5, 1]), math.pi / 4, math.pi / 8, 'lt']
+    # track_inter_test = kinematic_model(np.zeros(2 * (TRACK_LEN - 1)), [25, -2, -5, 0, math.pi], TRACK_LEN, dt)
+    # print('gradient error:', check_utility_grad(self_info_test, track_inter_test))
+
     "test cal_cost"
     # track_test = [np.array([[0, -15], [5, -13], [10, -10]]), np.array([[20, -2], [10, -2], [0, -2]])]
     # # track_test = [np.array([[0, -15], [5, -13], [10, -10]]), np.array([[0, -14], [5, -11], [10, -9]])]
@@ -0,0 +1,298 @@
+"""
+benchmarks of the planner hot paths (micro) and of end-to-end runs (macro)
+
+runs offline with fixed seeds, prints a table and optionally writes the results to JSON:
+    python benchmark.py                      # all benchmarks
+    python benchmark.py --only micro --json benchmark.json
+    python benchmark.py --only kinematic_model solve_game_IBR
+**** run from the repository root (the NDS data is read from ./data) ****
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import agent
+from agent import Agent, cal_interior_cost, cal_group_cost, cal_reliability, virtual_agent_IPV_range
+from tools.utility import kinematic_model
+from tools import jit_kernels
+
+SEED = 0
+
+
+def random_controls(rng, track_len):
+    return np.concatenate([rng.uniform(-agent.MAX_ACCELERATION, agent.MAX_ACCELERATION, track_len - 1),
+                           rng.uniform(-agent.MAX_STEERING_ANGLE, agent.MAX_STEERING_ANGLE, track_len - 1)])
+
+
+def simulation_agents():
+    """
+    left-turn and go-straight agents of the default scenario of main2
+    """
+    agent_lt = Agent(np.array([11, -5.8]), np.array([1.5, 1]), math.pi / 4, 'lt')
+    agent_gs = Agent(np.array([25, -2]), np.array([-5, 0]), math.pi, 'gs')
+    agent_lt.ipv = math.pi / 8
+    return agent_lt, agent_gs
+
+
+def sample_tracks(rng, num_track):
+    """
+    tracks of the left-turn and go-straight agents under random controls
+    """
+    agent_lt, agent_gs = simulation_agents()
+    tracks = {}
+    for name, planner in [('lt', agent_lt), ('gs', agent_gs)]:
+        init_state = [planner.position[0], planner.position[1], planner.velocity[0], planner.velocity[1],
+                      planner.heading]
+        tracks[name] = np.array([kinematic_model(random_controls(rng, agent.TRACK_LEN), init_state,
+                                                 agent.TRACK_LEN, agent.dt)[:, 0:2] for _ in range(num_track)])
+    return tracks
+
+
+"====micro-benchmarks: setup returns the function to time===="
+
+
+def setup_kinematic_model(rng):
+    u = random_controls(rng, agent.TRACK_LEN)
+    init_state = [11, -5.8, 1.5, 1, math.pi / 4]
+    return lambda: kinematic_model(u, init_state, agent.TRACK_LEN, agent.dt)
+
+
+def setup_cal_interior_cost(rng):
+    track = sample_tracks(rng, 1)['lt'][0]
+    return lambda: cal_interior_cost(track, 'lt')
+
+
+def setup_cal_group_cost(rng):
+    tracks = sample_tracks(rng, 1)
+    return lambda: cal_group_cost([tracks['lt'][0], tracks['gs'][0]], 'lt')
+
+
+def setup_cal_reliability(rng):
+    tracks = sample_tracks(rng, len(virtual_agent_IPV_range) + 1)
+    actual_track = tracks['gs'][0, 0:6]
+    candidates = tracks['gs'][1:, 0:6]
+    return lambda: cal_reliability([], actual_track, candidates, [])
+
+
+def setup_solve_game_IBR(rng):
+    agent_lt, agent_gs = simulation_agents()
+    inter_track = sample_tracks(rng, 1)['gs'][0]
+    return lambda: agent_lt.planning_state().solve_game_IBR(inter_track)
+
+
+MICRO_BENCHMARKS = {
+    'kinematic_model': setup_kinematic_model,
+    'cal_interior_cost': setup_cal_interior_cost,
+    'cal_group_cost': setup_cal_group_cost,
+    'cal_reliability': setup_cal_reliability,
+    'solve_game_IBR': setup_solve_game_IBR,
+}
+
+
+# micro-benchmarks of the hot loops with a JIT kernel
+JIT_BENCHMARKS = ['kinematic_model', 'cal_interior_cost', 'cal_group_cost']
+
+
+def time_micro(setup, min_time=1.0, repeat=5):
+    """
+    :return: dict of the best and median time per call [s] over repeat rounds of at least min_time / repeat seconds
+    """
+    fun = setup(np.random.default_rng(SEED))
+    fun()  # warm up (caches, lazy imports)
+
+    # number of calls per round
+    number = 1
+    while True:
+        tic = time.perf_counter()
+        for _ in range(number):
+            fun()
+        if time.perf_counter() - tic > min_time / repeat:
+            break
+        number *= 2
+
+    per_call = []
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        for _ in range(number):
+            fun()
+        per_call.append((time.perf_counter() - tic) / number)
+    return {'best': min(per_call), 'median': float(np.median(per_call)), 'calls': number * repeat}
+
+
+def time_jit_kernels(min_time=1.0):
+    """
+    parity of the JIT kernels with the NumPy implementations, and their speedup if numba is installed
+    """
+    result = {'numba': jit_kernels.NUMBA_AVAILABLE, 'parity': agent.check_jit_kernels()}
+    print(f"{'jit_kernels':<22s} parity (max abs difference): {result['parity']}")
+    if not jit_kernels.NUMBA_AVAILABLE:
+        print(' ' * 23 + 'numba is not installed, the NumPy implementations are used')
+        return result
+
+    use_jit_kernels = jit_kernels.USE_JIT_KERNELS
+    for name in JIT_BENCHMARKS:
+        times = {}
+        for use_jit in [False, True]:
+            jit_kernels.USE_JIT_KERNELS = use_jit
+            times[use_jit] = time_micro(MICRO_BENCHMARKS[name], min_time)['best']
+        result[name] = {'numpy': times[False], 'jit': times[True], 'speedup': times[False] / times[True]}
+        print(f"    {name:<18s} numpy {times[False] * 1e6:8.1f} us, jit {times[True] * 1e6:8.1f} us,"
+              f" speedup {result[name]['speedup']:.1f}x")
+    jit_kernels.USE_JIT_KERNELS = use_jit_kernels
+    return result
+
+
+"====macro-benchmarks: run once, return extra results===="
+
+
+def macro_ibr_step():
+    """
+    one Simulator.ibr_iteration step of the default main2 scenario (VGIM controller)
+    """
+    from simulator import Scenario, Simulator
+    simu = Simulator(36)
+    simu.initialize(Scenario([[11, -5.8], [25, -2]], [[1.5, 1], [-5, 0]], [math.pi / 4, math.pi],
+                             [math.pi / 8, 0.0]), 'VGIM')
+    simu.ibr_iteration(num_step=1, lt_controller_type='VGIM')
+    return simu.solver_iterations()
+
+
+def planning_problems(num_step=4):
+    """
+    best-response problems met in the first time steps of the default main2 scenario: each agent and its
+    estimated agent against the plan of the other
+    """
+    from simulator import Scenario, Simulator
+    simu = Simulator(36)
+    simu.initialize(Scenario([[11, -5.8], [25, -2]], [[1.5, 1], [-5, 0]], [math.pi / 4, math.pi],
+                             [math.pi / 8, 0.0]), 'VGIM')
+    problems = []
+    for _ in range(num_step):
+        simu.ibr_iteration(num_step=1, lt_controller_type='VGIM')
+        for planner in [simu.agent_lt, simu.agent_gs]:
+            problems.append((planner.planning_state(), planner.estimated_inter_agent.trj_solution))
+            problems.append((planner.estimated_inter_agent.planning_state(), planner.trj_solution))
+    return problems
+
+
+def macro_solver_backends():
+    """
+    every solver backend on the same planning problems, and the fastest one within 0.1 m of SLSQP
+    """
+    from solvers import compare_backends, select_backend
+    report = compare_backends(planning_problems())
+    for backend, result in report.items():
+        print(f"    {backend:<20s} {result['time']:8.2f} s {result['iterations']:6d} iterations"
+              f" {result['not_converged']:4d} not converged, max deviation {result['max_deviation']:.3f} m")
+    return {'backends': report, 'selected': select_backend(report, tolerance=0.1)}
+
+
+def macro_main2_scenario():
+    """
+    a full 30-step random scenario, drawn like the cases of main2 (VGIM controller)
+    """
+    from sweep import simulate_scenario
+    rng = np.random.RandomState(SEED)
+    init_gs_px = 2 * (2 * (rng.random_sample() - 0.5)) + 25
+    ipv_gs = math.pi * 1 / 4 * (2 * (rng.random_sample() - 0.5))
+    with tempfile.TemporaryDirectory() as output_directory:
+        outcome = simulate_scenario(0, output_directory, controller_type='VGIM', init_gs_px=init_gs_px,
+                                    ipv_gs=ipv_gs, num_step=30)
+    return {'semantic_result': outcome['result']}
+
+
+def macro_analyze_nds():
+    """
+    IPV estimation of one NDS case through analyze_nds (without writing the excel). dt and the cost weights of
+    agent.py are set from TARGET at import, so the run is skipped unless TARGET is 'nds analysis'
+    """
+    if agent.TARGET != 'nds analysis':
+        return {'skipped': "set TARGET = 'nds analysis' in agent.py (TARGET is '" + agent.TARGET + "')"}
+    import NDS_analysis
+    case_id = 38
+    save_data_needed = NDS_analysis.save_data_needed
+    NDS_analysis.save_data_needed = False
+    try:
+        work = NDS_analysis.analyze_nds(case_id)
+    finally:
+        NDS_analysis.save_data_needed = save_data_needed
+    return {'case_id': case_id, 'frames': len(NDS_analysis.estimation_tasks(case_id)),
+            'incremental': NDS_analysis.incremental_estimation, 'solver_iterations': work['iterations']}
+
+
+MACRO_BENCHMARKS = {
+    'ibr_iteration_step': macro_ibr_step,
+    'solver_backends': macro_solver_backends,
+    'main2_scenario': macro_main2_scenario,
+    'analyze_nds_case': macro_analyze_nds,
+}
+
+
+def time_macro(run):
+    np.random.seed(SEED)
+    tic = time.perf_counter()
+    extra = run()
+    return {'time': time.perf_counter() - tic, 'result': extra}
+
+
+def numba_version():
+    return jit_kernels.numba.__version__ if jit_kernels.NUMBA_AVAILABLE else None
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'numba': numba_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def run_benchmarks(names=None, min_time=1.0):
+    """
+    :param names: benchmarks (or 'micro' / 'macro') to run, all if None
+    :return: dict of the environment and the results of each benchmark
+    """
+    results = {'environment': environment(), 'micro': {}, 'macro': {}}
+    for name, setup in MICRO_BENCHMARKS.items():
+        if names is None or name in names or 'micro' in names:
+            results['micro'][name] = time_micro(setup, min_time)
+            print(f"{name:<22s} {results['micro'][name]['best'] * 1e6:12.1f} us/call"
+                  f" (median {results['micro'][name]['median'] * 1e6:.1f})")
+    if names is None or 'jit_kernels' in names or 'micro' in names:
+        results['jit_kernels'] = time_jit_kernels(min_time)
+    for name, run in MACRO_BENCHMARKS.items():
+        if names is None or name in names or 'macro' in names:
+            results['macro'][name] = time_macro(run)
+            print(f"{name:<22s} {results['macro'][name]['time']:12.2f} s   {results['macro'][name]['result']}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks of the planner hot paths and end-to-end runs')
+    parser.add_argument('--only', nargs='+', default=None,
+                        help='benchmarks to run, or micro / macro (default: all)')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--min-time', type=float, default=1.0, help='time spent on each micro-benchmark [s]')
+    args = parser.parse_args()
+
+    unknown = set(args.only or []) - set(MICRO_BENCHMARKS) - set(MACRO_BENCHMARKS) - {'micro', 'macro', 'jit_kernels'}
+    if unknown:
+        sys.exit('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    benchmark_results = run_benchmarks(args.only, args.min_time)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(benchmark_results, f, indent=2, default=str)
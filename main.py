@@ -1,11 +1,12 @@
 import copy
+from functools import partial
 import math
 import numpy as np
 from matplotlib import pyplot as plt
 from agent import Agent
 from tools.utility import get_central_vertices
+from tools.result_store import ResultStore, agent_arrays
 import time
-import pickle
 
 ipv_update_method = 1
 """
@@ -23,6 +24,10 @@ final_illustration_needed = 1
 save_data_needed = 1
 
 
+def result_key(rd, case_id):
+    return 'agents_info' + '_round_' + str(rd) + '_case_' + str(case_id)
+
+
 def simulate(gs_ipv_sim, lt_ipv_sim, rd, case_id):
     # initial state of the left-turn vehicle
     init_position_lt = np.array([11, -5.8])
@@ -80,13 +85,9 @@ def simulate(gs_ipv_sim, lt_ipv_sim, rd, case_id):
 
     "====save data===="
     if save_data_needed:
-        filename = output_directory + '/data/agents_info' \
-                   + '_round_' + str(rd) \
-                   + '_case_' + str(case_id) \
-                   + '.pckl'
-        f = open(filename, 'wb')
-        pickle.dump([agent_lt, agent_gs], f)
-        f.close()
+        ResultStore(output_directory + '/data').save(result_key(rd, case_id),
+                                                     agent_arrays({'lt': agent_lt, 'gs': agent_gs}),
+                                                     round=rd, case_id=case_id, gs_ipv=gs_ipv_sim, lt_ipv=lt_ipv_sim)
         print('round_' + str(rd) + '_case_' + str(case_id), ' saved')
 
     "====visualization===="
@@ -192,59 +193,44 @@ def multi_simulate(process_id, gs_ipv_set, lt_ipv_set):
             print('#======process ', process_id, ':', count / num_all * 100, '%')
 
 
+def ipv_sweep(gs_ipv_set, lt_ipv_set, rd=-1):
+    """
+    one simulation for each pair of ipv, with a unique case id so that results of different runs do not overwrite
+    each other. runs are scheduled onto a process pool by sweep.run_sweep
+    """
+    from sweep import scenario_grid
+    cases = scenario_grid(gs_ipv_sim=gs_ipv_set, lt_ipv_sim=lt_ipv_set)
+    for case_id, case in enumerate(cases):
+        case['rd'] = rd
+        case['case_id'] = case_id
+    return cases
+
+
+def simulation_saved(case, directory):
+    """
+    whether simulate already saved the results of a case in the output directory
+    """
+    return ResultStore(directory + '/data').exists(result_key(case['rd'], case['case_id']))
+
+
 if __name__ == '__main__':
-    from multiprocessing import Process
+    from sweep import run_sweep
 
     tic = time.perf_counter()
 
+    "**** set final_illustration_needed = 0 before running a sweep ****"
+    is_saved = partial(simulation_saved, directory=output_directory)
+
     "multi process"
     # lt_ipv_set_full = [-4, -3, -2, -1, 0, 1, 2, 3, 4]
-    # processes = [Process(target=multi_simulate, args=(1, [-4], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(2, [-3], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(3, [-2], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(4, [-1], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(5, [0], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(6, [1], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(7, [2], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(8, [3], lt_ipv_set_full)),
-    #              Process(target=multi_simulate, args=(9, [4], lt_ipv_set_full)),
-    #              ]
-    # [p.start() for p in processes]  # 开启进程
-    # [p.join() for p in processes]  # 等待进程依次结束
+    # run_sweep(simulate, ipv_sweep(lt_ipv_set_full, lt_ipv_set_full), is_done=is_saved)
 
     "multi process for used set"
-    # processes = [Process(target=multi_simulate, args=(1, [-2], [-2])),
-    #              Process(target=multi_simulate, args=(2, [-2], [0])),
-    #              Process(target=multi_simulate, args=(3, [-2], [2])),
-    #              Process(target=multi_simulate, args=(4, [0], [-2])),
-    #              Process(target=multi_simulate, args=(5, [0], [0])),
-    #              Process(target=multi_simulate, args=(6, [0], [2])),
-    #              Process(target=multi_simulate, args=(7, [2], [-2])),
-    #              Process(target=multi_simulate, args=(8, [2], [0])),
-    #              Process(target=multi_simulate, args=(9, [2], [2])),
-    #              ]
-    # [p.start() for p in processes]  # 开启进程
-    # [p.join() for p in processes]  # 等待进程依次结束
+    # run_sweep(simulate, ipv_sweep([-2, 0, 2], [-2, 0, 2]), is_done=is_saved)
 
     "multi process for used set for cooperativeness analysis"
-    # processes = [Process(target=multi_simulate, args=(1, [2], [-3])),
-    #              Process(target=multi_simulate, args=(2, [2], [-2])),
-    #              Process(target=multi_simulate, args=(3, [2], [-1])),
-    #              Process(target=multi_simulate, args=(4, [2], [0])),
-    #              Process(target=multi_simulate, args=(5, [2], [1])),
-    #              Process(target=multi_simulate, args=(6, [2], [2])),
-    #              Process(target=multi_simulate, args=(7, [2], [3]))
-    #              ]
-    # processes = [Process(target=multi_simulate, args=(1, [-3], [2])),
-    #              Process(target=multi_simulate, args=(2, [-2], [2])),
-    #              Process(target=multi_simulate, args=(3, [-1], [2])),
-    #              Process(target=multi_simulate, args=(4, [0], [2])),
-    #              Process(target=multi_simulate, args=(5, [1], [2])),
-    #              Process(target=multi_simulate, args=(6, [2], [2])),
-    #              Process(target=multi_simulate, args=(7, [3], [2]))
-    #              ]
-    # [p.start() for p in processes]  # 开启进程
-    # [p.join() for p in processes]  # 等待进程依次结束
+    # run_sweep(simulate, ipv_sweep([2], [-3, -2, -1, 0, 1, 2, 3]), is_done=is_saved)
+    # run_sweep(simulate, ipv_sweep([-3, -2, -1, 0, 1, 2, 3], [2]), is_done=is_saved)
 
     "single test"
     # for gs_ipv in [1]:
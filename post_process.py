@@ -2,13 +2,17 @@
 analysis of simulation results
 """
 
+import os
 import pickle
 import xlsxwriter
 import math
 import gc
+from functools import lru_cache
 import pandas as pd
 from matplotlib import pyplot as plt
 from tools.utility import get_central_vertices, smooth_ployline, draw_rectangle
+from tools.result_store import ResultStore, agent_arrays
+from tools.render import render_frames, make_gif, make_mp4
 from NDS_analysis import cal_pet
 import numpy as np
 
@@ -19,17 +23,132 @@ save_data = 0
 save_fig_for_paper = 1
 
 
+def pickle_to_store(directory):
+    """
+    convert pickled simulation results (lists starting with the lt and gs agents) in a directory to the result store
+    """
+    store = ResultStore(directory)
+    for filename in sorted(os.listdir(directory)):
+        key, extension = os.path.splitext(filename)
+        if extension != '.pckl' or store.exists(key):
+            continue
+        f = open(os.path.join(directory, filename), 'rb')
+        data = pickle.load(f)
+        f.close()
+        agent_lt, agent_gs = data[0:2]
+        params = {'semantic_result': data[2], 'tag': data[3]} if len(data) > 3 else {}
+        store.save(key, agent_arrays({'lt': agent_lt, 'gs': agent_gs}), **params)
+        print(filename, ' converted')
+
+
+def draw_trajectory_frame(ax1, agent_lt, agent_gs, t, img):
+    """
+    observed positions of both agents up to time step t (and their plans at t)
+    :param img: background picture
+    """
+    lt_ob_trj = agent_lt.observed_trajectory[:, 0:2]
+    lt_heading = agent_lt.observed_trajectory[:, 4] / math.pi * 180
+    gs_ob_trj = agent_gs.observed_trajectory[:, 0:2]
+    gs_heading = agent_gs.observed_trajectory[:, 4] / math.pi * 180
+    num_frame = len(lt_ob_trj)
+
+    ax1.cla()
+    ax1.imshow(img, extent=[-9.1, 24.9, -13, 8])
+    ax1.set(xlim=[-9.1, 35], ylim=[-13, 8])
+    if not save_fig_for_paper:
+        # central vertices
+        cv_lt, _ = get_central_vertices('lt', None)
+        cv_gs, _ = get_central_vertices('gs', None)
+        ax1.plot(cv_lt[:, 0], cv_lt[:, 1], 'r-')
+        ax1.plot(cv_gs[:, 0], cv_gs[:, 1], 'b-')
+    # # ---- show position: version 1 ---- #
+    # # left-turn
+    # ax1.scatter(lt_ob_trj[:t + 1, 0],
+    #             lt_ob_trj[:t + 1, 1],
+    #             s=120,
+    #             alpha=0.4,
+    #             color='red',
+    #             label='left-turn')
+    # # go-straight
+    # ax1.scatter(gs_ob_trj[:t + 1, 0],
+    #             gs_ob_trj[:t + 1, 1],
+    #             s=120,
+    #             alpha=0.4,
+    #             color='blue',
+    #             label='go-straight')
+
+    # ---- show position: version 2 ----#
+    for s in range(t+1):
+        draw_rectangle(lt_ob_trj[s, 0], lt_ob_trj[s, 1], lt_heading[s], ax1,
+                       para_alpha=(s+1)/num_frame, para_color='#0E76CF')
+        draw_rectangle(gs_ob_trj[s, 0], gs_ob_trj[s, 1], gs_heading[s], ax1,
+                       para_alpha=(s+1)/num_frame, para_color='#7030A0')
+
+        # non-interacting following car
+        draw_rectangle(30-s*0.5-0.5, -2, 0, ax1, para_alpha=(s+1)/num_frame, para_color='gray')
+
+    if not save_fig_for_paper:
+        if t < len(lt_ob_trj) - 1:
+            # real-time virtual plans of ## ego ## at time step t
+            lt_track = agent_lt.trj_solution_collection[t]
+            ax1.plot(lt_track[:, 0], lt_track[:, 1], '--', linewidth=3)
+            gs_track = agent_gs.trj_solution_collection[t]
+            ax1.plot(gs_track[:, 0], gs_track[:, 1], '--', linewidth=3)
+            if ipv_update_method == 1:
+                # real-time virtual plans of ## interacting agent ## at time step t
+                candidates_lt = agent_lt.estimated_inter_agent.virtual_track_collection[t]
+                candidates_gs = agent_gs.estimated_inter_agent.virtual_track_collection[t]
+                for track_lt in candidates_lt:
+                    ax1.plot(track_lt[:, 0], track_lt[:, 1], color='green', alpha=0.5)
+                for track_gs in candidates_gs:
+                    ax1.plot(track_gs[:, 0], track_gs[:, 1], color='green', alpha=0.5)
+        # position link
+        ax1.plot([lt_ob_trj[t, 0], gs_ob_trj[t, 0]],
+                 [lt_ob_trj[t, 1], gs_ob_trj[t, 1]],
+                 color='gray',
+                 alpha=0.2)
+
+
+def draw_trajectory_figure(fig, store_directory, key, t):
+    agent_lt, agent_gs = load_stored_agents(store_directory, key)
+    draw_trajectory_frame(fig.add_subplot(111), agent_lt, agent_gs, t, plt.imread('background_pic/T_intersection.jpg'))
+
+
+@lru_cache(maxsize=4)
+def load_stored_agents(store_directory, key):
+    # each rendering process loads a run once for all of its frames
+    return ResultStore(store_directory).load_agents(key)
+
+
+def render_results(store_directory, key, output_directory, gif=True, mp4=False, max_workers=None):
+    """
+    render the trajectory animation of get_results offscreen, frames split across worker processes
+    :return: list of PNG files
+    """
+    agent_lt, _ = load_stored_agents(store_directory, key)
+    frames = [(store_directory, key, t) for t in range(len(agent_lt.observed_trajectory))]
+    pattern = output_directory + '/' + key + '_{:04d}.png'
+    png_files = render_frames(draw_trajectory_figure, frames, pattern, figsize=(12, 4), max_workers=max_workers)
+    if gif:
+        make_gif(png_files, output_directory + '/' + key + '.gif')
+    if mp4:
+        make_mp4(pattern, output_directory + '/' + key + '.mp4')
+    return png_files
+
+
 def get_results(rd, case_id):
     # import data
     version_num = '28'
     tag = 'VGIM-dyna-gs-4'
     filedir = '../data/3_parallel_game_outputs/simulation/version' + str(version_num)
-    filename = filedir + '/data/agents_infocase' + '_round' + str(rd) + '-' + tag + '.pckl'
-    # filename = filedir + '/data/agents_info' + '_round_' + str(rd) + '_case_' + str(case_id) + '.pckl'
-    # filename = filedir + '/data/' + 'NE-Coop_task_1_case_0.pckl'
-    f = open(filename, 'rb')
-    agent_lt, agent_gs, _, _, _ = pickle.load(f)
-    f.close()
+    key = 'agents_infocase' + '_round' + str(rd) + '-' + tag
+    # key = 'agents_info' + '_round_' + str(rd) + '_case_' + str(case_id)
+    # key = 'NE-Coop_task_1_case_0'
+    store = ResultStore(filedir + '/data')
+    if not store.exists(key):
+        # results saved before the result store was introduced
+        pickle_to_store(filedir + '/data')
+    agent_lt, agent_gs = store.load_agents(key)
 
     "====data abstraction===="
     # lt track (observed and planned)
@@ -111,59 +230,7 @@ def get_results(rd, case_id):
         num_frame = len(lt_ob_trj)
         # num_frame = 16
         for t in range(num_frame):
-            ax1.cla()
-            ax1.imshow(img, extent=[-9.1, 24.9, -13, 8])
-            ax1.set(xlim=[-9.1, 35], ylim=[-13, 8])
-            if not save_fig_for_paper:
-                # central vertices
-                ax1.plot(cv_lt[:, 0], cv_lt[:, 1], 'r-')
-                ax1.plot(cv_gs[:, 0], cv_gs[:, 1], 'b-')
-            # # ---- show position: version 1 ---- #
-            # # left-turn
-            # ax1.scatter(lt_ob_trj[:t + 1, 0],
-            #             lt_ob_trj[:t + 1, 1],
-            #             s=120,
-            #             alpha=0.4,
-            #             color='red',
-            #             label='left-turn')
-            # # go-straight
-            # ax1.scatter(gs_ob_trj[:t + 1, 0],
-            #             gs_ob_trj[:t + 1, 1],
-            #             s=120,
-            #             alpha=0.4,
-            #             color='blue',
-            #             label='go-straight')
-
-            # ---- show position: version 2 ----#
-            for s in range(t+1):
-                draw_rectangle(lt_ob_trj[s, 0], lt_ob_trj[s, 1], lt_heading[s], ax1,
-                               para_alpha=(s+1)/num_frame, para_color='#0E76CF')
-                draw_rectangle(gs_ob_trj[s, 0], gs_ob_trj[s, 1], gs_heading[s], ax1,
-                               para_alpha=(s+1)/num_frame, para_color='#7030A0')
-
-                # non-interacting following car
-                draw_rectangle(30-s*0.5-0.5, -2, 0, ax1, para_alpha=(s+1)/num_frame, para_color='gray')
-
-            if not save_fig_for_paper:
-                if t < len(lt_ob_trj) - 1:
-                    # real-time virtual plans of ## ego ## at time step t
-                    lt_track = agent_lt.trj_solution_collection[t]
-                    ax1.plot(lt_track[:, 0], lt_track[:, 1], '--', linewidth=3)
-                    gs_track = agent_gs.trj_solution_collection[t]
-                    ax1.plot(gs_track[:, 0], gs_track[:, 1], '--', linewidth=3)
-                    if ipv_update_method == 1:
-                        # real-time virtual plans of ## interacting agent ## at time step t
-                        candidates_lt = agent_lt.estimated_inter_agent.virtual_track_collection[t]
-                        candidates_gs = agent_gs.estimated_inter_agent.virtual_track_collection[t]
-                        for track_lt in candidates_lt:
-                            ax1.plot(track_lt[:, 0], track_lt[:, 1], color='green', alpha=0.5)
-                        for track_gs in candidates_gs:
-                            ax1.plot(track_gs[:, 0], track_gs[:, 1], color='green', alpha=0.5)
-                # position link
-                ax1.plot([lt_ob_trj[t, 0], gs_ob_trj[t, 0]],
-                         [lt_ob_trj[t, 1], gs_ob_trj[t, 1]],
-                         color='gray',
-                         alpha=0.2)
+            draw_trajectory_frame(ax1, agent_lt, agent_gs, t, img)
             if show_gif:
                 plt.pause(0.1)
         if not save_fig_for_paper:
@@ -251,3 +318,8 @@ if __name__ == '__main__':
     rd = 3
     caseid = 1
     get_results(rd, caseid)
+
+    "render the trajectory animation offscreen"
+    # render_results('../data/3_parallel_game_outputs/simulation/version28/data',
+    #                'agents_infocase_round3-VGIM-dyna-gs-4',
+    #                '../data/3_parallel_game_outputs/simulation/version28/figures')
@@ -1,13 +1,16 @@
 import copy
+import json
 import math
+import os
 import numpy as np
+import pandas as pd
 from agent import Agent
 from tools.utility import get_central_vertices
-import pickle
-import pandas as pd
-import xlsxwriter
+from tools.result_store import ResultStore, agent_arrays
+from tools.outcome_log import OutcomeLog, write_excel_sheet
+from tools.render import render_frames
+from tools.instrumentation import Instrumentation, NULL_INSTRUMENTATION
 import scipy.io
-import os
 import matplotlib.pyplot as plt
 from NDS_analysis import analyze_ipv_in_nds
 
@@ -34,47 +37,95 @@ class Simulator:
         self.ending_point = None
         self.gs_actual_trj = []
         self.lt_actual_trj = []
+        self.instrumentation = NULL_INSTRUMENTATION
 
-    def initialize(self, scenario, case_tag):
+    def initialize(self, scenario, case_tag, warm_start=False, instrumented=False, solver_backend=None):
+        """
+        :param scenario:
+        :param case_tag:
+        :param warm_start: seed every solve with the previous plan (shifted by one step after each time step)
+        :param instrumented: time the phases of ibr_iteration and count the solver statistics, see
+        instrumentation_record
+        :param solver_backend: solver of solve_game_IBR (see solvers.SOLVER_BACKENDS), or a dict from controller type
+        to solver, e.g. {'VGIM': 'L-BFGS-B', 'OPT-dyna': 'SLSQP'} (the go-straight agent uses the 'VGIM' entry);
+        None: agent.SOLVER_BACKEND
+        :return:
+        """
         self.scenario = scenario
         self.agent_lt = Agent(scenario.position['lt'], scenario.velocity['lt'], scenario.heading['lt'], 'lt')
         self.agent_gs = Agent(scenario.position['gs'], scenario.velocity['gs'], scenario.heading['gs'], 'gs')
+        self.agent_lt.warm_start = warm_start
+        self.agent_gs.warm_start = warm_start
         self.agent_lt.estimated_inter_agent = copy.deepcopy(self.agent_gs)
         self.agent_gs.estimated_inter_agent = copy.deepcopy(self.agent_lt)
         self.agent_lt.ipv = self.scenario.ipv['lt']
         self.agent_gs.ipv = self.scenario.ipv['gs']
         self.tag = case_tag
 
+        # both agents and their estimated agents share the statistics of the run
+        self.instrumentation = Instrumentation() if instrumented else NULL_INSTRUMENTATION
+        for agent in [self.agent_lt, self.agent_gs, self.agent_lt.estimated_inter_agent,
+                      self.agent_gs.estimated_inter_agent]:
+            agent.instrumentation = self.instrumentation
+
+        # an agent plans its estimated agent with its own solver
+        if isinstance(solver_backend, dict):
+            lt_backend, gs_backend = solver_backend.get(case_tag), solver_backend.get('VGIM')
+        else:
+            lt_backend = gs_backend = solver_backend
+        self.agent_lt.solver_backend = self.agent_lt.estimated_inter_agent.solver_backend = lt_backend
+        self.agent_gs.solver_backend = self.agent_gs.estimated_inter_agent.solver_backend = gs_backend
+
+    def solver_iterations(self):
+        """
+        solver iterations spent by both agents and their estimated interacting agents so far
+        :return: dict with the number of solves and the total and mean number of iterations
+        """
+        nit = []
+        for agent in [self.agent_lt, self.agent_gs]:
+            nit += agent.solver_nit_collection + agent.estimated_inter_agent.solver_nit_collection
+        return {'solves': len(nit),
+                'iterations': int(np.sum(nit)),
+                'mean_iterations': float(np.mean(nit)) if nit else 0.0}
+
     def ibr_iteration(self, num_step=30, lt_controller_type='VGIM', break_when_finish=False):
         self.num_step = num_step
         iter_limit = 3
+        stats = self.instrumentation
         for t in range(self.num_step):
             print('time_step: ', t, '/', self.num_step)
+            stats.count('time_steps')
 
             "==plan for left-turn=="
             if lt_controller_type in {'VGIM-coop', 'VGIM-dyna', 'VGIM'}:
 
                 # ==interaction with parallel virtual agents
-                self.agent_lt.interact_with_parallel_virtual_agents(self.agent_gs, iter_limit=iter_limit)
+                with stats.timer('lt/virtual_games'):
+                    self.agent_lt.interact_with_parallel_virtual_agents(self.agent_gs, iter_limit=iter_limit)
 
                 # ==interaction with estimated agent
-                self.agent_lt.interact_with_estimated_agents(iter_limit=iter_limit)
+                with stats.timer('lt/estimated_agent_ibr'):
+                    self.agent_lt.interact_with_estimated_agents(iter_limit=iter_limit)
 
             elif lt_controller_type in {'OPT-coop', 'OPT-dyna', 'OPT-safe'}:
 
                 # ==interaction with estimated agent
-                self.agent_lt.interact_with_estimated_agents(controller_type=lt_controller_type)
+                with stats.timer('lt/estimated_agent_ibr'):
+                    self.agent_lt.interact_with_estimated_agents(controller_type=lt_controller_type)
 
             "==plan for go straight=="
             # ==interaction with parallel virtual agents
-            self.agent_gs.interact_with_parallel_virtual_agents(self.agent_lt, iter_limit)
+            with stats.timer('gs/virtual_games'):
+                self.agent_gs.interact_with_parallel_virtual_agents(self.agent_lt, iter_limit)
 
             # ==interaction with estimated agent
-            self.agent_gs.interact_with_estimated_agents(iter_limit)
+            with stats.timer('gs/estimated_agent_ibr'):
+                self.agent_gs.interact_with_estimated_agents(iter_limit)
 
             "==update state=="
-            self.agent_lt.update_state(self.agent_gs, controller_type=lt_controller_type)
-            self.agent_gs.update_state(self.agent_lt, controller_type='VGIM')
+            with stats.timer('update_state'):
+                self.agent_lt.update_state(self.agent_gs, controller_type=lt_controller_type)
+                self.agent_gs.update_state(self.agent_lt, controller_type='VGIM')
 
             if break_when_finish:
                 if self.agent_gs.observed_trajectory[-1, 0] < self.agent_lt.observed_trajectory[-1, 0] \
@@ -82,46 +133,91 @@ class Simulator:
                     self.num_step = t + 1
                     break
 
+    def instrumentation_record(self, task_id=1):
+        """
+        statistics of the run (None if not instrumented): wall time of the phases of ibr_iteration, of each solver
+        backend and of the IPV likelihood ('solver/<backend>' and 'ipv_likelihood' are nested in the phases), and
+        the counters of each solver backend
+        """
+        return self.instrumentation.record(tag=self.tag, task_id=task_id, case_id=self.case_id,
+                                           version=self.version, num_step=self.num_step)
+
+    @staticmethod
+    def result_key(tag, task_id, case_id):
+        return str(tag) + '_task_' + str(task_id) + '_case_' + str(case_id)
+
+    @staticmethod
+    def result_filename(output_directory, tag, task_id, case_id):
+        return ResultStore(output_directory + '/data').filename(Simulator.result_key(tag, task_id, case_id))
+
     def save_data(self, print_semantic_result=False, task_id=1):
-        filename = self.output_directory + '/data/' + str(self.tag) \
-                   + '_task_' + str(task_id) \
-                   + '_case_' + str(self.case_id) \
-                   + '.pckl'
-        f = open(filename, 'wb')
-        pickle.dump([self.agent_lt, self.agent_gs, self.semantic_result, self.tag, self.ending_point], f)
-        f.close()
+        arrays = agent_arrays({'lt': self.agent_lt, 'gs': self.agent_gs})
+        if self.ending_point is not None:
+            arrays['lt/ending_point'] = self.ending_point['lt']
+            arrays['gs/ending_point'] = self.ending_point['gs']
+        if len(self.lt_actual_trj):
+            arrays['lt/actual_trj'] = self.lt_actual_trj
+            arrays['gs/actual_trj'] = self.gs_actual_trj
+
+        params = {'tag': self.tag, 'task_id': task_id, 'case_id': self.case_id, 'version': self.version,
+                  'num_step': self.num_step, 'semantic_result': self.semantic_result}
+        for name in ['lt', 'gs']:
+            params[name + '_px'], params[name + '_py'] = self.scenario.position[name]
+            params[name + '_vx'], params[name + '_vy'] = self.scenario.velocity[name]
+            params[name + '_heading'] = float(self.scenario.heading[name])
+            params[name + '_ipv'] = float(self.scenario.ipv[name])
+
+        ResultStore(self.output_directory + '/data').save(self.result_key(self.tag, task_id, self.case_id),
+                                                          arrays, **params)
         print('case_' + str(self.tag), ' saved')
 
+        if self.instrumentation.enabled:
+            os.makedirs(self.output_directory + '/stats', exist_ok=True)
+            with open(self.output_directory + '/stats/' + self.result_key(self.tag, task_id, self.case_id)
+                      + '.json', 'w') as f:
+                json.dump(self.instrumentation_record(task_id), f, indent=2, default=str)
+
         if print_semantic_result:
+            with self.outcome_log(task_id) as log:
+                log.append(self.outcome_row())
 
-            # prepare workbook
-            workbook = self.output_directory + '/excel/' + self.tag + '.xlsx'
-            if not os.path.exists(workbook):
-                wb = xlsxwriter.Workbook(workbook)
-                ws = wb.add_worksheet(self.tag + '-task-' + str(task_id))
-                wb.close()
-
-            # prepare data
-            data_interaction_event = [[self.agent_gs.observed_trajectory[0, 0],
-                                       self.agent_gs.ipv,
-                                       self.semantic_result], ]
-            if self.case_id == 0:
-                pd_interaction_event = pd.DataFrame(data_interaction_event, columns=['gap', 'gs_ipv', 'result'])
-                # write data
-                with pd.ExcelWriter(workbook, mode='a', if_sheet_exists="overlay", engine="openpyxl") as writer:
-
-                    pd_interaction_event.to_excel(writer, index=False,
-                                                  sheet_name=self.tag + '-task-' + str(task_id),
-                                                  startrow=self.case_id)
+    def outcome_row(self):
+        """
+        row of the outcome log: gap and IPV of the go-straight vehicle and the semantic result
+        """
+        return {'case_id': self.case_id,
+                'gap': self.agent_gs.observed_trajectory[0, 0],
+                'gs_ipv': self.agent_gs.ipv,
+                'result': self.semantic_result}
 
-            else:
-                pd_interaction_event = pd.DataFrame(data_interaction_event)
-                # write data
-                with pd.ExcelWriter(workbook, mode='a', if_sheet_exists="overlay", engine="openpyxl") as writer:
+    def outcome_log(self, task_id=1):
+        """
+        running log of the semantic results of single runs saved with print_semantic_result. the workbook is
+        written from the result store instead (see export_outcomes), which holds every saved run
+        """
+        return OutcomeLog(self.output_directory + '/excel/' + self.tag + '-task-' + str(task_id) + '.csv',
+                          ['case_id', 'gap', 'gs_ipv', 'result'])
 
-                    pd_interaction_event.to_excel(writer, index=False, header=False,
-                                                  sheet_name=self.tag + '-task-' + str(task_id),
-                                                  startrow=self.case_id + 1)
+    def outcome_table(self, task_id=1):
+        """
+        outcomes (as in outcome_row) of all runs of the tag and task saved to the result store, ordered by case
+        """
+        index = ResultStore(self.output_directory + '/data').index()
+        if len(index) == 0:
+            return pd.DataFrame(columns=['case_id', 'gap', 'gs_ipv', 'result'])
+        runs = index[(index['tag'].astype(str) == str(self.tag)) & (index['task_id'] == task_id)]
+        table = pd.DataFrame({'case_id': runs['case_id'], 'gap': runs['gs_px'], 'gs_ipv': runs['gs_ipv'],
+                              'result': runs['semantic_result']})
+        return table.sort_values('case_id', kind='stable').reset_index(drop=True)
+
+    def export_outcomes(self, task_id=1):
+        """
+        write the outcomes of a task to its sheet of the workbook of the tag. they are read from the result store,
+        so runs whose rows never reached an outcome log (e.g. a crashed sweep) are included
+        """
+        os.makedirs(self.output_directory + '/excel', exist_ok=True)
+        write_excel_sheet(self.outcome_table(task_id), self.output_directory + '/excel/' + self.tag + '.xlsx',
+                          sheet_name=self.tag + '-task-' + str(task_id))
 
     def post_process(self):
         """
@@ -181,6 +277,22 @@ class Simulator:
         """
         # set figures
         fig = plt.figure(figsize=(12, 4))
+        self.draw(fig, controller_type)
+
+        # plt.ioff()
+        plt.savefig(self.output_directory + '/figures/' + str(self.tag)
+                    + '_task_' + str(task_id)
+                    + '_case_' + str(self.case_id)
+                    + '.svg', format='svg')
+
+        plt.pause(1)
+        plt.close('all')
+        # plt.show()
+
+    def draw(self, fig, controller_type='VGIM'):
+        """
+        trajectories and plans, IPV estimation and velocity of the agents
+        """
         fig.suptitle('case_' + str(self.tag))
         ax1 = fig.add_subplot(131, title='trajectory_LT_' + self.semantic_result)
 
@@ -303,15 +415,25 @@ class Simulator:
         ax2.legend()
         ax3.legend()
 
-        # plt.ioff()
-        plt.savefig(self.output_directory + '/figures/' + str(self.tag)
-                    + '_task_' + str(task_id)
-                    + '_case_' + str(self.case_id)
-                    + '.svg', format='svg')
-
-        plt.pause(1)
-        plt.close('all')
-        # plt.show()
+    @classmethod
+    def from_store(cls, output_directory, key):
+        """
+        simulator with the results of a run saved by save_data (for visualization)
+        """
+        store = ResultStore(output_directory + '/data')
+        run = store.index().set_index('key').loc[key]
+        simu = cls(run['version'])
+        simu.output_directory = output_directory
+        simu.tag = run['tag']
+        simu.case_id = run['case_id']
+        simu.num_step = run['num_step']
+        simu.semantic_result = run['semantic_result']
+        simu.agent_lt, simu.agent_gs = store.load_agents(key)
+        with store.load(key) as data:
+            if 'lt/actual_trj' in data.files:
+                simu.lt_actual_trj = data['lt/actual_trj']
+                simu.gs_actual_trj = data['gs/actual_trj']
+        return simu
 
     def read_nds_scenario(self):
         cross_id, data_cross, _ = analyze_ipv_in_nds(self.case_id)
@@ -339,6 +461,23 @@ class Simulator:
                             [ipv_lt, ipv_gs])
 
 
+def draw_stored_result(fig, output_directory, key, controller_type):
+    Simulator.from_store(output_directory, key).draw(fig, controller_type)
+
+
+def render_results(output_directory, keys=None, controller_type='VGIM', max_workers=None):
+    """
+    draw the figure of Simulator.visualize for many saved runs offscreen, runs split across worker processes
+    :param keys: runs in the result store of output_directory (default: all)
+    :return: list of PNG files, one per run
+    """
+    if keys is None:
+        keys = list(ResultStore(output_directory + '/data').index()['key'])
+    return render_frames(draw_stored_result, [(output_directory, key, controller_type) for key in keys],
+                         [output_directory + '/figures/' + key + '.png' for key in keys],
+                         figsize=(12, 4), max_workers=max_workers)
+
+
 def main1():
     """
     ==== main for simulating unprotected left-turning ====
@@ -399,31 +538,30 @@ def main2():
     5. **** check TARGET in agent.py: TARGET = 'simulation' ****
     :return:
     """
-    for case_id in range(100):
+    from sweep import run_sweep, simulate_scenario, simulation_done
+
+    task_id = 3
 
-        task_id = 3
+    # controller_tag = 'VGIM-coop'
+    # controller_tag = 'VGIM-dyna'
+    # controller_tag = 'OPT-coop'
+    # controller_tag = 'OPT-safe'
+    controller_tag = 'OPT-dyna'
 
-        # controller_tag = 'VGIM-coop'
-        # controller_tag = 'VGIM-dyna'
-        # controller_tag = 'OPT-coop'
-        # controller_tag = 'OPT-safe'
-        controller_tag = 'OPT-dyna'
+    # random cases are drawn up front (seeded by the task id), so a restarted sweep skips finished cases
+    rng = np.random.RandomState(task_id)
+    cases = []
+    for case_id in range(100):
 
         # generate gs position
-        init_gs_px = 2 * (2 * (np.random.random() - 0.5)) + 25
+        init_gs_px = 2 * (2 * (rng.random_sample() - 0.5)) + 25
         # init_gs_px = 26
 
-        # initial state of the go-straight vehicle
-        init_position_gs = [init_gs_px, -2]
-        init_velocity_gs = [-5, 0]
-        init_heading_gs = math.pi
-        ipv_gs = math.pi * 1 / 4 * (2 * (np.random.random() - 0.5))
+        # ipv of the go-straight vehicle
+        ipv_gs = math.pi * 1 / 4 * (2 * (rng.random_sample() - 0.5))
         # ipv_gs = -0.5 * math.pi/4
 
-        # initial state of the left-turn vehicle
-        init_position_lt = [11, -5.8]
-        init_velocity_lt = [1.5, 1]
-        init_heading_lt = math.pi / 4
+        # ipv of the left-turn vehicle
         if controller_tag in {'VGIM-coop', 'OPT-coop'}:
             ipv_lt = math.pi / 8
         elif controller_tag in {'OPT-safe'}:
@@ -434,27 +572,32 @@ def main2():
             else:
                 ipv_lt = math.pi / 8
 
-        simu_scenario = Scenario([init_position_lt, init_position_gs],
-                                 [init_velocity_lt, init_velocity_gs],
-                                 [init_heading_lt, init_heading_gs],
-                                 [ipv_lt, ipv_gs])
-        simu = Simulator(36)
-        simu.output_directory = '../data/3_parallel_game_outputs/simulation/version' + str(simu.version)
-        simu.case_id = case_id
-
-        print('==== start main for random interaction ====')
-        print('task type: ', controller_tag)
-        print('task id: ' + str(task_id))
-        print('case id: ' + str(case_id))
-        print('gs_px: ', init_gs_px)
-        print('gs_ipv: ', ipv_gs)
-
-        simu.initialize(simu_scenario, controller_tag)
-
-        simu.ibr_iteration(lt_controller_type=controller_tag, num_step=30, break_when_finish=True)
-        simu.post_process()
-        simu.save_data(print_semantic_result=True, task_id=task_id)
-        simu.visualize(task_id=task_id, controller_type=controller_tag)
+        cases.append({'case_id': case_id,
+                      'output_directory': '../data/3_parallel_game_outputs/simulation/version36',
+                      'controller_type': controller_tag,
+                      'task_id': task_id,
+                      'init_gs_px': init_gs_px,
+                      'ipv_gs': ipv_gs,
+                      'ipv_lt': ipv_lt,
+                      'print_semantic_result': False,
+                      'visualize': False})
+
+    print('==== start main for random interaction ====')
+    print('task type: ', controller_tag)
+    print('task id: ' + str(task_id))
+
+    run_sweep(simulate_scenario, cases, is_done=simulation_done)
+
+    # write the semantic results of all saved cases (including those of earlier, interrupted sweeps) to the workbook
+    simu = Simulator(36)
+    simu.output_directory = cases[0]['output_directory']
+    simu.tag = controller_tag
+    simu.export_outcomes(task_id=task_id)
+
+    # figures of all runs, drawn offscreen after the sweep instead of interactively in every worker
+    render_results(simu.output_directory,
+                   [Simulator.result_key(controller_tag, task_id, case['case_id']) for case in cases],
+                   controller_type=controller_tag)
 
 
 def main3():
@@ -0,0 +1,315 @@
+"""
+solver backends of the best-response trajectory optimization (Planner.solve_game_IBR)
+
+the controls of a plan are one flat vector [accelerations, steering angles] with box bounds only, so any
+bound-constrained optimizer can solve it. a backend is a function backend(problem, u0) returning a
+scipy OptimizeResult (x, fun, nit, nfev, success), registered in SOLVER_BACKENDS by name.
+"""
+import numpy as np
+from scipy.optimize import minimize, OptimizeResult, approx_fprime
+from tools.instrumentation import Instrumentation
+from tools.utility import kinematic_model_step, kinematic_model_jacobians
+
+
+class TrajectoryProblem:
+    def __init__(self, init_state, inter_track, ipv, target, lower, upper, fun, fun_grad=None,
+                 position_grad=None, fun_batch=None, dt=0.12):
+        """
+        :param init_state: [x, y, vx, vy, heading] of the planning agent
+        :param inter_track: planned track of the interacting agent
+        :param lower: lower bounds of the flattened controls
+        :param upper: upper bounds of the flattened controls
+        :param fun: objective of the flattened controls
+        :param fun_grad: objective and its gradient (None: finite differences where a gradient is needed)
+        :param position_grad: gradient of the objective w.r.t. the positions of a track (TRACK_LEN by 2 array)
+        :param fun_batch: objective of N by (TRACK_LEN - 1) by 2 arrays of controls, returning N values
+        :param dt: time step of the bicycle model
+        """
+        self.init_state = init_state
+        self.inter_track = inter_track
+        self.track_len = np.size(inter_track, 0)
+        self.ipv = ipv
+        self.target = target
+        self.lower = lower
+        self.upper = upper
+        self.fun = fun
+        self.fun_grad = fun_grad
+        self.position_grad = position_grad
+        self.fun_batch = fun_batch
+        self.dt = dt
+
+    @property
+    def bounds(self):
+        return list(zip(self.lower, self.upper))
+
+    def clip(self, u):
+        return np.clip(u, self.lower, self.upper)
+
+    def value_and_grad(self, u):
+        if self.fun_grad is not None:
+            return self.fun_grad(u)
+        return self.fun(u), approx_fprime(u, self.fun, 1.4901161193847656e-08)
+
+
+def solve_slsqp(problem, u0):
+    if problem.fun_grad is not None:
+        return minimize(problem.fun_grad, u0, jac=True, bounds=problem.bounds, method='SLSQP')
+    return minimize(problem.fun, u0, bounds=problem.bounds, method='SLSQP')
+
+
+def solve_lbfgsb(problem, u0):
+    if problem.fun_grad is not None:
+        return minimize(problem.fun_grad, u0, jac=True, bounds=problem.bounds, method='L-BFGS-B')
+    return minimize(problem.fun, u0, bounds=problem.bounds, method='L-BFGS-B')
+
+
+def solve_projected_gradient(problem, u0, max_iter=200, ftol=1e-9, gtol=1e-6):
+    """
+    gradient steps projected onto the box, with Barzilai-Borwein step lengths and Armijo backtracking.
+    the controls are scaled by the widths of their bounds, as accelerations and steering angles differ in range
+    """
+    scale = problem.upper - problem.lower
+    x = problem.clip(np.asarray(u0, dtype=float))
+    f, g = problem.value_and_grad(x)
+    nfev = 1
+    step = 1 / max(np.linalg.norm(g * scale), 1e-12)
+    success = False
+    message = 'maximal number of iterations reached'
+    nit = 0
+    for nit in range(1, max_iter + 1):
+        # stationary if the projected gradient step vanishes
+        if np.amax(np.abs(problem.clip(x - g * scale ** 2) - x) / scale) < gtol:
+            success, message = True, 'projected gradient below gtol'
+            break
+
+        # backtrack along the projection arc until the Armijo condition holds
+        while True:
+            x_new = problem.clip(x - step * scale ** 2 * g)
+            f_new, g_new = problem.value_and_grad(x_new)
+            nfev += 1
+            if f_new <= f + 1e-4 * np.dot(g, x_new - x) or step < 1e-12:
+                break
+            step *= 0.5
+
+        # Barzilai-Borwein step length in the scaled controls
+        s = (x_new - x) / scale
+        y = (g_new - g) * scale
+        sy = np.dot(s, y)
+        step = np.dot(s, s) / sy if sy > 0 else 2 * step
+
+        f_old = f
+        x, f, g = x_new, f_new, g_new
+        if abs(f_old - f) <= ftol * max(abs(f_old), abs(f), 1):
+            success, message = True, 'relative reduction of the objective below ftol'
+            break
+    return OptimizeResult(x=x, fun=f, jac=g, nit=nit, nfev=nfev, success=success, message=message)
+
+
+def rollout(problem, u_steps):
+    """
+    :param u_steps: (TRACK_LEN - 1) by 2 array of controls
+    :return: TRACK_LEN by 4 array of bicycle-model states [x, y, speed, heading]
+    """
+    x, y, vx, vy, heading = problem.init_state
+    states = np.empty([problem.track_len, 4])
+    states[0] = [x, y, np.hypot(vx, vy), np.squeeze(heading)]
+    for t in range(problem.track_len - 1):
+        states[t + 1] = kinematic_model_step(states[t], u_steps[t], problem.dt)
+    return states
+
+
+def solve_ilqr(problem, u0, max_iter=100, ftol=1e-9, reg_init=1.0, reg_max=1e6):
+    """
+    iterative LQR on the bicycle model (state [x, y, speed, heading]), with the controls clamped to their bounds.
+    the objective couples the time steps (travel distance, mean deviation, maximal speed), so it is expanded per
+    step by its gradient w.r.t. each position, with a quadratic proximal term on the positions and controls
+    (Levenberg-Marquardt style: its weight shrinks after a successful step and grows after a failed one)
+    """
+    if problem.position_grad is None:
+        raise ValueError('the iLQR backend needs the gradient of the objective w.r.t. the positions')
+    num_step = problem.track_len - 1
+    lower = problem.lower.reshape(2, num_step).T
+    upper = problem.upper.reshape(2, num_step).T
+    # proximal weights, controls scaled by the widths of their bounds
+    weight_position = np.diag([1.0, 1.0, 0.0, 0.0])
+    weight_control = np.diag(1 / (problem.upper - problem.lower).reshape(2, num_step)[:, 0] ** 2)
+
+    u = np.clip(np.reshape(u0, [2, num_step]).T, lower, upper)
+    states = rollout(problem, u)
+    f = problem.fun(u.T.flatten())
+    nfev = 1
+    reg = reg_init
+    success = False
+    message = 'maximal number of iterations reached'
+    nit = 0
+    for nit in range(1, max_iter + 1):
+        "==backward pass=="
+        grad_position = problem.position_grad(states[:, 0:2])
+        jac_state, jac_control = kinematic_model_jacobians(states[:-1], u, problem.dt)
+        gain_ff = np.zeros([num_step, 2])
+        gain_fb = np.zeros([num_step, 2, 4])
+        value_x = np.concatenate([grad_position[-1], [0, 0]])
+        value_xx = reg * weight_position
+        for t in range(num_step - 1, -1, -1):
+            a, b = jac_state[t], jac_control[t]
+            q_u = b.T @ value_x
+            q_x = np.concatenate([grad_position[t], [0, 0]]) + a.T @ value_x
+            q_uu = reg * weight_control + b.T @ value_xx @ b
+            q_ux = b.T @ value_xx @ a
+            q_xx = reg * weight_position + a.T @ value_xx @ a
+            gain_ff[t] = -np.linalg.solve(q_uu, q_u)
+            gain_fb[t] = -np.linalg.solve(q_uu, q_ux)
+            value_x = q_x + gain_fb[t].T @ q_uu @ gain_ff[t] + gain_fb[t].T @ q_u + q_ux.T @ gain_ff[t]
+            value_xx = q_xx + gain_fb[t].T @ q_uu @ gain_fb[t] + gain_fb[t].T @ q_ux + q_ux.T @ gain_fb[t]
+            value_xx = (value_xx + value_xx.T) / 2
+
+        "==forward pass with line search on the feedforward step=="
+        improved = False
+        for alpha in [1, 0.5, 0.25, 0.125]:
+            u_new = np.empty_like(u)
+            states_new = np.empty_like(states)
+            states_new[0] = states[0]
+            for t in range(num_step):
+                u_new[t] = np.clip(u[t] + alpha * gain_ff[t] + gain_fb[t] @ (states_new[t] - states[t]),
+                                   lower[t], upper[t])
+                states_new[t + 1] = kinematic_model_step(states_new[t], u_new[t], problem.dt)
+            f_new = problem.fun(u_new.T.flatten())
+            nfev += 1
+            if f_new < f:
+                improved = True
+                break
+
+        if not improved:
+            reg *= 10
+            if reg > reg_max:
+                success, message = False, 'no descent within the maximal proximal weight'
+                break
+            continue
+
+        reg = max(reg / 2, 1e-6)
+        f_old = f
+        u, states, f = u_new, states_new, f_new
+        if f_old - f <= ftol * max(abs(f_old), abs(f), 1):
+            success, message = True, 'relative reduction of the objective below ftol'
+            break
+    return OptimizeResult(x=u.T.flatten(), fun=f, nit=nit, nfev=nfev, success=success, message=message)
+
+
+# seed of the sampling backend: every solve draws the same perturbations, so runs are reproducible
+MPPI_SEED = 0
+
+
+def solve_mppi(problem, u0, num_sample=2048, max_iter=20, noise=0.25, temperature=0.05, ftol=1e-6, seed=None):
+    """
+    model predictive path integral (sampling) update of the plan: perturbed control sequences are rolled out
+    and scored all at once (problem.fun_batch), and the plan moves to their average weighted by exp(-cost)
+    :param num_sample: number of perturbed sequences per iteration
+    :param noise: standard deviation of the perturbations, relative to the widths of the bounds
+    :param temperature: of the exponential weights, relative to the spread of the sampled costs
+    :param seed: of the perturbations, MPPI_SEED if None
+    """
+    if problem.fun_batch is None:
+        raise ValueError('the MPPI backend needs the objective of a batch of controls')
+    num_step = problem.track_len - 1
+    lower = problem.lower.reshape(2, num_step).T
+    upper = problem.upper.reshape(2, num_step).T
+    rng = np.random.default_rng(MPPI_SEED if seed is None else seed)
+
+    u = np.clip(np.reshape(u0, [2, num_step]).T, lower, upper)
+    u_best = u
+    f_best = problem.fun_batch(u[None])[0]
+    nfev = 1
+    success = False
+    message = 'maximal number of iterations reached'
+    nit = 0
+    for nit in range(1, max_iter + 1):
+        samples = u[None] + rng.standard_normal([num_sample, num_step, 2]) * noise * (upper - lower)
+        samples = np.clip(samples, lower, upper)
+        # the current plan takes part, so the update cannot be pulled away from a plan better than all samples
+        samples[0] = u
+        cost = problem.fun_batch(samples)
+        nfev += num_sample
+
+        spread = max(np.std(cost), 1e-12)
+        weight = np.exp(-(cost - np.amin(cost)) / (temperature * spread))
+        weight /= np.sum(weight)
+        u = np.clip(np.tensordot(weight, samples, axes=1), lower, upper)
+        f = problem.fun_batch(u[None])[0]
+        nfev += 1
+
+        # keep the best plan seen, the weighted average or the best sample
+        i_min = np.argmin(cost)
+        if cost[i_min] < f:
+            u, f = samples[i_min], cost[i_min]
+        f_old = f_best
+        if f < f_best:
+            u_best, f_best = u, f
+        if f_old - f_best <= ftol * max(abs(f_old), 1) and nit > 1:
+            success, message = True, 'relative reduction of the objective below ftol'
+            break
+    return OptimizeResult(x=u_best.T.flatten(), fun=f_best, nit=nit, nfev=nfev, success=success, message=message)
+
+
+SOLVER_BACKENDS = {
+    'SLSQP': solve_slsqp,
+    'L-BFGS-B': solve_lbfgsb,
+    'projected-gradient': solve_projected_gradient,
+    'iLQR': solve_ilqr,
+    'MPPI': solve_mppi,
+}
+
+
+def solve_trajectory(problem, u0, backend='SLSQP'):
+    """
+    :param backend: name of a backend in SOLVER_BACKENDS
+    :return: OptimizeResult of the backend
+    """
+    if backend not in SOLVER_BACKENDS:
+        raise ValueError('unknown solver backend ' + str(backend) + ', choose from ' + str(list(SOLVER_BACKENDS)))
+    return SOLVER_BACKENDS[backend](problem, u0)
+
+
+def compare_backends(problems, backends=None, reference='SLSQP'):
+    """
+    solve the same planning problems with each backend
+    :param problems: list of (planner, inter_track), planner being an Agent or PlanningState
+    :param backends: names of the backends to compare (default: all)
+    :param reference: backend whose trajectories the others are compared with
+    :return: dict from backend name to its total time [s], solver iterations and function evaluations,
+    number of non-converged solves and the mean and maximal deviation [m] of the planned positions from the
+    reference
+    """
+    backends = list(SOLVER_BACKENDS) if backends is None else list(backends)
+    if reference not in backends:
+        backends.insert(0, reference)
+
+    tracks = {}
+    report = {}
+    for backend in backends:
+        tracks[backend] = []
+        stats = Instrumentation()
+        for planner, inter_track in problems:
+            state = planner.planning_state()
+            state.solver_backend = backend
+            state.instrumentation = stats
+            tracks[backend].append(state.solve_game_IBR(inter_track))
+        report[backend] = {'time': stats.timers['solver/' + backend][1]}
+        for counter in ['iterations', 'function_evaluations', 'not_converged']:
+            report[backend][counter] = stats.counters['solver/' + backend + '/' + counter]
+
+    for backend in backends:
+        deviation = [np.amax(np.linalg.norm(track[:, 0:2] - track_ref[:, 0:2], axis=1))
+                     for track, track_ref in zip(tracks[backend], tracks[reference])]
+        report[backend]['mean_deviation'] = float(np.mean(deviation))
+        report[backend]['max_deviation'] = float(np.amax(deviation))
+    return report
+
+
+def select_backend(report, tolerance=0.1):
+    """
+    :param report: result of compare_backends
+    :param tolerance: maximal deviation [m] of the planned positions from the reference backend
+    :return: name of the fastest backend within the tolerance
+    """
+    candidates = [backend for backend in report if report[backend]['max_deviation'] <= tolerance]
+    return min(candidates, key=lambda backend: report[backend]['time'])
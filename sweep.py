@@ -0,0 +1,95 @@
+"""
+parameter sweeps: schedule independent simulation runs onto a process pool
+"""
+import itertools
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from simulator import Scenario, Simulator
+
+
+def scenario_grid(**axes):
+    """
+    cartesian product of parameter axes, e.g. scenario_grid(ipv_gs=[-1, 0, 1], init_gs_px=[22, 25])
+    :return: list of parameter dicts, one per run
+    """
+    names = list(axes.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+
+def run_sweep(run_case, cases, is_done=None, max_workers=None, on_result=None):
+    """
+    run every case on a process pool. runs are submitted one by one, so a worker that finishes early
+    picks up the next waiting run instead of idling until a fixed shard of runs is done
+    :param run_case: top-level function called as run_case(**case) in a worker process
+    :param cases: list of parameter dicts
+    :param is_done: function of a case, True if its results already exist (the run is skipped)
+    :param max_workers: number of worker processes (default: number of CPUs), 1 runs in this process
+    :param on_result: function called in this process as on_result(case, result) when a run finishes
+    :return: dict from the index of each executed case to the return value of run_case
+    """
+    todo = [i for i in range(len(cases)) if is_done is None or not is_done(cases[i])]
+    print('==== sweep: ' + str(len(cases)) + ' runs, ' + str(len(cases) - len(todo)) + ' already done ====')
+
+    results = {}
+    tic = time.perf_counter()
+
+    def report(case_index):
+        if on_result is not None:
+            on_result(cases[case_index], results[case_index])
+        num_finished = len(results)
+        elapsed = time.perf_counter() - tic
+        eta = elapsed / num_finished * (len(todo) - num_finished)
+        print('#====== run ' + str(case_index) + ' finished: '
+              + str(num_finished) + '/' + str(len(todo))
+              + f', elapsed {elapsed:0.1f} s, ETA {eta:0.1f} s')
+
+    if max_workers == 1:
+        for i in todo:
+            results[i] = run_case(**cases[i])
+            report(i)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(run_case, **cases[i]): i for i in todo}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                report(futures[future])
+    return results
+
+
+def simulate_scenario(case_id, output_directory, controller_type='VGIM', task_id=1, version=36,
+                      init_gs_px=25, init_gs_vx=-5, ipv_gs=0.0,
+                      init_lt_position=(11, -5.8), init_lt_velocity=(1.5, 1), ipv_lt=math.pi / 8,
+                      num_step=30, break_when_finish=True, print_semantic_result=False, visualize=False,
+                      instrumented=False, solver_backend=None):
+    """
+    one unprotected left-turn simulation (see simulator.main2) with the given parameters
+    :param instrumented: save the timers and solver statistics of the run to output_directory/stats
+    :param solver_backend: solver of solve_game_IBR, see Simulator.initialize
+    :return: outcome of the run, see Simulator.outcome_row
+    """
+    simu_scenario = Scenario([list(init_lt_position), [init_gs_px, -2]],
+                             [list(init_lt_velocity), [init_gs_vx, 0]],
+                             [math.pi / 4, math.pi],
+                             [ipv_lt, ipv_gs])
+    simu = Simulator(version)
+    simu.output_directory = output_directory
+    simu.case_id = case_id
+    simu.initialize(simu_scenario, controller_type, instrumented=instrumented,
+                    solver_backend=solver_backend)
+    simu.ibr_iteration(lt_controller_type=controller_type, num_step=num_step, break_when_finish=break_when_finish)
+    simu.post_process()
+    simu.save_data(print_semantic_result=print_semantic_result, task_id=task_id)
+    if visualize:
+        simu.visualize(task_id=task_id, controller_type=controller_type)
+    return simu.outcome_row()
+
+
+def simulation_done(case):
+    """
+    whether simulate_scenario already saved the results of a case
+    """
+    filename = Simulator.result_filename(case['output_directory'], case.get('controller_type', 'VGIM'),
+                                         case.get('task_id', 1), case['case_id'])
+    return os.path.exists(filename)
@@ -0,0 +1,39 @@
+import math
+import numpy as np
+import pytest
+from agent import check_utility_grad, check_jit_kernels, kinematic_model, dt, TRACK_LEN, MAX_ACCELERATION, \
+    MAX_STEERING_ANGLE
+from tools import jit_kernels
+
+# initial states [x, y, vx, vy, heading] of the agents of the default scenario of main2
+INIT_STATES = {'lt': [11, -5.8, 1.5, 1, math.pi / 4], 'gs': [25, -2, -5, 0, math.pi]}
+
+
+@pytest.mark.parametrize('target, inter_target', [('lt', 'gs'), ('gs', 'lt')])
+@pytest.mark.parametrize('ipv', [math.pi / 8, -math.pi / 8])
+def test_utility_grad_matches_finite_differences(target, inter_target, ipv):
+    init_state = INIT_STATES[target]
+    self_info = [np.array(init_state[0:2]), np.array(init_state[2:4]), init_state[4], ipv, target]
+    track_inter = kinematic_model(np.zeros(2 * (TRACK_LEN - 1)), INIT_STATES[inter_target], TRACK_LEN, dt)
+    rng = np.random.default_rng(0)
+    u = np.concatenate([rng.uniform(-1, 1, TRACK_LEN - 1) * MAX_ACCELERATION,
+                        rng.uniform(-1, 1, TRACK_LEN - 1) * MAX_STEERING_ANGLE]) * 0.5
+
+    max_error, max_grad = check_utility_grad(self_info, track_inter, u)
+    assert max_grad > 0
+    assert max_error <= 1e-6 * max_grad
+
+
+def test_jit_kernels_match_numpy():
+    # compiled kernels if numba is installed, otherwise the same kernels run as plain Python
+    differences = check_jit_kernels()
+    assert set(differences) == {'kinematic_model', 'cal_interior_cost', 'cal_group_cost'}
+    for kernel, difference in differences.items():
+        assert difference <= 1e-9, kernel
+
+
+@pytest.mark.skipif(not jit_kernels.NUMBA_AVAILABLE, reason='numba is not installed')
+def test_jit_kernels_compiled():
+    check_jit_kernels(num_track=1)
+    for kernel in [jit_kernels.rollout, jit_kernels.interior_cost, jit_kernels.group_cost_simulation]:
+        assert kernel.signatures
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+from tools.utility import check_lane_distance_field, get_lane_distance_field
+
+# first points of the left-turn and go-straight vehicles of NDS case 38, at the start of their interaction
+NDS_ORIGINS = {'lt_nds': np.array([15.83, 19.32]), 'gs_nds': np.array([21.67, 43.64])}
+
+
+@pytest.mark.parametrize('cv_type', ['lt', 'gs', 'lt_nds', 'gs_nds'])
+def test_lane_distance_field_within_resolution(cv_type):
+    max_error, resolution = check_lane_distance_field(cv_type, NDS_ORIGINS.get(cv_type))
+    assert max_error <= resolution
+
+
+@pytest.mark.parametrize('cv_type', ['lt_nds', 'gs_nds'])
+def test_nds_reference_path_requires_origin(cv_type):
+    with pytest.raises(ValueError):
+        get_lane_distance_field(cv_type)
@@ -0,0 +1,108 @@
+"""
+opt-in timers and counters of a run
+
+an Instrumentation collects the wall time of named phases and named counters (e.g. solver iterations) and exports
+them as one plain dict per run. agents and simulators hold NULL_INSTRUMENTATION by default, whose timers and
+counters do nothing, so the instrumented code paths cost next to nothing unless instrumentation is switched on.
+records of worker processes are merged into the parent's instrumentation.
+"""
+import time
+
+
+class _Timer:
+    __slots__ = ('instrumentation', 'name', 'tic')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.tic = 0.0
+
+    def __enter__(self):
+        self.tic = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.tic)
+
+
+class Instrumentation:
+    enabled = True
+
+    def __init__(self):
+        # name -> [number of timed calls, total time in s]
+        self.timers = {}
+        # name -> value
+        self.counters = {}
+
+    def timer(self, name):
+        """
+        context manager adding the wall time of its block to the timer name
+        """
+        return _Timer(self, name)
+
+    def add_time(self, name, duration, calls=1):
+        timer = self.timers.setdefault(name, [0, 0.0])
+        timer[0] += calls
+        timer[1] += duration
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, other):
+        """
+        :param other: Instrumentation or a record of one (see record)
+        """
+        if isinstance(other, Instrumentation):
+            other = other.record()
+        if not other:
+            return
+        for name, timer in other['timers'].items():
+            self.add_time(name, timer['total'], timer['calls'])
+        for name, value in other['counters'].items():
+            self.count(name, value)
+
+    def record(self, **params):
+        """
+        :param params: run parameters stored with the statistics, e.g. the case id
+        :return: dict of the params, the timers (calls, total and mean time) and the counters
+        """
+        return {'params': params,
+                'timers': {name: {'calls': calls, 'total': total, 'mean': total / calls if calls else 0.0}
+                           for name, (calls, total) in self.timers.items()},
+                'counters': dict(self.counters)}
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return None
+
+
+class NullInstrumentation:
+    """
+    disabled instrumentation: records nothing
+    """
+    enabled = False
+    _timer = _NullTimer()
+
+    def timer(self, name):
+        return self._timer
+
+    def add_time(self, name, duration, calls=1):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def merge(self, other):
+        pass
+
+    def record(self, **params):
+        return None
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
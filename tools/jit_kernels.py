@@ -0,0 +1,134 @@
+"""
+optional JIT-compiled (numba) kernels of the rollout and cost hot loops
+
+numba is detected at import. without it, USE_JIT_KERNELS is False and the NumPy implementations are used; the
+kernels below are then plain Python functions, which is slow but lets check_jit_kernels (agent.py) verify them
+anywhere. the kernels work on one track at a time: for tracks of ten points the loops beat the overhead of the
+vectorized NumPy versions once compiled.
+"""
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# switch of all kernels, on by default when numba is installed
+USE_JIT_KERNELS = NUMBA_AVAILABLE
+
+
+def jit(fun):
+    if numba is None:
+        return fun
+    return numba.njit(cache=True)(fun)
+
+
+@jit
+def rollout(u, init_state, dt, r_len, f_len):
+    """
+    kinematic_model_batch of one control sequence
+    :param u: (TRACK_LEN - 1) by 2 array of controls [acceleration, steering angle]
+    :param init_state: [x, y, vx, vy, heading]
+    :return: TRACK_LEN by 5 array [x, y, vx, vy, heading]
+    """
+    num_step = u.shape[0]
+    track = np.empty((num_step + 1, 5))
+    track[0, :] = init_state
+    x, y, psi = init_state[0], init_state[1], init_state[4]
+    v = math.sqrt(init_state[2] ** 2 + init_state[3] ** 2)
+    for t in range(num_step):
+        beta = math.atan((r_len / (r_len + f_len)) * math.tan(u[t, 1]))
+        x += v * math.cos(psi + beta) * dt
+        y += v * math.sin(psi + beta) * dt
+        psi += (v / f_len) * math.sin(beta) * dt
+        v += u[t, 0] * dt
+        track[t + 1, 0] = x
+        track[t + 1, 1] = y
+        track[t + 1, 2] = v * math.cos(psi)
+        track[t + 1, 3] = v * math.sin(psi)
+        track[t + 1, 4] = psi
+    return track
+
+
+@jit
+def bilinear_distance(points, origin, resolution, grid):
+    """
+    LaneDistanceField.distance of the points inside the grid
+    :return: m array of distances and m array of whether a point is inside the grid (distance 0 if not)
+    """
+    num_point = points.shape[0]
+    dis = np.zeros(num_point)
+    inside = np.zeros(num_point, dtype=np.bool_)
+    for i in range(num_point):
+        rx = (points[i, 0] - origin[0]) / resolution
+        ry = (points[i, 1] - origin[1]) / resolution
+        ix = int(math.floor(rx))
+        iy = int(math.floor(ry))
+        if ix < 0 or iy < 0 or ix >= grid.shape[0] - 1 or iy >= grid.shape[1] - 1:
+            continue
+        fx = rx - ix
+        fy = ry - iy
+        dis[i] = (grid[ix, iy] * (1 - fx) * (1 - fy) + grid[ix + 1, iy] * fx * (1 - fy)
+                  + grid[ix, iy + 1] * (1 - fx) * fy + grid[ix + 1, iy + 1] * fx * fy)
+        inside[i] = True
+    return dis, inside
+
+
+@jit
+def interior_cost(track, dis2cv, dt, max_speed, weight_metric):
+    """
+    cal_interior_cost of one track, given the distances of its points to the reference path
+    """
+    num_point = track.shape[0]
+    travel_distance = math.sqrt((track[-1, 0] - track[0, 0]) ** 2
+                                + (track[-1, 1] - track[0, 1]) ** 2) / num_point
+    mean_deviation = max(0.2, np.mean(dis2cv))
+
+    max_vel = -np.inf
+    last_dis = math.sqrt((track[1, 0] - track[0, 0]) ** 2 + (track[1, 1] - track[0, 1]) ** 2)
+    for i in range(1, num_point - 1):
+        dis = math.sqrt((track[i + 1, 0] - track[i, 0]) ** 2 + (track[i + 1, 1] - track[i, 1]) ** 2)
+        max_vel = max(max_vel, (dis - last_dis) / dt)
+        last_dis = dis
+    overspeed = max(max_vel - max_speed, 0.0)
+    return -weight_metric[0] * travel_distance + weight_metric[1] * mean_deviation + weight_metric[2] * overspeed
+
+
+@jit
+def group_cost_simulation(track_self, track_inter, dt, track_len):
+    """
+    cal_group_cost of one track, version 2 (TARGET = 'simulation'), before weighting
+    """
+    total = 0.0
+    for i in range(1, track_self.shape[0]):
+        pos_x = track_inter[i, 0] - track_self[i, 0]
+        pos_y = track_inter[i, 1] - track_self[i, 1]
+        dis = math.sqrt(pos_x ** 2 + pos_y ** 2)
+        vel_x = ((track_self[i, 0] - track_self[i - 1, 0]) - (track_inter[i, 0] - track_inter[i - 1, 0])) / dt
+        vel_y = ((track_self[i, 1] - track_self[i - 1, 1]) - (track_inter[i, 1] - track_inter[i - 1, 1])) / dt
+        collision_factor = 0.5 if dis > 3 else 1.5
+        nearness = collision_factor * (pos_x * vel_x + pos_y * vel_y) / dis
+        # do not give reward to negative nearness (flee action)
+        total += max(nearness, 0.0)
+    return total / track_len
+
+
+@jit
+def group_cost_nds(track_self, track_inter, dt, track_len, max_acceleration):
+    """
+    cal_group_cost of one track, version 3 (TARGET = 'nds analysis' / 'nds simulation'), before weighting
+    """
+    total = 0.0
+    for i in range(2, track_self.shape[0]):
+        pos_x = track_inter[i, 0] - track_self[i, 0]
+        pos_y = track_inter[i, 1] - track_self[i, 1]
+        dis = math.sqrt(pos_x ** 2 + pos_y ** 2)
+        acc_x = ((track_self[i, 0] - track_self[i - 1, 0]) / dt
+                 - (track_self[i - 1, 0] - track_self[i - 2, 0]) / dt) / dt
+        acc_y = ((track_self[i, 1] - track_self[i - 1, 1]) / dt
+                 - (track_self[i - 1, 1] - track_self[i - 2, 1]) / dt) / dt
+        total += (pos_x * acc_x + pos_y * acc_y) / dis
+    return total / track_len / max_acceleration
@@ -0,0 +1,191 @@
+"""
+lazy accessor of the NDS dataset (NDS_data_fixed.mat)
+
+the MATLAB file is only parsed when the data is first used. optionally, it is converted once to plain .npy files
+that are opened as memory maps, so processes reading the dataset share the pages of one copy: all trajectories
+in one flat array with the offset and shape of each (case, vehicle), plus the valid-frame bounds of every vehicle
+and the interaction origin/destination frames of every go-straight vehicle.
+"""
+import os
+import numpy as np
+import scipy.io
+
+# files of the memory-mappable copy
+MEMMAP_FILES = ['vehicles', 'layout', 'interact_agent_num', 'valid_frames', 'interaction_od', 'source']
+
+
+def find_valid_frames(interaction_info):
+    """
+    trajectories are padded with (0, 0) positions before a vehicle appears
+    :return: case by vehicle by 2 array of the first valid frame and the end (exclusive) of the valid frames
+    """
+    valid_frames = np.zeros(interaction_info.shape + (2,), dtype=np.int64)
+    for index in np.ndindex(interaction_info.shape):
+        track = interaction_info[index]
+        if np.size(track, 1) == 0:
+            continue
+        solid_frame = np.nonzero(track[:, 0])[0]
+        if len(solid_frame):
+            valid_frames[index] = [solid_frame[0], solid_frame[-1] + 1]
+    return valid_frames
+
+
+def find_interaction_od(interaction_info, interact_agent_num, valid_frames):
+    """
+    the starting and end frame of each go-straight vehicle interacting with the left-turn vehicle of every case,
+    i.e. the frames in which it is below (y) the left-turn vehicle, without overlapping the previous one
+    :return: case by vehicle - 1 by 2 array of the origin and destination frames
+    """
+    interaction_od = np.zeros((np.size(interaction_info, 0), np.size(interaction_info, 1) - 1, 2))
+    for case_id in range(np.size(interaction_info, 0)):
+        lt_info = interaction_info[case_id, 0]
+        inter_o = interaction_od[case_id, :, 0]
+        inter_d = interaction_od[case_id, :, 1]
+
+        init_id = 0
+        for i in range(interact_agent_num[0, case_id]):
+            gs_agent_temp = interaction_info[case_id, i + 1]
+            first_frame, end_frame = valid_frames[case_id, i + 1]
+            solid_range = range(first_frame, end_frame - 1)
+            inter_frame = first_frame + np.array(
+                np.where(gs_agent_temp[solid_range, 1] - lt_info[solid_range, 1] < 0)[0])
+
+            # find start and end frame with each gs agent
+            if inter_frame.size > 1:
+                if i == init_id:
+                    inter_o[i] = inter_frame[0]
+                else:
+                    inter_o[i] = max(inter_frame[0], inter_d[i - 1])
+                inter_d[i] = max(inter_frame[-1], inter_d[i - 1])
+            else:
+                init_id += 1
+    return interaction_od
+
+
+class NDSDataset:
+    def __init__(self, mat_file, memmap_directory=None):
+        """
+        :param mat_file: NDS_data_fixed.mat
+        :param memmap_directory: directory of the memory-mappable copy, created on first use (the .mat is parsed
+        directly if None)
+        """
+        self.mat_file = mat_file
+        self.memmap_directory = memmap_directory
+        self._interaction_info = None
+        self._interact_agent_num = None
+        self._valid_frames = None
+        self._interaction_od = None
+
+    @property
+    def interaction_info(self):
+        """
+        case by vehicle object array of trajectories, the first vehicle of a case turns left
+        """
+        if self._interaction_info is None:
+            self.load()
+        return self._interaction_info
+
+    @property
+    def interact_agent_num(self):
+        """
+        1 by case array of the number of go-straight vehicles interacting with the left-turn vehicle
+        """
+        if self._interact_agent_num is None:
+            self.load()
+        return self._interact_agent_num
+
+    @property
+    def case_number(self):
+        return len(self.interaction_info)
+
+    @property
+    def valid_frames(self):
+        """
+        case by vehicle by 2 array of the first valid frame and the end (exclusive) of the valid frames
+        """
+        if self._valid_frames is None:
+            self._valid_frames = find_valid_frames(self.interaction_info)
+        return self._valid_frames
+
+    @property
+    def interaction_od(self):
+        """
+        case by vehicle - 1 by 2 array of the interaction origin and destination frame of each go-straight vehicle
+        """
+        if self._interaction_od is None:
+            self._interaction_od = find_interaction_od(self.interaction_info, self.interact_agent_num,
+                                                       self.valid_frames)
+        return self._interaction_od
+
+    def valid_track(self, case_id, vehicle_id):
+        """
+        trajectory of a vehicle without the padded frames (vehicle 0 turns left)
+        """
+        first_frame, end_frame = self.valid_frames[case_id, vehicle_id]
+        return self.interaction_info[case_id, vehicle_id][first_frame:end_frame]
+
+    def find_inter_od(self, case_id):
+        """
+        :return: origin and destination frames of the interacting go-straight vehicles of a case
+        """
+        interaction_od = self.interaction_od[case_id, :self.interact_agent_num[0, case_id]]
+        return interaction_od[:, 0].copy(), interaction_od[:, 1].copy()
+
+    def load(self):
+        if self.memmap_directory is None:
+            mat = scipy.io.loadmat(self.mat_file)
+            self._interaction_info = mat['interaction_info']
+            self._interact_agent_num = mat['interact_agent_num']
+            return
+
+        if not self.memmap_up_to_date():
+            self.convert()
+        vehicles = np.load(os.path.join(self.memmap_directory, 'vehicles.npy'), mmap_mode='r')
+        layout = np.load(os.path.join(self.memmap_directory, 'layout.npy'))
+        interaction_info = np.empty(layout.shape[0:2], dtype=object)
+        for index in np.ndindex(interaction_info.shape):
+            offset, num_row, num_column = layout[index]
+            interaction_info[index] = vehicles[offset:offset + num_row * num_column].reshape(num_row, num_column)
+        self._interaction_info = interaction_info
+        self._interact_agent_num = np.load(os.path.join(self.memmap_directory, 'interact_agent_num.npy'))
+        self._valid_frames = np.load(os.path.join(self.memmap_directory, 'valid_frames.npy'))
+        self._interaction_od = np.load(os.path.join(self.memmap_directory, 'interaction_od.npy'))
+
+    def source_stamp(self):
+        stat = os.stat(self.mat_file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def memmap_up_to_date(self):
+        for name in MEMMAP_FILES:
+            if not os.path.exists(os.path.join(self.memmap_directory, name + '.npy')):
+                return False
+        return np.array_equal(np.load(os.path.join(self.memmap_directory, 'source.npy')), self.source_stamp())
+
+    def convert(self):
+        """
+        write the memory-mappable copy: all trajectories in one flat float array, with the offset and shape of
+        each (case, vehicle) in a layout array, and the precomputed valid frames and interaction od
+        """
+        mat = scipy.io.loadmat(self.mat_file)
+        interaction_info = mat['interaction_info']
+        layout = np.zeros(interaction_info.shape + (3,), dtype=np.int64)
+        offset = 0
+        for index in np.ndindex(interaction_info.shape):
+            num_row, num_column = np.shape(interaction_info[index])
+            layout[index] = [offset, num_row, num_column]
+            offset += num_row * num_column
+        vehicles = np.concatenate([np.ravel(interaction_info[index]).astype(float)
+                                   for index in np.ndindex(interaction_info.shape)])
+
+        # write to temporary files and rename, so that a process never maps a half-written copy
+        os.makedirs(self.memmap_directory, exist_ok=True)
+        valid_frames = find_valid_frames(interaction_info)
+        arrays = {'vehicles': vehicles, 'layout': layout,
+                  'interact_agent_num': mat['interact_agent_num'],
+                  'valid_frames': valid_frames,
+                  'interaction_od': find_interaction_od(interaction_info, mat['interact_agent_num'], valid_frames),
+                  'source': self.source_stamp()}
+        for name, array in arrays.items():
+            temp_file = os.path.join(self.memmap_directory, name + '.' + str(os.getpid()) + '.tmp.npy')
+            np.save(temp_file, array)
+            os.replace(temp_file, os.path.join(self.memmap_directory, name + '.npy'))
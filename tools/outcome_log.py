@@ -0,0 +1,105 @@
+"""
+append-only log of simulation outcomes, one CSV row per case
+
+rows are buffered and appended in batches under an exclusive file lock, so several processes can write to the
+same log. Excel sheets are written at once from a whole table (see write_excel_sheet).
+"""
+import os
+import csv
+import pandas as pd
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+
+def lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def write_excel_sheet(data, workbook, sheet_name):
+    """
+    write a table to one sheet of a workbook (other sheets of an existing workbook are kept)
+    """
+    if os.path.exists(workbook):
+        with pd.ExcelWriter(workbook, mode='a', if_sheet_exists='replace', engine='openpyxl') as writer:
+            data.to_excel(writer, index=False, sheet_name=sheet_name)
+    else:
+        with pd.ExcelWriter(workbook, engine='xlsxwriter') as writer:
+            data.to_excel(writer, index=False, sheet_name=sheet_name)
+
+
+class OutcomeLog:
+    def __init__(self, filename, columns, batch_size=20):
+        """
+        :param filename: CSV file, created with a header row if it does not exist
+        :param columns: names of the values in a row
+        :param batch_size: number of buffered rows that triggers a flush
+        """
+        self.filename = filename
+        self.columns = list(columns)
+        self.batch_size = batch_size
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def append(self, row):
+        """
+        :param row: dict from column name to value
+        """
+        self._rows.append([row[column] for column in self.columns])
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        with open(self.filename, 'a', newline='') as f:
+            lock_file(f)
+            try:
+                f.seek(0, os.SEEK_END)
+                writer = csv.writer(f)
+                if f.tell() == 0:
+                    writer.writerow(self.columns)
+                writer.writerows(self._rows)
+                f.flush()
+            finally:
+                unlock_file(f)
+        self._rows = []
+
+    def read(self):
+        """
+        all flushed rows
+        """
+        if not os.path.exists(self.filename):
+            return pd.DataFrame(columns=self.columns)
+        return pd.read_csv(self.filename)
+
+    def export_excel(self, workbook, sheet_name, sort_by=None):
+        """
+        write the whole log to one sheet of a workbook (other sheets of an existing workbook are kept)
+        :param sort_by: column to sort the rows by, e.g. the case id (rows are logged in order of completion)
+        """
+        self.flush()
+        data = self.read()
+        if sort_by is not None:
+            data = data.sort_values(sort_by, kind='stable')
+        write_excel_sheet(data, workbook, sheet_name)
@@ -1,12 +1,12 @@
 """
 for visualize driving trajectories in the Jianhe-Xianxia Intersection
 """
-import scipy.io
 import numpy as np
 from matplotlib import pyplot as plt
 import pandas as pd
 import xlsxwriter
 from datetime import datetime
+from nds_dataset import NDSDataset
 
 # save trajectories into excel?
 save_trajectory = False
@@ -26,26 +26,21 @@ def vis_nds(case_id='all'):
 
     gs_num = 0
     for i in target_range:
-        # abstract interaction info. of a given case
-        case_info = inter_info[i]
         # left-turn vehicle
-        lt_info = case_info[0]
-        # go-straight vehicles
-        gs_info_multi = case_info[1:inter_num[0, i] + 1]
+        lt_info = nds_data.interaction_info[i, 0]
 
         # go straight trajectories
-        for gs_id in range(np.size(gs_info_multi, 0)):
+        for gs_id in range(nds_data.interact_agent_num[0, i]):
 
-            # delete invalid (0,0) positions
-            gs_trj_temp = gs_info_multi[gs_id][:, 0:2]
-            invalid_len = len((np.where(gs_trj_temp[:, 0] == 0))[0])
+            # without invalid (0,0) positions
+            gs_trj = nds_data.valid_track(i, gs_id + 1)
 
-            plt.plot(gs_info_multi[gs_id][invalid_len:, 0], gs_info_multi[gs_id][invalid_len:, 1],
+            plt.plot(gs_trj[:, 0], gs_trj[:, 1],
                      alpha=0.5,
                      color='red')
 
             if save_trajectory:
-                pd_trj_gs = pd.DataFrame(gs_info_multi[gs_id][invalid_len:, 0:2],
+                pd_trj_gs = pd.DataFrame(gs_trj[:, 0:2],
                                          columns=['case-' + str(i) + '-x', 'case-' + str(i) + '-y'])
                 with pd.ExcelWriter(filename, mode='a', if_sheet_exists="overlay", engine="openpyxl") as writer:
                     pd_trj_gs.to_excel(writer, startcol=2 * gs_num, index=False, sheet_name='go-straight')
@@ -65,12 +60,9 @@ def vis_nds(case_id='all'):
 
 if __name__ == '__main__':
     # load mat file
-    mat = scipy.io.loadmat('../data/NDS_data_fixed.mat')
-
-    # full interaction information
-    inter_info = mat['interaction_info']
+    nds_data = NDSDataset('../data/NDS_data_fixed.mat')
     '''
-    inter_info: (131 scenarios) x (less than 24 vehicles)
+    nds_data.interaction_info: (131 scenarios) x (less than 24 vehicles)
     in each scenario, the first vehicle was turning left and others were going straight
     for each driver, info. in column are as follow:
     0-1: [position x] [position y]
@@ -79,11 +71,10 @@ if __name__ == '__main__':
     5: [velocity overall = sqrt(vx^2+xy^2)]
     6: [curvature] (only for left-turn vehicles)
     dt = 0.12s 
+    nds_data.interact_agent_num: the number of go-straight vehicles that interact with the left-turn vehicle in
+    each scenario
     '''
 
-    # the number of go-straight vehicles that interact with the left-turn vehicle in each scenario
-    inter_num = mat['interact_agent_num']
-
     if save_trajectory:
         data_path = '../data/3_parallel_game_outputs/'
         # date = datetime.now().strftime("%Y_%m_%d-%I:%M:%S_%p")
@@ -0,0 +1,90 @@
+"""
+offscreen (Agg) rendering of animation frames on a process pool
+
+a frame is drawn by a top-level function draw_frame(fig, *args) into a cleared figure, so the drawing code of the
+interactive plots can be reused. frames are written as numbered PNGs and can be assembled into a GIF (Pillow) or
+an MP4 (ffmpeg, if installed).
+"""
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+
+
+def _use_agg():
+    matplotlib.use('Agg', force=True)
+
+
+def _render_chunk(draw_frame, frames, filenames, figsize, dpi):
+    _use_agg()
+    from matplotlib import pyplot as plt
+
+    # one figure per chunk, cleared between frames
+    fig = plt.figure(figsize=figsize)
+    for args, filename in zip(frames, filenames):
+        fig.clf()
+        draw_frame(fig, *args)
+        fig.savefig(filename, dpi=dpi)
+    plt.close(fig)
+    return filenames
+
+
+def render_frames(draw_frame, frames, filename_pattern, figsize=(12, 12), dpi=100, max_workers=None, chunk_size=8):
+    """
+    :param draw_frame: top-level function called as draw_frame(fig, *args) for each frame
+    :param frames: list of argument tuples, one per frame
+    :param filename_pattern: PNG file of a frame, formatted with the frame number, e.g. './frames/case_1_{:04d}.png',
+    or a list of PNG files, one per frame
+    :param max_workers: number of worker processes (default: number of CPUs), 1 renders in this process
+    :param chunk_size: number of consecutive frames rendered by a worker at once
+    :return: list of PNG files, in the order of frames
+    """
+    if isinstance(filename_pattern, str):
+        filenames = [filename_pattern.format(i) for i in range(len(frames))]
+    else:
+        filenames = list(filename_pattern)
+    for directory in {os.path.dirname(filename) for filename in filenames}:
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    chunks = [(frames[i:i + chunk_size], filenames[i:i + chunk_size]) for i in range(0, len(frames), chunk_size)]
+    if max_workers == 1:
+        for chunk_frames, chunk_filenames in chunks:
+            _render_chunk(draw_frame, chunk_frames, chunk_filenames, figsize, dpi)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_use_agg) as executor:
+            futures = [executor.submit(_render_chunk, draw_frame, chunk_frames, chunk_filenames, figsize, dpi)
+                       for chunk_frames, chunk_filenames in chunks]
+            for future in futures:
+                future.result()
+    return filenames
+
+
+def make_gif(png_files, gif_file, frame_duration=100):
+    """
+    :param frame_duration: display time of a frame [ms]
+    """
+    from PIL import Image
+    images = [Image.open(filename) for filename in png_files]
+    images[0].save(gif_file, save_all=True, append_images=images[1:], duration=frame_duration, loop=0)
+    for image in images:
+        image.close()
+    return gif_file
+
+
+def make_mp4(filename_pattern, mp4_file, fps=10):
+    """
+    encode numbered PNGs written by render_frames with ffmpeg
+    :param filename_pattern: the pattern given to render_frames
+    :return: mp4_file, None if ffmpeg is not installed
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        print('ffmpeg not found, ' + mp4_file + ' is not written')
+        return None
+    # ffmpeg numbers frames printf-style: '{:04d}' -> '%04d'
+    input_pattern = filename_pattern.replace('{:0', '%0').replace('d}', 'd').replace('{}', '%d')
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-framerate', str(fps), '-i', input_pattern,
+                    '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', mp4_file], check=True)
+    return mp4_file
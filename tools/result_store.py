@@ -0,0 +1,137 @@
+"""
+columnar store of simulation results
+
+every run is saved as one uncompressed .npz file of fixed-schema arrays (see AGENT_FIELDS), and one row with its
+scenario parameters and semantic result is appended to index.csv in the same directory. np.load reads the members
+of an .npz lazily, so loading one field of many runs only reads that field from each file.
+"""
+import os
+import numpy as np
+import pandas as pd
+from tools.outcome_log import lock_file, unlock_file
+
+# histories of an agent, saved as '<agent name>/<field>'
+AGENT_FIELDS = ['observed_trajectory', 'trj_solution_collection', 'action_collection']
+# histories of the estimated interacting agent of an agent, saved as '<agent name>/estimated_<field>'
+ESTIMATED_FIELDS = ['ipv_collection', 'ipv_error_collection', 'virtual_track_collection']
+INDEX_FILE = 'index.csv'
+
+
+def agent_arrays(agents):
+    """
+    arrays of the result store from simulated agents
+    :param agents: dict from agent name ('lt', 'gs') to Agent
+    :return: dict from field name to array
+    """
+    arrays = {}
+    for name, agent in agents.items():
+        for field in AGENT_FIELDS:
+            arrays[name + '/' + field] = getattr(agent, field)
+        arrays[name + '/ipv'] = np.asarray(agent.ipv, dtype=float)
+        arrays[name + '/target'] = np.asarray(agent.target)
+        if agent.estimated_inter_agent is not None:
+            arrays[name + '/estimated_ipv'] = np.asarray(agent.estimated_inter_agent.ipv, dtype=float)
+            for field in ESTIMATED_FIELDS:
+                arrays[name + '/estimated_' + field] = getattr(agent.estimated_inter_agent, field)
+    return arrays
+
+
+class StoredAgent:
+    """
+    read-only stand-in of an Agent rebuilt from the result store, with the attributes used in post-processing
+    """
+
+    def __init__(self, ipv, target=None, observed_trajectory=None, trj_solution_collection=None,
+                 action_collection=None, ipv_collection=None, ipv_error_collection=None,
+                 virtual_track_collection=None):
+        self.ipv = ipv
+        self.target = target
+        self.observed_trajectory = observed_trajectory
+        self.trj_solution_collection = trj_solution_collection
+        self.action_collection = action_collection
+        self.ipv_collection = ipv_collection
+        self.ipv_error_collection = ipv_error_collection
+        self.virtual_track_collection = virtual_track_collection
+        self.estimated_inter_agent = None
+
+
+class ResultStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def filename(self, key):
+        return os.path.join(self.directory, str(key) + '.npz')
+
+    def exists(self, key):
+        return os.path.exists(self.filename(key))
+
+    def save(self, key, arrays, **params):
+        """
+        save the arrays of one run and append its parameters to the index
+        :param key: name of the run, unique in the store
+        :param arrays: dict from field name to array
+        :param params: scalar parameters and results of the run (columns of the index)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file and rename, so that an interrupted save never leaves a truncated run behind
+        temp_file = os.path.join(self.directory, str(key) + '.' + str(os.getpid()) + '.tmp.npz')
+        np.savez(temp_file, **arrays)
+        os.replace(temp_file, self.filename(key))
+
+        # several processes of a sweep append to the same index
+        row = pd.DataFrame([dict({'key': str(key)}, **params)])
+        with open(os.path.join(self.directory, INDEX_FILE), 'a', newline='') as f:
+            lock_file(f)
+            try:
+                f.seek(0, os.SEEK_END)
+                row.to_csv(f, index=False, header=f.tell() == 0)
+                f.flush()
+            finally:
+                unlock_file(f)
+
+    def index(self):
+        """
+        scenario parameters and semantic results of all runs, one row per run (later saves of a key win)
+        """
+        index_file = os.path.join(self.directory, INDEX_FILE)
+        if not os.path.exists(index_file):
+            return pd.DataFrame(columns=['key'])
+        index = pd.read_csv(index_file, dtype={'key': str})
+        return index.drop_duplicates('key', keep='last').reset_index(drop=True)
+
+    def load(self, key):
+        """
+        lazy view of one run: fields are read from the file when they are accessed. use as a context manager
+        or close it when done
+        """
+        return np.load(self.filename(key))
+
+    def field(self, name, keys=None):
+        """
+        one field of many runs, e.g. store.field('lt/observed_trajectory')
+        :param keys: runs to read (default: all runs in the index)
+        :return: list of arrays, in the order of keys
+        """
+        if keys is None:
+            keys = self.index()['key']
+        values = []
+        for key in keys:
+            with self.load(key) as data:
+                values.append(data[name])
+        return values
+
+    def load_agents(self, key, names=('lt', 'gs')):
+        """
+        agents of one run, with their estimated interacting agents, as saved by agent_arrays
+        :return: list of StoredAgent, in the order of names
+        """
+        agents = []
+        with self.load(key) as data:
+            for name in names:
+                agent = StoredAgent(float(data[name + '/ipv']), str(data[name + '/target']),
+                                    **{field: data[name + '/' + field] for field in AGENT_FIELDS})
+                if name + '/estimated_ipv' in data.files:
+                    estimated = {field: data[name + '/estimated_' + field] for field in ESTIMATED_FIELDS}
+                    agent.estimated_inter_agent = StoredAgent(float(data[name + '/estimated_ipv']), **estimated)
+                agents.append(agent)
+        return agents
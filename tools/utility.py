@@ -1,10 +1,66 @@
 import numpy as np
 from matplotlib import pyplot as plt
 from scipy.interpolate import splrep, splev
+from scipy.spatial import cKDTree
 import math
+from collections import OrderedDict
 from shapely.geometry import LineString
 import matplotlib.patches as patches
 import matplotlib.transforms as mt
+from tools import jit_kernels
+
+
+class GrowingArray:
+    """
+    append-only array backed by a preallocated buffer that doubles its capacity when full,
+    so appending costs O(1) amortized instead of copying the whole history every time
+    """
+
+    def __init__(self, capacity=16):
+        self._capacity = capacity
+        self._buffer = None
+        self._length = 0
+
+    @classmethod
+    def from_items(cls, items):
+        growing_array = cls()
+        for item in items:
+            growing_array.append(item)
+        return growing_array
+
+    def append(self, item):
+        item = np.asarray(item, dtype=float)
+        if self._buffer is None:
+            self._buffer = np.empty((self._capacity,) + item.shape)
+        elif self._length == np.size(self._buffer, 0):
+            buffer = np.empty((2 * self._length,) + self._buffer.shape[1:])
+            buffer[:self._length] = self._buffer
+            self._buffer = buffer
+        self._buffer[self._length] = item
+        self._length += 1
+
+    @property
+    def view(self):
+        """
+        the appended items as one array (a view of the buffer)
+        """
+        if self._buffer is None:
+            return np.zeros(0)
+        return self._buffer[:self._length]
+
+    def __len__(self):
+        return self._length
+
+    def __getstate__(self):
+        # do not store the unused capacity
+        return {'items': self.view.copy()}
+
+    def __setstate__(self, state):
+        self._capacity = 16
+        self._buffer = None
+        self._length = 0
+        for item in state['items']:
+            self.append(item)
 
 
 def smooth_ployline(cv_init, point_num=1000):
@@ -107,7 +163,7 @@ def savitzky_golay(y, window_size, order, deriv=0, rate=1):
     return np.convolve(m[::-1], y, mode='valid')
 
 
-def get_central_vertices(cv_type, origin_point=None):
+def _build_central_vertices(cv_type, origin_point=None):
     cv_init = None
     if cv_type == 'lt':  # left turn
         cv_init = np.array([[0, -10], [9, -7.5], [12, -5.2], [13.5, 0], [14, 10], [14, 20], [14, 30]])
@@ -122,31 +178,324 @@ def get_central_vertices(cv_type, origin_point=None):
     return cv_smoothed, s_accumulated
 
 
+class ReferencePathCache:
+    """
+    bounded LRU cache of smoothed reference paths, so that the spline fitting in smooth_ployline
+    is paid once per path instead of once per cost evaluation.
+
+    entries are keyed by the path type and, for the NDS variants whose first vertex is the agent's
+    origin, by the origin point quantized to `quantum` meters. the spline is fitted through the
+    quantized origin, so a cached path does not depend on which caller built it first.
+    """
+
+    def __init__(self, maxsize=128, quantum=1e-3):
+        self.maxsize = maxsize
+        self.quantum = quantum
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def make_key(self, cv_type, origin_point=None):
+        if cv_type in {'lt_nds', 'gs_nds'}:
+            if origin_point is None:
+                raise ValueError(cv_type + ' reference path starts at the origin point of the agent, pass origin_point')
+            origin_q = np.round(np.asarray(origin_point, dtype=float)[0:2] / self.quantum).astype(np.int64)
+            return cv_type, int(origin_q[0]), int(origin_q[1])
+        return cv_type, None, None
+
+    def get(self, cv_type, origin_point=None):
+        """
+        :return: dict of the cached path with keys 'cv' (central vertices) and 's' (accumulated progress).
+                 other per-path precomputation may be attached to the same dict.
+        """
+        key = self.make_key(cv_type, origin_point)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+        self.misses += 1
+        if key[1] is None:
+            cv, s = _build_central_vertices(cv_type)
+        else:
+            cv, s = _build_central_vertices(cv_type, np.array(key[1:]) * self.quantum)
+        # shared between all callers, so protect them from in-place modification
+        cv.flags.writeable = False
+        s.flags.writeable = False
+        entry = {'cv': cv, 's': s}
+        self._entries[key] = entry
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+reference_path_cache = ReferencePathCache()
+
+
+def get_central_vertices(cv_type, origin_point=None):
+    entry = reference_path_cache.get(cv_type, origin_point)
+    return entry['cv'], entry['s']
+
+
+def distance_to_central_vertices(cv, points):
+    """
+    brute-force distance from each point to its nearest central vertex
+    :param cv: central vertices, n by 2
+    :param points: m by 2 array of positions
+    :return: m array of distances
+    """
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    dis = np.empty(np.size(points, 0))
+    for i in range(np.size(points, 0)):
+        dis[i] = np.amin(np.linalg.norm(cv - points[i, :], axis=1))
+    return dis
+
+
+class LaneDistanceField:
+    """
+    raster of the distance to a reference path, sampled on a regular grid around the path and
+    queried with bilinear interpolation. queries outside the grid fall back to an exact kd-tree search.
+    """
+
+    def __init__(self, cv, resolution=0.1, margin=5):
+        self.cv = cv
+        self.resolution = resolution
+        self.origin = np.amin(cv, axis=0) - margin
+        self.shape = (np.ceil((np.amax(cv, axis=0) + margin - self.origin) / resolution) + 1).astype(int)
+        self._tree = cKDTree(cv)
+
+        gx = self.origin[0] + resolution * np.arange(self.shape[0])
+        gy = self.origin[1] + resolution * np.arange(self.shape[1])
+        nodes = np.stack(np.meshgrid(gx, gy, indexing='ij'), axis=-1).reshape(-1, 2)
+        self.grid, _ = self._tree.query(nodes)
+        self.grid = self.grid.reshape(self.shape)
+
+    def _locate(self, points):
+        rel = (points - self.origin) / self.resolution
+        idx = np.floor(rel).astype(int)
+        inside = np.all((idx >= 0) & (idx < self.shape - 1), axis=1)
+        idx[~inside] = 0
+        frac = rel - idx
+        return idx, frac, inside
+
+    def distance(self, points):
+        """
+        :param points: m by 2 array of positions
+        :return: m array of (interpolated) distances to the reference path
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if jit_kernels.USE_JIT_KERNELS:
+            dis, inside = jit_kernels.bilinear_distance(points, self.origin, float(self.resolution), self.grid)
+            if not inside.all():
+                dis[~inside], _ = self._tree.query(points[~inside])
+            return dis
+        idx, frac, inside = self._locate(points)
+        ix, iy = idx[:, 0], idx[:, 1]
+        fx, fy = frac[:, 0], frac[:, 1]
+        g = self.grid
+        dis = (g[ix, iy] * (1 - fx) * (1 - fy) + g[ix + 1, iy] * fx * (1 - fy)
+               + g[ix, iy + 1] * (1 - fx) * fy + g[ix + 1, iy + 1] * fx * fy)
+        if not inside.all():
+            dis[~inside], _ = self._tree.query(points[~inside])
+        return dis
+
+    def distance_and_gradient(self, points):
+        """
+        :param points: m by 2 array of positions
+        :return: m array of distances and m by 2 array of their gradients w.r.t. the positions
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        idx, frac, inside = self._locate(points)
+        ix, iy = idx[:, 0], idx[:, 1]
+        fx, fy = frac[:, 0], frac[:, 1]
+        g = self.grid
+        g00, g10, g01, g11 = g[ix, iy], g[ix + 1, iy], g[ix, iy + 1], g[ix + 1, iy + 1]
+        dis = g00 * (1 - fx) * (1 - fy) + g10 * fx * (1 - fy) + g01 * (1 - fx) * fy + g11 * fx * fy
+        grad = np.empty_like(points)
+        grad[:, 0] = ((g10 - g00) * (1 - fy) + (g11 - g01) * fy) / self.resolution
+        grad[:, 1] = ((g01 - g00) * (1 - fx) + (g11 - g10) * fx) / self.resolution
+        if not inside.all():
+            dis_out, nearest = self._tree.query(points[~inside])
+            dis[~inside] = dis_out
+            grad[~inside] = (points[~inside] - self.cv[nearest]) / np.maximum(dis_out, 1e-9)[:, None]
+        return dis, grad
+
+
+def get_lane_distance_field(cv_type, origin_point=None):
+    """
+    distance field of the reference path, built once per cached get_central_vertices result
+    """
+    entry = reference_path_cache.get(cv_type, origin_point)
+    if 'field' not in entry:
+        entry['field'] = LaneDistanceField(entry['cv'])
+    return entry['field']
+
+
+def check_lane_distance_field(cv_type, origin_point=None, num_points=2000, seed=0):
+    """
+    compare the distance field against the brute-force search on random points around the path
+    :param origin_point: first point of the path, required for 'lt_nds' and 'gs_nds'
+    :return: maximal absolute error and the grid resolution (the bound it should stay within)
+    """
+    field = get_lane_distance_field(cv_type, origin_point)
+    rng = np.random.default_rng(seed)
+    low = np.amin(field.cv, axis=0) - 5
+    high = np.amax(field.cv, axis=0) + 5
+    points = rng.uniform(low, high, size=(num_points, 2))
+    error = np.abs(field.distance(points) - distance_to_central_vertices(field.cv, points))
+    return np.amax(error), field.resolution
+
+
+# rear and front axle distances to the center of mass of the bicycle model
+R_LEN = 0.8
+F_LEN = 1
+
+
+def state_array(init_state):
+    try:
+        return np.asarray(init_state, dtype=float)
+    except ValueError:  # heading given as a one-element array
+        return np.array([np.squeeze(s) for s in init_state], dtype=float)
+
+
+def kinematic_model_batch(u, init_state, dt):
+    """
+    roll out the bicycle model for a batch of control sequences at once.
+    speed and heading are prefix sums of the controls, so every step is evaluated with cumulative sums
+    :param u: N by (TRACK_LEN - 1) by 2 array of controls [acceleration, steering angle]
+    :param init_state: N by 5 array of initial states [x, y, vx, vy, heading], or one state shared by all
+    :param dt:
+    :return: N by TRACK_LEN by 5 array of tracks [x, y, vx, vy, heading]
+    """
+    r_len = R_LEN
+    f_len = F_LEN
+    u = np.asarray(u, dtype=float)
+    num_seq, num_step = u.shape[0], u.shape[1]
+    init_state = state_array(init_state).reshape(-1, 5)
+    if init_state.shape[0] != num_seq:
+        init_state = np.repeat(init_state, num_seq, axis=0)
+
+    acc = u[:, :, 0]
+    beta = np.arctan((r_len / (r_len + f_len)) * np.tan(u[:, :, 1]))
+
+    # speed at the beginning of each step (and at the end of the last one)
+    v_all = np.empty([num_seq, num_step + 1])
+    v_all[:, 0] = np.sqrt(init_state[:, 2] ** 2 + init_state[:, 3] ** 2)
+    v_all[:, 1:] = acc * dt
+    v_all = np.cumsum(v_all, axis=1)
+    v = v_all[:, :-1]
+
+    psi = np.empty([num_seq, num_step + 1])
+    psi[:, 0] = init_state[:, 4]
+    psi[:, 1:] = (v / f_len) * np.sin(beta) * dt
+    psi = np.cumsum(psi, axis=1)
+
+    track = np.empty([num_seq, num_step + 1, 5])
+    track[:, 0, :] = init_state
+    track[:, 1:, 0] = v * np.cos(psi[:, :-1] + beta) * dt
+    track[:, 1:, 1] = v * np.sin(psi[:, :-1] + beta) * dt
+    track[:, :, 0:2] = np.cumsum(track[:, :, 0:2], axis=1)
+    track[:, 1:, 2] = v_all[:, 1:] * np.cos(psi[:, 1:])
+    track[:, 1:, 3] = v_all[:, 1:] * np.sin(psi[:, 1:])
+    track[:, 1:, 4] = psi[:, 1:]
+    return track
+
+
 def kinematic_model(u, init_state, TRACK_LEN, dt):
+    u = np.asarray(u, dtype=float)
     if not np.size(u, 0) == TRACK_LEN - 1:
-        u = np.array([u[0:TRACK_LEN - 1], u[TRACK_LEN - 1:]]).T
-    r_len = 0.8
-    f_len = 1
-    x, y, vx, vy, h = init_state
-    # track = [init_state]
-    psi = h
-    track = [[x, y, vx, vy, h]]
-    v_temp = np.sqrt(vx ** 2 + vy ** 2)
-
-    for i in range(len(u)):
-        a = u[i][0]
-        delta = u[i][1]
-        beta = math.atan((r_len / (r_len + f_len)) * math.tan(delta))
-        x = x + v_temp * np.cos(psi + beta) * dt
-        y = y + v_temp * np.sin(psi + beta) * dt
-        psi = psi + (v_temp / f_len) * np.sin(beta) * dt
-        v_temp = v_temp + a * dt
-
-        vx = v_temp * np.cos(psi)
-        vy = v_temp * np.sin(psi)
-
-        track.append([x, y, vx, vy, psi])
-    return np.array(track)
+        # flattened controls: all accelerations first, then all steering angles
+        u = u.reshape(2, TRACK_LEN - 1).T
+    if jit_kernels.USE_JIT_KERNELS:
+        return jit_kernels.rollout(np.ascontiguousarray(u.reshape(TRACK_LEN - 1, 2)),
+                                   state_array(init_state).reshape(5), dt, R_LEN, F_LEN)
+    u = u.reshape(1, TRACK_LEN - 1, 2)
+    return kinematic_model_batch(u, init_state, dt)[0]
+
+
+def kinematic_model_vjp(u, init_state, grad_position, dt):
+    """
+    back-propagate a gradient w.r.t. the positions of a track through the bicycle model
+    :param u: (TRACK_LEN - 1) by 2 array of controls [acceleration, steering angle]
+    :param init_state: initial state [x, y, vx, vy, heading]
+    :param grad_position: TRACK_LEN by 2 array, gradient of a scalar w.r.t. the positions of the track
+    :param dt:
+    :return: (TRACK_LEN - 1) by 2 array, gradient of the scalar w.r.t. the controls
+    """
+    r_len = R_LEN
+    f_len = F_LEN
+    k = r_len / (r_len + f_len)
+    u = np.asarray(u, dtype=float)
+    track = kinematic_model_batch(u[None], init_state, dt)[0]
+    delta = u[:, 1]
+    beta = np.arctan(k * np.tan(delta))
+    v = np.cumsum(np.concatenate([[np.hypot(track[0, 2], track[0, 3])], u[:-1, 0] * dt]))
+    c = track[:-1, 4] + beta
+
+    # gradient w.r.t. the displacement of step i is the summed gradient of all later positions
+    g = np.cumsum(grad_position[:0:-1], axis=0)[::-1]
+    grad_c = v * dt * (-np.sin(c) * g[:, 0] + np.cos(c) * g[:, 1])
+    # heading of step i accumulates the yaw rate of all former steps
+    grad_psi_later = np.concatenate([np.cumsum(grad_c[:0:-1])[::-1], [0]])
+    grad_beta = grad_c + grad_psi_later * (v / f_len) * np.cos(beta) * dt
+    grad_v = dt * (np.cos(c) * g[:, 0] + np.sin(c) * g[:, 1]) + grad_psi_later * np.sin(beta) * dt / f_len
+    # speed of step i accumulates the acceleration of all former steps
+    grad_acc = dt * np.concatenate([np.cumsum(grad_v[:0:-1])[::-1], [0]])
+    grad_delta = grad_beta * k / np.cos(delta) ** 2 / (1 + (k * np.tan(delta)) ** 2)
+    return np.array([grad_acc, grad_delta]).T
+
+
+def kinematic_model_step(state, u, dt):
+    """
+    one step of the bicycle model in its own state [x, y, speed, heading] (see kinematic_model_batch)
+    :param state: [x, y, speed, heading]
+    :param u: [acceleration, steering angle]
+    :return: state after the step
+    """
+    x, y, v, psi = state
+    beta = math.atan(R_LEN / (R_LEN + F_LEN) * math.tan(u[1]))
+    return np.array([x + v * math.cos(psi + beta) * dt,
+                     y + v * math.sin(psi + beta) * dt,
+                     v + u[0] * dt,
+                     psi + v / F_LEN * math.sin(beta) * dt])
+
+
+def kinematic_model_jacobians(states, u, dt):
+    """
+    linearization of kinematic_model_step along a track
+    :param states: (TRACK_LEN - 1) by 4 array of states [x, y, speed, heading] at the beginning of each step
+    :param u: (TRACK_LEN - 1) by 2 array of controls [acceleration, steering angle]
+    :return: (TRACK_LEN - 1) by 4 by 4 array of state Jacobians, (TRACK_LEN - 1) by 4 by 2 array of control Jacobians
+    """
+    k = R_LEN / (R_LEN + F_LEN)
+    v, psi = states[:, 2], states[:, 3]
+    beta = np.arctan(k * np.tan(u[:, 1]))
+    dbeta = k / np.cos(u[:, 1]) ** 2 / (1 + (k * np.tan(u[:, 1])) ** 2)
+    c = psi + beta
+
+    num_step = np.size(u, 0)
+    jac_state = np.repeat(np.eye(4)[None], num_step, axis=0)
+    jac_state[:, 0, 2] = np.cos(c) * dt
+    jac_state[:, 0, 3] = -v * np.sin(c) * dt
+    jac_state[:, 1, 2] = np.sin(c) * dt
+    jac_state[:, 1, 3] = v * np.cos(c) * dt
+    jac_state[:, 3, 2] = np.sin(beta) / F_LEN * dt
+
+    jac_control = np.zeros([num_step, 4, 2])
+    jac_control[:, 0, 1] = -v * np.sin(c) * dbeta * dt
+    jac_control[:, 1, 1] = v * np.cos(c) * dbeta * dt
+    jac_control[:, 2, 0] = dt
+    jac_control[:, 3, 1] = v / F_LEN * np.cos(beta) * dbeta * dt
+    return jac_state, jac_control
 
 
 def get_intersection_point(polyline1, polyline2):
@@ -157,6 +506,47 @@ def get_intersection_point(polyline1, polyline2):
     return inter_point
 
 
+def segment_intersections(polyline1, polyline2):
+    """
+    crossing points of two polylines, all pairs of segments at once
+    :return: K by 2 array of crossing points ordered along polyline1, index of the segment of polyline1 and of
+    polyline2 of each crossing point
+    """
+    p = polyline1[:-1, :]
+    r = polyline1[1:, :] - p
+    q = polyline2[:-1, :]
+    s = polyline2[1:, :] - q
+
+    # p + t * r = q + u * s
+    qp = q[np.newaxis, :, :] - p[:, np.newaxis, :]
+    r_cross_s = r[:, np.newaxis, 0] * s[np.newaxis, :, 1] - r[:, np.newaxis, 1] * s[np.newaxis, :, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (qp[:, :, 0] * s[np.newaxis, :, 1] - qp[:, :, 1] * s[np.newaxis, :, 0]) / r_cross_s
+        u = (qp[:, :, 0] * r[:, np.newaxis, 1] - qp[:, :, 1] * r[:, np.newaxis, 0]) / r_cross_s
+    # parallel (and collinear) segments are not counted as crossing
+    crossing = (r_cross_s != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    index1, index2 = np.nonzero(crossing)
+    points = p[index1, :] + t[index1, index2, np.newaxis] * r[index1, :]
+    return points, index1, index2
+
+
+def project_to_polyline(polyline, point):
+    """
+    nearest point of a polyline to a given point
+    :return: arc length of the nearest point along the polyline, distance to it
+    """
+    start = polyline[:-1, :]
+    delta = polyline[1:, :] - start
+    seg_len = np.linalg.norm(delta, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tau = np.sum((point - start) * delta, axis=1) / seg_len ** 2
+    tau = np.clip(np.nan_to_num(tau), 0, 1)
+    dis = np.linalg.norm(start + tau[:, np.newaxis] * delta - point, axis=1)
+    index = np.argmin(dis)
+    progress = np.sum(seg_len[:index]) + tau[index] * seg_len[index]
+    return progress, dis[index]
+
+
 def draw_rectangle(x, y, deg, ax, para_alpha=0.5, para_color='blue'):
     car_len = 1
     car_wid = 2